@@ -0,0 +1,182 @@
+"""
+    Per-worker admission control: every route class (public catalog reads, shelf operations, writes and bulk operations)
+    has its own concurrency limit and bounded wait queue so the expensive endpoints can't take all the database
+    connections, requests that can't wait are rejected early with 503 and a Retry-After header.
+    The authenticated users are also rate limited with a token bucket each (see auth.requires_auth).
+"""
+import math
+import os
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import BoundedSemaphore, Lock
+from constants import ADMISSION_LIMITS, ADMISSION_TIMEOUT, ADMISSION_RETRY_AFTER, RATE_LIMIT, RATE_LIMIT_BURST, \
+    RATE_LIMIT_MAX_USERS
+
+# route classes
+CATALOG = "catalog"
+SHELVES = "shelves"
+WRITES = "writes"
+BULK = "bulk"
+
+
+class Overloaded(Exception):
+    """ Rejected request, answered with the status code and a Retry-After header """
+
+    def __init__(self, description: str, status_code: int, retry_after: int):
+        self.description = description
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class RouteClass():
+    """ At most limit concurrent requests, at most queue more requests wait up to timeout seconds for their turn """
+
+    def __init__(self, limit: int, queue: int, timeout: float = ADMISSION_TIMEOUT):
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self._slots = BoundedSemaphore(limit)
+        self._lock = Lock()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+
+    def acquire(self):
+        """ Returns whether the request got a slot, the caller must release() it """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.queue:
+                    self.shed += 1
+                    return False
+                self.waiting += 1
+            acquired = self._slots.acquire(timeout=self.timeout)
+            with self._lock:
+                self.waiting -= 1
+                if not acquired:
+                    self.shed += 1
+                    return False
+        with self._lock:
+            self.active += 1
+            self.admitted += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "queue": self.queue,
+                "active": self.active,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "shed": self.shed
+            }
+
+
+class AdmissionControl():
+    def __init__(self, limits=ADMISSION_LIMITS):
+        # route class: RouteClass
+        self.classes = {name: RouteClass(limit, queue) for name, (limit, queue) in limits.items()}
+
+    def limit(self, route_class: str):
+        """ Runs the view within the limits of the route class, the slot of a streamed response
+            is held until the response is sent
+        """
+        def limit_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                limits = self.classes[route_class]
+                if not limits.acquire():
+                    raise Overloaded(f"too many {route_class} requests", 503, ADMISSION_RETRY_AFTER)
+
+                released = []
+
+                def release():
+                    # once, by the end of the stream or by the close of the response
+                    if not released:
+                        released.append(True)
+                        limits.release()
+
+                try:
+                    response = f(*args, **kwargs)
+                except BaseException:
+                    release()
+                    raise
+                if getattr(response, "is_streamed", False):
+                    def stream(iterable):
+                        try:
+                            yield from iterable
+                        finally:
+                            release()
+                    response.response = stream(response.response)
+                    response.call_on_close(release)
+                else:
+                    release()
+                return response
+
+            return wrapper
+        return limit_decorator
+
+    def stats(self):
+        return {
+            "classes": {name: limits.stats() for name, limits in self.classes.items()},
+            "worker": os.getpid()
+        }
+
+
+class RateLimiter():
+    """ Token bucket of every user: rate tokens per second up to burst tokens, a request takes a token,
+        the least recently seen users are dropped past max_users (a dropped user starts with a full bucket)
+    """
+
+    def __init__(self, rate: float = RATE_LIMIT, burst: int = RATE_LIMIT_BURST, max_users: int = RATE_LIMIT_MAX_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        # user id: (tokens, time)
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+        self.limited = 0
+
+    def take(self, user_id: str):
+        """ Takes a token of the user, returns 0 or the seconds until the user has a token when there's none """
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(user_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[user_id] = (tokens, now)
+                self.limited += 1
+                return (1 - tokens) / self.rate
+            self._buckets[user_id] = (tokens - 1, now)
+            self._buckets.move_to_end(user_id)
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        return 0
+
+    def check(self, user_id: str):
+        """ Raises Overloaded (429) when the user has no token left """
+        wait = self.take(user_id)
+        if wait:
+            raise Overloaded("too many requests", 429, math.ceil(wait))
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "users": len(self._buckets),
+            "limited": self.limited
+        }
+
+
+admission = AdmissionControl()
+rate_limiter = RateLimiter()
+
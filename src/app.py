@@ -1,40 +1,109 @@
-from flask import Flask, request, abort, jsonify, redirect
+from flask import Flask, request, abort, redirect
 from flask_cors import CORS
 import datetime
 import re
+from collections import Counter
 from auth import get_token_from_code, requires_auth, AuthError, get_user_id, get_login_url
+from local_issuer import local_issuer
+from cache import response_cache, setup_cache
+from encoder import jsonify, setup_json
+from catalog_cache import book_summaries, setup_catalog_cache
+from shelf_cache import shelf_summaries, setup_shelf_cache
+from autocomplete import autocomplete_index, setup_autocomplete, BOOK, AUTHOR
+from jobs import job_runner, setup_jobs
+from admission import admission, rate_limiter, Overloaded, CATALOG, SHELVES, WRITES, BULK
+from conditional import conditional, versions_of
+from export import stream_export, FORMATS as EXPORT_FORMATS
+from constants import AUTH_PROVIDER, CHANGES_PER_PAGE, MAX_CHANGES_PER_PAGE, MAX_LOOKUP_IDS, MAX_BULK_BOOKS, MAX_BULK_UPDATES
+from constants import AUTOCOMPLETE_LIMIT, MAX_AUTOCOMPLETE_LIMIT, SIMILAR_BOOKS, SIMILAR_BOOKS_PER_PAGE, MAX_JOB_ITEMS
 from models import *
 
+# the cached query arguments that the views parse (see get_page and with_total)
+PAGE_ARGS = (("page", int), ("per_page", int))
+TOTAL_ARG = ("include_total", str.lower)
+
 
 def create_app():
     app = Flask(__name__)
     setup_db(app)
+    setup_cache(app)
+    setup_json(app)
+    setup_catalog_cache(app, Change.head, Change.feed)
+    setup_shelf_cache(app)
+    with app.app_context():
+        setup_autocomplete(app, get_names)
+    setup_jobs(app)
     CORS(app)
+    if AUTH_PROVIDER == "local":
+        # serve the jwks, token and authorize endpoints of the local stand-in issuer
+        app.register_blueprint(local_issuer)
+
     # region BOOKS
 
     @app.route("/books")
+    @response_cache.cached("books", args=("ids", ("genre", Genre.make_key), "search_term", "sort", *PAGE_ARGS, TOTAL_ARG,
+                                          "fields", "facets"))
+    @admission.limit(CATALOG)
     def get_books():
+        ids = request.args.get("ids", type=str)
+        if ids:
+            return lookup_books(ids)
+
         genre = request.args.get("genre", type=str)
         search_term = request.args.get("search_term", type=str)
-        books_query = Book.query
+        fields = parse_fields(Book.FIELDS, Book.SUMMARY_FIELDS)
+        # the summaries come from the book cache, only the ids of the page are queried
+        summaries = set(fields) == set(Book.SUMMARY_FIELDS)
+        books_query = Book.select(["id"] if summaries else fields)
         if genre:
+            # filter with an integer join on the genre id
             books_query = books_query.join(
-                BookGenre, Book.id == BookGenre.book_id).filter(BookGenre.genre.ilike(genre))
+                BookGenre, Book.id == BookGenre.book_id).filter(BookGenre.genre_id == Genre.get_id(genre))
 
         if search_term:
             books_query = books_query.filter(
-                Book.title.ilike(f"%{search_term}%"))
+                Book.title.ilike(f"%{escape_like(search_term)}%", escape="\\"))
+
+        sort = request.args.get("sort", type=str)
+        if sort and sort not in BOOK_SORTS:
+            abort(422)
+        if sort == "popularity":
+            # the order changes with the stored books
+            response_cache.tag("popularity")
+        books_query = books_query.order_by(*BOOK_SORTS.get(sort, [Book.id]))
+        response = with_total({
+            "success": True,
+            "books": paginate(books_query, lambda page: Book.get_summaries([row["id"] for row in page])
+                              if summaries else Book.format_rows(page, fields))
+        }, books_query)
+
+        facets = request.args.get("facets", "", type=str).split(",")
+        if "genres" in facets:
+            # the genre counts ignore the genre filter so they can be used to change it
+            response["facets"] = {"genres": BookGenre.count_books(search_term)}
+
+        return jsonify(response)
 
-        books = books_query.all()
+    def lookup_books(ids):
+        """ Returns the details of many books at once in request order """
+        try:
+            # remove duplicates keeping the request order
+            ids = list(dict.fromkeys(int(id) for id in ids.split(",")))
+        except ValueError:
+            abort(422)
+        if len(ids) > MAX_LOOKUP_IDS:
+            abort(422)
 
+        books = Book.get_many(ids, parse_fields(Book.FIELDS, Book.FIELDS))
         return jsonify({
             "success": True,
-            "books": paginate(books),
-            "total": len(books)
+            "books": [books[id] for id in ids if id in books],
+            "missing": [id for id in ids if id not in books]
         })
 
     @app.route("/books", methods=["POST"])
     @requires_auth("post:books")
+    @admission.limit(WRITES)
     def create_book():
         data = request.json
         try:
@@ -51,39 +120,75 @@ def create_app():
         if not (title and description and year and author_id.isnumeric() and pages.isnumeric() and type(genres) == list):
             # if the body has an empty string or invalid numeric value then raise unprocessable entity error
             abort(422)
-        elif Book.query.filter(Book.title.ilike(title)).first():
+        elif Book.query.filter(Book.title.ilike(escape_like(title), escape="\\")).first():
             # if the book already exists raise conflict error
             abort(409)
 
         # check if author exists
         author_id = int(author_id)
-        if not Author.query.filter_by(id=author_id).first():
+        author = Author.query.filter_by(id=author_id).first()
+        if not author:
             abort(404)
 
         # add book
         book = Book(title, description, author_id, pages, year)
         book.insert()
 
-        # Add genres
-        for genre in genres:
+        # Add genres, names that only differ in case are the same genre
+        for genre in {Genre.make_key(genre): genre for genre in genres}.values():
             BookGenre(book.id, genre).insert()
 
+        # the author details include the author's books
+        author.touch()
+        response_cache.invalidate("books", f"author-books:{author_id}")
+        autocomplete_index.put(BOOK, book.id, book.title)
         return jsonify({
             "success": True,
             "created": book.id
         }), 201
 
     @app.route("/books/<id>")
+    @conditional(versions_of(Book))
+    @response_cache.cached("book:{id}", args=("fields",))
+    @admission.limit(CATALOG)
     def get_book_details(id):
+        fields = parse_fields(Book.FIELDS, Book.FIELDS)
+        book = Book.get_formatted(id, fields)
+        if "author" in book:
+            # the details include the author name
+            response_cache.tag(f"author:{book['author']['id']}")
+        return jsonify({
+            "success": True,
+            "book": book
+        })
+
+    @app.route("/books/<id>/similar")
+    @admission.limit(CATALOG)
+    def get_similar_books(id):
+        limit = request.args.get("limit", SIMILAR_BOOKS_PER_PAGE, type=int)
+        if not 0 < limit <= SIMILAR_BOOKS:
+            abort(422)
+        try:
+            id = int(id)
+        except ValueError:
+            abort(404)
+
+        # one index lookup of the precomputed neighbors, the summaries come from the book cache
+        ids = SimilarBook.get_ids(id, limit)
+        if not ids:
+            # the book doesn't exist or has no similar books
+            Book.get(id)
         return jsonify({
             "success": True,
-            "book": Book.get(id).detailed_format()
+            "books": Book.get_summaries(ids)
         })
 
     @app.route("/books/<id>", methods=["PATCH"])
     @requires_auth("patch:books")
+    @admission.limit(WRITES)
     def edit_book(id):
         book = Book.get(id)
+        old_author_id = book.author_id
         data = request.json
         if not data:
             abort(400)
@@ -111,34 +216,165 @@ def create_app():
             db.session.rollback()
             abort(422)
 
-        # update genres
-        old_genres = [
-            g.genre for g in BookGenre.query.filter_by(book_id=id).all()]
-        if new_genres and new_genres != old_genres:
-            for genre in (old_genres + new_genres):
-                if genre not in old_genres:
-                    BookGenre(book.id, genre).insert()
-                elif genre not in new_genres:
-                    BookGenre.query.filter_by(
-                        book_id=id, genre=genre).first().delete()
-
+        # update genres, comparing them by key since the names are case insensitive
+        old_genres = {
+            g.genre.key: g for g in BookGenre.query.filter_by(book_id=book.id).all()}
+        new_genres = {Genre.make_key(genre): genre for genre in new_genres or []}
+        if new_genres and new_genres.keys() != old_genres.keys():
+            for key in new_genres.keys() - old_genres.keys():
+                BookGenre(book.id, new_genres[key]).insert()
+            for key in old_genres.keys() - new_genres.keys():
+                old_genres[key].delete()
+            book.touch()
+
+        # the author details include the author's books
+        for author in Author.query.filter(Author.id.in_({old_author_id, book.author_id})).all():
+            author.touch()
+
+        response_cache.invalidate("books", f"book:{book.id}", f"author-books:{old_author_id}",
+                                  f"author-books:{book.author_id}")
+        autocomplete_index.put(BOOK, book.id, book.title)
         return jsonify({
             "success": True
         }), 200
 
+    # status: message of the failed items of the bulk updates
+    BULK_UPDATE_ERRORS = {404: "not found", 409: "duplicate", 422: "unprocessable"}
+
+    def get_bulk_updates(parse):
+        """ Validates the list of partial updates of the bulk PATCH requests
+            parse : function that takes an update and returns (id, columns) or raises KeyError, TypeError or ValueError
+            Returns: (id: columns of the valid updates, the id and status of every update in request order)
+        """
+        items = request.json
+        if not isinstance(items, list):
+            abort(400)
+        if not 0 < len(items) <= MAX_BULK_UPDATES:
+            abort(422)
+
+        updates, results = {}, []
+        for item in items:
+            try:
+                id, columns = parse(item)
+                status = 409 if id in updates else 200
+            except (KeyError, TypeError, ValueError, AttributeError):
+                id, status = item.get("id") if isinstance(item, dict) else None, 422
+            results.append({"id": id, "status": status})
+            if status == 200:
+                updates[id] = columns
+        return updates, results
+
+    def fail_bulk_updates(updates: dict, results: list, ids: set, status: int):
+        """ Removes the given ids from the updates and marks their results as failed """
+        for result in results:
+            if result["status"] == 200 and result["id"] in ids:
+                result["status"] = status
+        for id in ids:
+            updates.pop(id, None)
+
+    def format_bulk_results(results: list):
+        for result in results:
+            if result["status"] != 200:
+                result["message"] = BULK_UPDATE_ERRORS[result["status"]]
+        return results
+
+    def parse_book_update(item: dict):
+        columns = {}
+        for column in ("title", "description"):
+            if column in item:
+                columns[column] = item[column].strip()
+                if not columns[column]:
+                    raise ValueError
+        for column in ("author_id", "pages", "year"):
+            if column in item:
+                columns[column] = int(item[column])
+                # a value out of the column range would fail the whole transaction
+                if not -2 ** 31 <= columns[column] < 2 ** 31:
+                    raise ValueError
+        if "genres" in item:
+            if type(item["genres"]) != list or not all(isinstance(genre, str) for genre in item["genres"]):
+                raise TypeError
+            columns["genres"] = item["genres"]
+        return int(item["id"]), columns
+
+    @app.route("/books", methods=["PATCH"])
+    @requires_auth("patch:books")
+    @admission.limit(BULK)
+    def edit_books():
+        updates, results = get_bulk_updates(parse_book_update)
+
+        books = {book.id: book for book in Book.query.filter(Book.id.in_(updates)).all()}
+        fail_bulk_updates(updates, results, updates.keys() - books.keys(), 404)
+        author_ids = {columns["author_id"] for columns in updates.values() if "author_id" in columns}
+        if author_ids:
+            missing = author_ids - {row.id for row in fetch_rows(db.session.query(Author.id).filter(Author.id.in_(author_ids)))}
+            fail_bulk_updates(updates, results,
+                              {id for id, columns in updates.items() if columns.get("author_id") in missing}, 404)
+
+        # the genres of all the books are synced at once, like the single book update an empty list keeps them
+        genre_updates = {id: columns.pop("genres") for id, columns in updates.items() if columns.get("genres")}
+        old_genres = BookGenre.get_of(list(genre_updates))
+        genre_ids = Genre.get_or_create_many([genre for genres in genre_updates.values() for genre in genres])
+
+        author_ids = set()
+        for id, columns in updates.items():
+            book = books[id]
+            author_ids.update({book.author_id, columns.get("author_id", book.author_id)})
+            for column, value in columns.items():
+                setattr(book, column, value)
+            if id in genre_updates:
+                new = {Genre.make_key(genre): genre for genre in genre_updates[id]}
+                old = old_genres.get(id, {})
+                if new.keys() != old.keys():
+                    for key in new.keys() - old.keys():
+                        db.session.add(BookGenre(id, new[key], genre_ids[key]))
+                    for key in old.keys() - new.keys():
+                        db.session.delete(old[key])
+                    book.bump()
+        # the author details include the author's books
+        for author in Author.query.filter(Author.id.in_(author_ids)).all():
+            author.bump()
+        # read before the commit expires the books
+        titles = {id: books[id].title for id in updates}
+        # every change is flushed and committed at once, the versions, change log and author statistics
+        # are maintained by the flush hooks like for single updates
+        db.session.commit()
+
+        if updates:
+            response_cache.invalidate("books", *[f"book:{id}" for id in updates],
+                                      *[f"author-books:{id}" for id in author_ids])
+            for id, title in titles.items():
+                autocomplete_index.put(BOOK, id, title)
+        return jsonify({
+            "success": True,
+            "updated": len(updates),
+            "results": format_bulk_results(results)
+        }), 200
+
     @app.route("/books/<id>", methods=["DELETE"])
     @requires_auth("delete:books")
+    @admission.limit(WRITES)
     def delete_book(id):
         book = Book.get(id)
+        author = Author.get(book.author_id)
 
         # delete book genres
         for g in BookGenre.query.filter_by(book_id=book.id).all():
             g.delete()
 
+        shelf_ids = set()
         for stored_book in Stored_Book.query.filter_by(book_id=book.id).all():
+            shelf_ids.add(stored_book.shelf_id)
+            shelf_summaries.add_books(stored_book.user_id, stored_book.shelf_id, -1)
             stored_book.delete()
         # then delete the book
         book.delete()
+        author.touch()
+        for shelf in Shelf.query.filter(Shelf.id.in_(shelf_ids)).all():
+            shelf.touch()
+        response_cache.invalidate(
+            "books", f"book:{int(id)}", f"author-books:{author.id}")
+        autocomplete_index.remove(BOOK, int(id))
         return jsonify({
             "success": True,
             "deleted": int(id)
@@ -146,25 +382,41 @@ def create_app():
 
     # endregion
 
+    # region GENRES
+
+    @app.route("/genres")
+    @response_cache.cached("books")
+    @admission.limit(CATALOG)
+    def get_genres():
+        return jsonify({
+            "success": True,
+            "genres": BookGenre.count_books()
+        })
+
+    # endregion
+
     # region AUTHORS
 
     @app.route("/authors")
+    @response_cache.cached("authors", args=("search_term", *PAGE_ARGS, TOTAL_ARG, "fields"))
+    @admission.limit(CATALOG)
     def get_authors():
         search_term = request.args.get("search_term", type=str)
-        authors_query = Author.query
+        fields = parse_fields(Author.FIELDS, Author.SUMMARY_FIELDS)
+        authors_query = Author.select(fields)
         if search_term:
             authors_query = authors_query.filter(
-                Author.name.ilike(f"%{search_term}%"))
+                Author.name.ilike(f"%{escape_like(search_term)}%", escape="\\"))
 
-        authors = authors_query.all()
-        return jsonify({
+        authors_query = authors_query.order_by(Author.id)
+        return jsonify(with_total({
             "success": True,
-            "authors": paginate(authors),
-            "total": len(authors)
-        })
+            "authors": paginate(authors_query, lambda page: Author.format_rows(page, fields))
+        }, authors_query))
 
     @app.route("/authors", methods=["POST"])
     @requires_auth("post:authors")
+    @admission.limit(WRITES)
     def create_author():
         data = request.json
         try:
@@ -178,7 +430,7 @@ def create_app():
         if not (name and description and birthday):
             # if the body has an empty string then raise unprocessable entity error
             abort(422)
-        elif Author.query.filter(Author.name.ilike(name)).first():
+        elif Author.query.filter(Author.name.ilike(escape_like(name), escape="\\")).first():
             # if the author already exists raise conflict error
             abort(409)
 
@@ -191,20 +443,27 @@ def create_app():
 
         author = Author(name, description, birthday)
         author.insert()
+        response_cache.invalidate("authors")
+        autocomplete_index.put(AUTHOR, author.id, author.name)
         return jsonify({
             "success": True,
             "created": author.id
         }), 201
 
     @app.route("/authors/<id>")
+    @conditional(versions_of(Author))
+    @response_cache.cached("author:{id}", "author-books:{id}", args=(*PAGE_ARGS, "fields"))
+    @admission.limit(CATALOG)
     def get_author_details(id):
+        fields = parse_fields(Author.DETAILED_FIELDS, Author.DETAILED_FIELDS)
         return jsonify({
             "success": True,
-            "author": Author.get(id).detailed_format()
+            "author": Author.get(id).detailed_format(fields)
         })
 
     @app.route("/authors/<id>", methods=["PATCH"])
     @requires_auth("patch:authors")
+    @admission.limit(WRITES)
     def edit_author(id):
         author = Author.get(id)
         data = request.json
@@ -229,12 +488,53 @@ def create_app():
             db.session.rollback()
             abort(422)
 
+        # book listings and details include the author name
+        response_cache.invalidate("authors", f"author:{author.id}", "books")
+        autocomplete_index.put(AUTHOR, author.id, author.name)
         return jsonify({
             "success": True
         }), 200
 
+    def parse_author_update(item: dict):
+        columns = {}
+        for column in ("name", "description"):
+            if column in item:
+                columns[column] = item[column].strip()
+                if not columns[column]:
+                    raise ValueError
+        if item.get("birthday"):
+            columns["birthday"] = datetime.datetime(*map(int, re.split("/|-", item["birthday"])))
+        return int(item["id"]), columns
+
+    @app.route("/authors", methods=["PATCH"])
+    @requires_auth("patch:authors")
+    @admission.limit(BULK)
+    def edit_authors():
+        updates, results = get_bulk_updates(parse_author_update)
+
+        authors = {author.id: author for author in Author.query.filter(Author.id.in_(updates)).all()}
+        fail_bulk_updates(updates, results, updates.keys() - authors.keys(), 404)
+        for id, columns in updates.items():
+            for column, value in columns.items():
+                setattr(authors[id], column, value)
+        # read before the commit expires the authors
+        names = {id: authors[id].name for id in updates}
+        db.session.commit()
+
+        if updates:
+            # book listings and details include the author name
+            response_cache.invalidate("authors", "books", *[f"author:{id}" for id in updates])
+            for id, name in names.items():
+                autocomplete_index.put(AUTHOR, id, name)
+        return jsonify({
+            "success": True,
+            "updated": len(updates),
+            "results": format_bulk_results(results)
+        }), 200
+
     @app.route("/authors/<id>", methods=["DELETE"])
     @requires_auth("delete:authors")
+    @admission.limit(WRITES)
     def delete_author(id):
         author = Author.get(id)
 
@@ -244,6 +544,8 @@ def create_app():
 
         # else delete author
         author.delete()
+        response_cache.invalidate("authors", f"author:{author.id}")
+        autocomplete_index.remove(AUTHOR, int(id))
         return jsonify({
             "success": True,
             "deleted": int(id)
@@ -251,6 +553,118 @@ def create_app():
 
     # endregion
 
+    # region SEARCH
+
+    @app.route("/search")
+    @response_cache.cached("books", "authors", args=(("q", str.strip), *PAGE_ARGS))
+    @admission.limit(CATALOG)
+    def search_catalog():
+        term = request.args.get("q", type=str)
+        if term is None:
+            abort(400)
+        term = term.strip()
+        if not term:
+            abort(422)
+
+        # the page and the counts come from the same query
+        page, per_page = get_page()
+        rows = fetch_rows(search(term).offset((page - 1) * per_page).limit(per_page))
+        if not rows and page > 1:
+            # past the last page, the counts still come from the first match
+            counts = fetch_rows(search(term).limit(1))
+        else:
+            counts = rows
+        return jsonify({
+            "success": True,
+            "results": [{"type": row["type"], "id": row["id"], "name": row["name"]} for row in rows],
+            "counts": {column: counts[0][column] if counts else 0 for column in SEARCH_TYPES.values()},
+            "total": counts[0]["total"] if counts else 0
+        })
+
+    # endregion
+
+    # region AUTOCOMPLETE
+
+    @app.route("/autocomplete")
+    @admission.limit(CATALOG)
+    def autocomplete():
+        prefix = request.args.get("q", type=str)
+        if prefix is None:
+            abort(400)
+        limit = request.args.get("limit", AUTOCOMPLETE_LIMIT, type=int)
+        if not prefix.strip() or not 0 < limit <= MAX_AUTOCOMPLETE_LIMIT:
+            abort(422)
+
+        # served from the in-memory index without queries
+        return jsonify({
+            "success": True,
+            "suggestions": [{"type": type, "id": id, "name": name}
+                            for type, id, name in autocomplete_index.search(prefix, limit)]
+        })
+
+    # endregion
+
+    # region CHANGES
+
+    @app.route("/changes")
+    @admission.limit(CATALOG)
+    def get_changes():
+        try:
+            since = Change.parse_token(request.args.get("since", "0.0", type=str))
+        except ValueError:
+            abort(422)
+        limit = request.args.get("limit", CHANGES_PER_PAGE, type=int)
+        limit = max(1, min(limit, MAX_CHANGES_PER_PAGE))
+
+        # fetch one extra change to know if there are more
+        changes = Change.feed(since, limit + 1)
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+        if changes:
+            since = (changes[-1].transaction_id, changes[-1].id)
+
+        return jsonify({
+            "success": True,
+            "changes": [change.format() for change in changes],
+            "next": Change.make_token(*since),
+            "has_more": has_more
+        })
+
+    # endregion
+
+    # region STATS
+
+    # the stats reveal the load and the internals of the workers, only the managers read them
+    @app.route("/cache/stats")
+    @requires_auth("read:stats")
+    def get_cache_stats():
+        return jsonify({
+            "success": True,
+            "cache": response_cache.stats(),
+            "book_summaries": book_summaries.stats(),
+            "shelf_summaries": shelf_summaries.stats(),
+            "autocomplete": autocomplete_index.stats()
+        })
+
+    @app.route("/pool/stats")
+    @requires_auth("read:stats")
+    def get_pool_stats():
+        return jsonify({
+            "success": True,
+            "pool": db.engine.pool.stats()
+        })
+
+    @app.route("/admission/stats")
+    @requires_auth("read:stats")
+    def get_admission_stats():
+        return jsonify({
+            "success": True,
+            "admission": admission.stats(),
+            "rate_limit": rate_limiter.stats()
+        })
+
+    # endregion
+
     # region USER ACCOUNT
 
     @app.route("/login")
@@ -271,6 +685,7 @@ def create_app():
             Shelf(user_id, "want to read").insert()
             Shelf(user_id, "currently reading").insert()
             Shelf(user_id, "read").insert()
+            shelf_summaries.invalidate(user_id)
 
         return jsonify({
             "success": True,
@@ -285,24 +700,36 @@ def create_app():
             "user_id": get_user_id()
         })
 
+    @app.route("/user/library/export")
+    @requires_auth()
+    @admission.limit(BULK)
+    def export_library():
+        export_format = request.args.get("format", "ndjson", type=str)
+        if export_format not in EXPORT_FORMATS:
+            abort(422)
+        # the connection of the request session, it's closed with the session after the response is sent
+        return stream_export(db.session.connection(), Stored_Book.select_library(get_user_id()).statement,
+                             export_format, "library")
+
     # endregion
 
     # region SHELVES
 
     @app.route("/shelves")
     @requires_auth()
+    @admission.limit(SHELVES)
     def get_shelves():
-        user_id = get_user_id()
-        shelves = Shelf.query.filter_by(user_id=user_id).all()
+        # served from the shelf cache without queries
+        shelves = Shelf.get_summaries(get_user_id())
 
-        return jsonify({
+        return jsonify(with_total({
             "success": True,
-            "shelves": paginate(shelves),
-            "total": len(shelves)
-        })
+            "shelves": paginate(shelves, lambda page: page)
+        }, shelves))
 
     @app.route("/shelves", methods=["POST"])
     @requires_auth()
+    @admission.limit(SHELVES)
     def create_shelf():
         try:
             name = request.json["name"].strip()
@@ -313,12 +740,13 @@ def create_app():
             abort(422)
 
         user_id = get_user_id()
-        if Shelf.query.filter_by(user_id=user_id).filter(Shelf.name.ilike(name)).first():
+        if Shelf.query.filter_by(user_id=user_id).filter(Shelf.name.ilike(escape_like(name), escape="\\")).first():
             # if the shelf already exists raise conflict error
             abort(409)
 
         shelf = Shelf(user_id, name)
         shelf.insert()
+        shelf_summaries.add_shelf(user_id, shelf.id, {"id": shelf.user_based_id, "name": name, "total_books": 0})
         return jsonify({
             "success": True,
             "created": shelf.user_based_id
@@ -326,6 +754,7 @@ def create_app():
 
     @app.route("/shelves/<id>")
     @requires_auth()
+    @admission.limit(SHELVES)
     def get_shelf_details(id):
         return jsonify({
             "success": True,
@@ -334,6 +763,7 @@ def create_app():
 
     @app.route("/shelves/<id>", methods=["PATCH"])
     @requires_auth()
+    @admission.limit(SHELVES)
     def edit_shelf(id):
         shelf = Shelf.get(get_user_id(), id)
         try:
@@ -346,6 +776,7 @@ def create_app():
         
         shelf.name = name
         shelf.update()
+        shelf_summaries.rename_shelf(shelf.user_id, shelf.id, name)
         return jsonify({
             "success": True
         }), 200
@@ -353,15 +784,18 @@ def create_app():
 
     @app.route("/shelves/<id>", methods=["DELETE"])
     @requires_auth()
+    @admission.limit(SHELVES)
     def delete_shelf(id):
         shelf = Shelf.get(get_user_id(), id)
 
         # delete stored books in the shelf
-        for book in Stored_Book.query.filter_by(shelf_id=shelf.id).all():
-            book.delete()
+        removed = Stored_Book.remove_many(shelf.user_id, shelf_id=shelf.id)
 
-        # then delete the shelf
+        # then delete the shelf in the same transaction
+        shelf_summaries.remove_shelf(shelf.user_id, shelf.id)
         shelf.delete()
+        if removed:
+            response_cache.invalidate("popularity")
         return jsonify({
             "success": True,
             "deleted": int(id)
@@ -371,25 +805,93 @@ def create_app():
     #       Storing Books
     # ---------------------------
 
+    def touch_shelves(changes: Counter):
+        """ Bumps the versions of the shelves whose books changed without committing, returns the non zero changes
+            changes : shelf id to the number of added books (negative for removed)
+        """
+        changes = {shelf_id: count for shelf_id, count in changes.items() if count}
+        if changes:
+            for shelf in Shelf.query.filter(Shelf.id.in_(changes)).all():
+                shelf.bump()
+        return changes
+
+    def commit_shelf_changes(user_id: str, changes: Counter):
+        """ Bumps the versions of the changed shelves and commits the stored books changes with them
+            changes : shelf id to the number of added books (negative for removed)
+        """
+        changes = touch_shelves(changes)
+        db.session.commit()
+        for shelf_id, count in changes.items():
+            shelf_summaries.add_books(user_id, shelf_id, count)
+        if sum(changes.values()):
+            # books were added or removed, not only moved
+            response_cache.invalidate("popularity")
+
+    def get_book_ids():
+        """ Returns the unique book ids of the body of the bulk stored books requests in request order """
+        try:
+            ids = request.json["book_ids"]
+        except:
+            abort(400)
+        if not isinstance(ids, list) or not 0 < len(ids) <= MAX_JOB_ITEMS:
+            abort(422)
+        try:
+            # remove duplicates keeping the request order
+            return list(dict.fromkeys(int(id) for id in ids))
+        except (TypeError, ValueError):
+            abort(422)
+
     @app.route("/shelves/<shelf_id>", methods=["POST"])
     @requires_auth()
+    @admission.limit(SHELVES)
     def add_book_to_shelf(shelf_id):
         try:
             book_id = int(request.json.get("book_id"))
         except AttributeError:
             abort(400)
-        except ValueError:
+        except (TypeError, ValueError):
             abort(422)
 
-        # try to get the book if it doesn't exist it will abort 404
-        Book.get(book_id)
         user_id = get_user_id()
         shelf = Shelf.get(user_id, shelf_id)
-        if Stored_Book.query.filter_by(user_id=user_id, book_id=book_id).first():
-            # if the book is already stored in any of the user's shelves raise conflict error
+        if not Stored_Book.add_many(user_id, shelf.id, [book_id]):
+            # if the book doesn't exist it will abort 404
+            Book.get(book_id)
+            # otherwise the book is already stored in one of the user's shelves, raise conflict error
             abort(409)
+        commit_shelf_changes(user_id, Counter({shelf.id: 1}))
+
+        return jsonify({
+            "success": True
+        }), 200
+
+    @app.route("/shelves/<shelf_id>/<book_id>", methods=["PATCH"])
+    @requires_auth()
+    @admission.limit(SHELVES)
+    def move_stored_book(shelf_id, book_id):
+        try:
+            target_id = int(request.json.get("shelf_id"))
+        except AttributeError:
+            abort(400)
+        except (TypeError, ValueError):
+            abort(422)
+        try:
+            book_id = int(book_id)
+        except ValueError:
+            abort(404)
 
-        Stored_Book(user_id, shelf.id, book_id).insert()
+        user_id = get_user_id()
+        shelf = Shelf.get(user_id, shelf_id)
+        target = Shelf.get(user_id, target_id)
+        if target.id == shelf.id:
+            # nothing to move, only check that the book is on the shelf
+            if not Stored_Book.query.filter_by(user_id=user_id, shelf_id=shelf.id, book_id=book_id).first():
+                abort(404)
+        elif not Stored_Book.move_many(user_id, [book_id], target.id, from_shelf_id=shelf.id):
+            # the book isn't on the shelf
+            abort(404)
+        else:
+            commit_shelf_changes(user_id, Counter({shelf.id: -1, target.id: 1}))
 
         return jsonify({
             "success": True
@@ -397,12 +899,112 @@ def create_app():
 
     @app.route("/shelves/<shelf_id>/<book_id>", methods=["DELETE"])
     @requires_auth()
+    @admission.limit(SHELVES)
     def remove_book_from_shelf(shelf_id, book_id):
-        Stored_Book.get(get_user_id(), book_id).delete()
+        try:
+            book_id = int(book_id)
+        except ValueError:
+            abort(404)
+
+        user_id = get_user_id()
+        removed = Stored_Book.remove_many(user_id, [book_id])
+        if not removed:
+            abort(404)
+        commit_shelf_changes(user_id, Counter({removed[0][1]: -1}))
         return jsonify({
             "success": True
         }), 200
 
+    # operation: the result key of the changed books
+    STORED_BOOKS_OPERATIONS = {"add": "added", "move": "moved", "remove": "removed"}
+
+    def change_stored_books(operation: str, user_id: str, shelf_id: int, book_ids: list):
+        """ Runs a bulk stored books operation without committing
+            Returns: (ids of the changed books, shelf id: number of added books)
+        """
+        if operation == "add":
+            added = Stored_Book.add_many(user_id, shelf_id, book_ids)
+            return added, Counter({shelf_id: len(added)})
+        if operation == "move":
+            moved = Stored_Book.move_many(user_id, book_ids, shelf_id)
+            changes = Counter({shelf_id: len(moved)})
+            changes.subtract(previous for _, previous in moved)
+            return [id for id, _ in moved], changes
+        removed = Stored_Book.remove_many(user_id, book_ids, shelf_id)
+        return [id for id, _ in removed], Counter({shelf_id: -len(removed)})
+
+    def bulk_stored_books(shelf_id, operation: str):
+        book_ids = get_book_ids()
+        user_id = get_user_id()
+        shelf = Shelf.get(user_id, shelf_id)
+
+        if len(book_ids) > MAX_BULK_BOOKS or request.args.get("background", "false", type=str).lower() == "true":
+            # too large for a request, run it in batches in the background
+            job = job_runner.submit("stored_books", book_ids, {"operation": operation, "shelf_id": shelf.id}, user_id)
+            return jsonify({
+                "success": True,
+                "job": job.id
+            }), 202, {"Location": f"/jobs/{job.id}"}
+
+        changed, changes = change_stored_books(operation, user_id, shelf.id, book_ids)
+        commit_shelf_changes(user_id, changes)
+        changed = set(changed)
+        return jsonify({
+            "success": True,
+            STORED_BOOKS_OPERATIONS[operation]: [id for id in book_ids if id in changed],
+            # added: books that don't exist or are already stored
+            # moved: books that aren't stored or are already on the shelf
+            # removed: books that aren't on the shelf
+            "skipped": [id for id in book_ids if id not in changed]
+        }), 200
+
+    def finish_stored_books(job):
+        # the batches only bumped the shelf versions
+        shelf_summaries.invalidate(job.user_id)
+        if job.params["operation"] != "move":
+            response_cache.invalidate("popularity")
+
+    @job_runner.handler("stored_books", finish=finish_stored_books)
+    def run_stored_books(job, book_ids):
+        operation = job.params["operation"]
+        changed, changes = change_stored_books(operation, job.user_id, job.params["shelf_id"], book_ids)
+        touch_shelves(changes)
+        return {STORED_BOOKS_OPERATIONS[operation]: len(changed), "skipped": len(book_ids) - len(changed)}
+
+    @app.route("/shelves/<shelf_id>/books", methods=["POST"])
+    @requires_auth()
+    @admission.limit(BULK)
+    def add_books_to_shelf(shelf_id):
+        return bulk_stored_books(shelf_id, "add")
+
+    @app.route("/shelves/<shelf_id>/books", methods=["PATCH"])
+    @requires_auth()
+    @admission.limit(BULK)
+    def move_books_to_shelf(shelf_id):
+        return bulk_stored_books(shelf_id, "move")
+
+    @app.route("/shelves/<shelf_id>/books", methods=["DELETE"])
+    @requires_auth()
+    @admission.limit(BULK)
+    def remove_books_from_shelf(shelf_id):
+        return bulk_stored_books(shelf_id, "remove")
+
+    # endregion
+
+    # region JOBS
+
+    @app.route("/jobs/<id>")
+    @requires_auth()
+    def get_job(id):
+        job = Job.get(id)
+        if job.user_id != get_user_id():
+            # the jobs of other users don't exist for the user
+            abort(404)
+        return jsonify({
+            "success": True,
+            "job": job.format()
+        })
+
     # endregion
 
     # region ERROR HANDLERS
@@ -463,6 +1065,14 @@ def create_app():
             "message": error.error["description"]
         }), error.status_code
 
+    @app.errorhandler(Overloaded)
+    def overloaded(error):
+        return jsonify({
+            "success": False,
+            "error": error.status_code,
+            "message": error.description
+        }), error.status_code, {"Retry-After": str(error.retry_after)}
+
     # endregion
 
     return app
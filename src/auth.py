@@ -3,6 +3,8 @@ from flask import request, url_for
 from jose import jwt
 import requests
 from constants import *
+from local_issuer import get_jwks, exchange_code
+from admission import rate_limiter
 
 user_id = None
 
@@ -35,6 +37,9 @@ def get_login_url():
     """
         Returns the auh0 login page url
     """
+    if AUTH_PROVIDER == "local":
+        return url_for("local_issuer.authorize")
+
     return f"""https://{AUTH0_DOMAIN}/authorize?"
             &response_type=code
             &client_id={CLIENT_ID}
@@ -44,6 +49,14 @@ def get_login_url():
 
 
 def get_token_from_code(code):
+    if AUTH_PROVIDER == "local":
+        token = exchange_code(code or "")
+        if not token:
+            raise AuthError({
+                "code": "invalid_grant",
+                "description": "Invalid authorization code"}, 403)
+        return token
+
     data = {"grant_type": "authorization_code",
             "client_id": CLIENT_ID,
             "client_secret": CLIENT_SECRET,
@@ -94,10 +107,20 @@ def get_token_auth_header():
     return auth[1]
 
 
-def verify_decode_jwt(token):
+def get_issuer_jwks():
+    """
+        Returns the public keys of the token issuer
+    """
+    if AUTH_PROVIDER == "local":
+        return get_jwks()
+
     jsonurl = requests.get(
         f"https://{AUTH0_DOMAIN}/.well-known/jwks.json", timeout=REQUEST_TIMEOUT)
-    jwks = jsonurl.json()
+    return jsonurl.json()
+
+
+def verify_decode_jwt(token):
+    jwks = get_issuer_jwks()
     try:
         unverified_header = jwt.get_unverified_header(token)
     except:
@@ -128,7 +151,7 @@ def verify_decode_jwt(token):
                 rsa_key,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer=LOCAL_ISSUER if AUTH_PROVIDER == "local" else 'https://' + AUTH0_DOMAIN + '/'
             )
 
             return payload
@@ -175,6 +198,7 @@ def requires_auth(permission=""):
             global user_id
             user_id = payload["sub"]
             user_id = user_id[user_id.index('|')+1:]
+            rate_limiter.check(user_id)
             return f(*args, **kwargs)
 
         return wrapper
@@ -0,0 +1,224 @@
+"""
+    Per-worker in-memory index of the book titles and author names for the prefix suggestions of GET /autocomplete.
+    The index is built at startup, the write handlers update it and the changes
+    handled by other workers are applied from the change log (see catalog_cache.CatalogSync).
+"""
+import os
+from array import array
+from threading import Lock
+from catalog_cache import catalog_sync
+from constants import AUTOCOMPLETE_LIMIT
+
+BOOK = "book"
+AUTHOR = "author"
+TYPES = (BOOK, AUTHOR)
+
+# a word key is the entry code followed by the offset of the word in the name key
+OFFSET_BITS = 16
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+
+
+def normalize(text: str):
+    """ Returns the lowercase words of the text separated by single spaces """
+    return " ".join(text.casefold().split())
+
+
+def _code(type: str, id: int):
+    """ Packs a book or author in an integer """
+    return id << 1 | TYPES.index(type)
+
+
+def _entry(code: int):
+    return TYPES[code & 1], code >> 1
+
+
+def _word_keys(code: int, key: str):
+    """ Returns the keys of the words of a name key after the first one """
+    return [code << OFFSET_BITS | i + 1 for i, char in enumerate(key) if char == " " and i < OFFSET_MASK]
+
+
+class SortedKeys():
+    """ Array of integer keys sorted by (text, key), key_text returns the text of a key """
+
+    def __init__(self, key_text):
+        self.key_text = key_text
+        self.keys = array("q")
+
+    def _sort_key(self, key: int):
+        return self.key_text(key), key
+
+    def bisect(self, sort_key: tuple):
+        """ Returns the position of the first key whose (text, key) isn't lower than sort_key """
+        low, high = 0, len(self.keys)
+        while low < high:
+            middle = (low + high) // 2
+            if self._sort_key(self.keys[middle]) < sort_key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def scan(self, prefix: str):
+        """ Yields the keys whose text starts with the prefix, in order """
+        for i in range(self.bisect((prefix,)), len(self.keys)):
+            key = self.keys[i]
+            if not self.key_text(key).startswith(prefix):
+                return
+            yield key
+
+    def build(self, keys):
+        self.keys = array("q", sorted(keys, key=self._sort_key))
+
+    def patch(self, removed: list, added: list):
+        """ Removes and inserts keys with a single copy of the array
+            removed : keys located with their current text, added : (sort key, key) with their new text
+        """
+        events = [(self.bisect(self._sort_key(key)), 1, 0, 0) for key in removed]
+        events.extend((self.bisect(sort_key), 0, i, key) for i, (sort_key, key) in enumerate(sorted(added)))
+        keys = array("q")
+        start = 0
+        for position, is_removed, _, key in sorted(events):
+            keys.extend(self.keys[start:position])
+            if is_removed:
+                start = position + 1
+            else:
+                keys.append(key)
+                start = position
+        keys.extend(self.keys[start:])
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class AutocompleteIndex():
+    """ A name is found by its beginning (the name keys) or by the beginning of any of its other words (the word keys),
+        the keys are sorted arrays of integers pointing into the entries, so a title costs its name and a few integers.
+        The changes are kept aside and patched into the arrays in batches
+    """
+
+    # patching copies the arrays, so the changes are patched every few changes
+    PATCH_EVERY = 256
+
+    def __init__(self):
+        # code: (name, name key) of the indexed entries
+        self._entries = {}
+        # code: (name, name key), None when removed, of the changes not patched yet
+        self._pending = {}
+        self._names = SortedKeys(lambda code: self._entries[code][1])
+        self._words = SortedKeys(lambda key: self._entries[key >> OFFSET_BITS][1][key & OFFSET_MASK:])
+        self._lock = Lock()
+        self._load = None
+
+    def build(self, load):
+        """ Rebuilds the index, load : function that takes (book ids, author ids)
+            and returns their (type, id, name), all the books and authors when both are None
+        """
+        self._load = load
+        rows = load(None, None)
+        with self._lock:
+            self._entries = {_code(type, id): (name, normalize(name)) for type, id, name in rows}
+            self._pending = {}
+            self._names.build(self._entries)
+            self._words.build(key for code, (name, name_key) in self._entries.items()
+                              for key in _word_keys(code, name_key))
+
+    def _patch(self):
+        removed = [code for code in self._pending if code in self._entries]
+        added = [(code, value) for code, value in self._pending.items() if value is not None]
+        self._names.patch(removed, [((name_key, code), code) for code, (name, name_key) in added])
+        self._words.patch([key for code in removed for key in _word_keys(code, self._entries[code][1])],
+                          [((name_key[key & OFFSET_MASK:], key), key) for code, (name, name_key) in added
+                           for key in _word_keys(code, name_key)])
+        for code, value in self._pending.items():
+            if value is None:
+                self._entries.pop(code, None)
+            else:
+                self._entries[code] = value
+        self._pending = {}
+
+    def _set(self, code: int, value):
+        self._pending[code] = value
+        if len(self._pending) >= self.PATCH_EVERY:
+            self._patch()
+
+    def put(self, type: str, id: int, name: str):
+        """ Adds or renames a book (type BOOK) or author (type AUTHOR) """
+        with self._lock:
+            self._set(_code(type, id), (name, normalize(name)))
+
+    def remove(self, type: str, id: int):
+        with self._lock:
+            self._set(_code(type, id), None)
+
+    def apply_changes(self, changes: list):
+        """ Reloads the names of the books and authors of the given change log entries """
+        if self._load is None:
+            return
+        books = {c.entity_id for c in changes if c.entity == BOOK}
+        authors = {c.entity_id for c in changes if c.entity == AUTHOR}
+        # the deleted books and authors are missing
+        names = {_code(type, id): name for type, id, name in self._load(books, authors)}
+        with self._lock:
+            for code in [_code(BOOK, id) for id in books] + [_code(AUTHOR, id) for id in authors]:
+                self._set(code, (names[code], normalize(names[code])) if code in names else None)
+
+    def _matches(self, keys: SortedKeys, prefix: str, limit: int, found: dict):
+        """ Returns up to limit (text, code) of the keys that start with the prefix, skipping the found codes """
+        matches = []
+        seen = set()
+        for key in keys.scan(prefix):
+            code = key >> OFFSET_BITS if keys is self._words else key
+            # the keys of the changed entries are stale, their changes are matched below
+            if code in self._pending or code in found or code in seen:
+                continue
+            seen.add(code)
+            matches.append((keys.key_text(key), code))
+            if len(matches) == limit:
+                break
+
+        for code, value in self._pending.items():
+            if value is None or code in found:
+                continue
+            name_key = value[1]
+            offsets = [key & OFFSET_MASK for key in _word_keys(code, name_key)] if keys is self._words else [0]
+            texts = [name_key[offset:] for offset in offsets if name_key[offset:].startswith(prefix)]
+            if texts:
+                matches.append((min(texts), code))
+        return sorted(matches)[:limit]
+
+    def search(self, prefix: str, limit: int = AUTOCOMPLETE_LIMIT):
+        """ Returns up to limit (type, id, name) whose name or one of its words starts with the prefix,
+            the names that start with the prefix come first, then alphabetically
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        found = {}
+        with self._lock:
+            for keys in (self._names, self._words):
+                for _, code in self._matches(keys, prefix, limit - len(found), found):
+                    found[code] = (self._pending.get(code) or self._entries[code])[0]
+                if len(found) >= limit:
+                    break
+        return [(*_entry(code), name) for code, name in found.items()]
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "keys": len(self._names) + len(self._words),
+            "pending": len(self._pending),
+            "worker": os.getpid()
+        }
+
+
+autocomplete_index = AutocompleteIndex()
+catalog_sync.subscribe(autocomplete_index.apply_changes)
+
+
+def setup_autocomplete(app, load):
+    """
+        binds a flask application and the autocomplete index
+        load : function that takes (book ids, author ids) and returns their (type, id, name), all of them when both are None
+    """
+    autocomplete_index.build(load)
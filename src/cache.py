@@ -0,0 +1,277 @@
+"""
+    Read-through response cache for the public catalog endpoints.
+    Every entry remembers the generation of the tags it depends on (e.g. "book:1"),
+    write handlers bump the generations with invalidate() so only the affected entries go stale,
+    the per worker backends also follow the change log for the writes of the other workers.
+"""
+import os
+import time
+import json
+import sqlite3
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock, local
+from flask import request, g, current_app
+from catalog_cache import catalog_sync
+from constants import CACHE_BACKEND, CACHE_MAX_ENTRIES, CACHE_TTL, CACHE_SQLITE_PATH
+
+
+class MemoryBackend():
+    """ In-process LRU store with a ttl per entry """
+    name = "memory"
+    shared = False
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_generations(self, tags):
+        return {tag: self._generations.get(tag, 0) for tag in tags}
+
+    def incr_generations(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend():
+    """ LRU store in a local sqlite file shared by all the workers of the host,
+        the values are (body, status, mimetype, generations) stored as a blob and json
+    """
+    name = "sqlite"
+    shared = True
+
+    # checking the size on every write is wasteful, evict every few writes instead
+    EVICT_EVERY = 64
+
+    def __init__(self, path=CACHE_SQLITE_PATH, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = local()
+        self._writes = 0
+        # the cached responses are served as they are, only the user of the app may write them
+        os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB, meta TEXT, expires REAL, used REAL)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS generations (tag TEXT PRIMARY KEY, generation INTEGER)")
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        now = time.time()
+        with self._connection() as connection:
+            row = connection.execute(
+                "SELECT body, meta FROM responses WHERE key = ? AND expires > ?", (key, now)).fetchone()
+            if not row:
+                return None
+            connection.execute(
+                "UPDATE responses SET used = ? WHERE key = ?", (now, key))
+            return (row[0], *json.loads(row[1]))
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._connection() as connection:
+            body, *meta = value
+            connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                               (key, body, json.dumps(meta), now + ttl, now))
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 0:
+                connection.execute("DELETE FROM responses WHERE expires < ?", (now,))
+                connection.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,))
+
+    def delete(self, key):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def get_generations(self, tags):
+        tags = list(tags)
+        rows = self._connection().execute(
+            f"SELECT tag, generation FROM generations WHERE tag IN ({', '.join('?' * len(tags))})", tags).fetchall()
+        generations = dict.fromkeys(tags, 0)
+        generations.update(rows)
+        return generations
+
+    def incr_generations(self, tags):
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT INTO generations VALUES (?, 1) ON CONFLICT (tag) DO UPDATE SET generation = generation + 1",
+                [(tag,) for tag in tags])
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+BACKENDS = {
+    "memory": MemoryBackend,
+    "sqlite": SQLiteBackend
+}
+
+
+def _parse(value: str, parse):
+    """ Returns the value parsed like the view does so equivalent requests share the same cache entry,
+        the value itself when there's no parse function or the view can't parse it either
+    """
+    if parse is None:
+        return value
+    try:
+        return parse(value)
+    except ValueError:
+        return value
+
+
+def _parse_id(value: str):
+    """ Parses a view argument like DatabaseObject.get so the tags are the ones the writes invalidate (e.g. "book:1" for /books/01) """
+    return _parse(value, int)
+
+
+class ResponseCache():
+    def __init__(self):
+        self.backend = None
+        self.ttl = CACHE_TTL
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app, backend=CACHE_BACKEND, ttl=CACHE_TTL):
+        """ Sets the cache backend, "none" disables the cache """
+        self.backend = BACKENDS[backend]() if backend in BACKENDS else None
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, args):
+        normalized = []
+        # the version the etag was built from, so a cached body always matches its etag
+        if "conditional_version" in g:
+            normalized.append(f"version={g.conditional_version}")
+        for arg in args:
+            arg, parse = arg if isinstance(arg, tuple) else (arg, None)
+            value = request.args.get(arg, type=str)
+            if value:
+                normalized.append(f"{arg}={_parse(value, parse)}")
+        return f"{request.path}?{'&'.join(normalized)}"
+
+    def cached(self, *tags, args=()):
+        """ Caches the response of a GET view
+            tags: the tags that invalidate the cached response, formatted with the view arguments (e.g. "book:{id}")
+                parsed as integers when they are
+            args: the query arguments that change the response, any other argument is ignored,
+                (name, parse) keys the argument with the value parsed like the view does (e.g. ("page", int))
+        """
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*f_args, **kwargs):
+                if self.backend is None:
+                    return f(*f_args, **kwargs)
+
+                key = self._key(args)
+                entry = self.backend.get(key)
+                if entry:
+                    body, status, mimetype, generations = entry
+                    if self.backend.get_generations(generations) == generations:
+                        self.hits += 1
+                        response = current_app.response_class(
+                            body, status=status, mimetype=mimetype)
+                        response.headers["X-Cache"] = "HIT"
+                        return response
+                self.misses += 1
+
+                # the generations are read before the view so a concurrent write makes the entry stale
+                g.cache_generations = self.backend.get_generations(
+                    [tag.format(**{name: _parse_id(value) for name, value in kwargs.items()}) for tag in tags])
+                response = current_app.make_response(f(*f_args, **kwargs))
+                if response.status_code == 200:
+                    self.backend.set(key, (response.get_data(), response.status_code,
+                                           response.mimetype, g.cache_generations), self.ttl)
+                response.headers["X-Cache"] = "MISS"
+                return response
+
+            return wrapper
+        return cached_decorator
+
+    def tag(self, *tags):
+        """ Adds tags to the response being cached, for dependencies that are only known inside the view """
+        if self.backend is not None and "cache_generations" in g:
+            g.cache_generations.update(self.backend.get_generations(tags))
+
+    def invalidate(self, *tags):
+        """ Makes every cached response that depends on any of the given tags stale """
+        if self.backend is not None:
+            self.backend.incr_generations(set(tags))
+
+    def apply_changes(self, changes: list):
+        """ Invalidates the responses of the changed books and authors, a shared backend is already invalidated by the writer """
+        if self.backend is None or self.backend.shared:
+            return
+        tags = set()
+        for change in changes:
+            if change.entity == "book":
+                tags.update(("books", f"book:{change.entity_id}"))
+            elif change.entity == "author":
+                # the writes of books touch their authors, so the author books follow the author changes
+                tags.update(("authors", "books", f"author:{change.entity_id}", f"author-books:{change.entity_id}"))
+        if tags:
+            self.backend.incr_generations(tags)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "backend": self.backend.name if self.backend is not None else "none",
+            "entries": len(self.backend) if self.backend is not None else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / requests if requests else 0,
+            "worker": os.getpid()
+        }
+
+
+response_cache = ResponseCache()
+catalog_sync.subscribe(response_cache.apply_changes)
+
+
+def setup_cache(app, backend=CACHE_BACKEND):
+    """
+        binds a flask application and the response cache
+    """
+    response_cache.init_app(app, backend)
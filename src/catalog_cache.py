@@ -0,0 +1,158 @@
+"""
+    Per-worker cache of the formatted book summaries shared by the book, shelf and author pages.
+    Every worker follows the change log (see models.Change) with CatalogSync and drops the entries
+    of the changed books and authors, so other workers' writes are seen within CATALOG_SYNC_INTERVAL.
+"""
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from constants import BOOK_CACHE_MAX_ENTRIES, CATALOG_SYNC_INTERVAL, CATALOG_SYNC_BATCH
+
+
+class BookSummaryCache():
+    """ LRU of book id to the book summary (id, title, genres and author) """
+
+    def __init__(self, max_entries=BOOK_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        # author id: ids of the cached books of the author, to drop them when the author changes
+        self._author_books = {}
+        self._lock = Lock()
+        # bumped by every invalidation, summaries loaded during an invalidation aren't stored
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _pop(self, id):
+        summary = self._entries.pop(id, None)
+        if summary:
+            books = self._author_books.get(summary["author"]["id"])
+            if books:
+                books.discard(id)
+
+    def get_many(self, ids: list, load):
+        """ Returns the summaries of the given books in the same order, missing books are left out
+            load : function that returns a dictionary of book id to summary of the given ids
+            the returned summaries are shared, they must not be modified
+        """
+        with self._lock:
+            generation = self._generation
+            found = {}
+            for id in ids:
+                summary = self._entries.get(id)
+                if summary:
+                    self._entries.move_to_end(id)
+                    found[id] = summary
+        missing = [id for id in ids if id not in found]
+        self.hits += len(found)
+        self.misses += len(missing)
+
+        if missing:
+            loaded = load(missing)
+            with self._lock:
+                for id, summary in (loaded.items() if generation == self._generation else ()):
+                    self._entries[id] = summary
+                    self._author_books.setdefault(summary["author"]["id"], set()).add(id)
+                while len(self._entries) > self.max_entries:
+                    self._pop(next(iter(self._entries)))
+            found.update(loaded)
+        return [found[id] for id in ids if id in found]
+
+    def invalidate(self, books=(), authors=()):
+        """ Drops the given books and the books of the given authors """
+        with self._lock:
+            self._generation += 1
+            for author_id in authors:
+                for id in list(self._author_books.pop(author_id, ())):
+                    self._entries.pop(id, None)
+            for id in books:
+                self._pop(id)
+
+    def apply_changes(self, changes: list):
+        """ Drops the entries affected by the given change log entries """
+        self.invalidate(books=[c.entity_id for c in changes if c.entity == "book"],
+                        authors=[c.entity_id for c in changes if c.entity == "author"])
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._author_books.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / requests if requests else 0,
+            "worker": os.getpid()
+        }
+
+
+class CatalogSync():
+    """ Follows the change log and passes the new changes to the subscribed listeners,
+        at most once every interval seconds and only from one thread at a time
+    """
+
+    def __init__(self):
+        self.listeners = []
+        self.head = None
+        self.feed = None
+        self.interval = CATALOG_SYNC_INTERVAL
+        self.position = None
+        self._last_poll = 0
+        self._lock = Lock()
+
+    def init_app(self, app, head, feed, interval=CATALOG_SYNC_INTERVAL):
+        """ head : function that returns the position of the last change
+            feed : function that returns the changes after a position, see Change.feed
+        """
+        self.head = head
+        self.feed = feed
+        self.interval = interval
+        self.position = None
+        app.before_request(self.poll)
+
+    def subscribe(self, listener):
+        """ listener : function that takes a list of changes """
+        self.listeners.append(listener)
+        return listener
+
+    def poll(self):
+        if self.feed is None or time.time() - self._last_poll < self.interval:
+            return
+        # another thread is already polling
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._last_poll = time.time()
+            if self.position is None:
+                # the caches start empty, only the changes from now on matter
+                self.position = self.head()
+                return
+
+            while True:
+                changes = self.feed(self.position, CATALOG_SYNC_BATCH)
+                if changes:
+                    self.position = (changes[-1].transaction_id, changes[-1].id)
+                    for listener in self.listeners:
+                        listener(changes)
+                if len(changes) < CATALOG_SYNC_BATCH:
+                    break
+        finally:
+            self._lock.release()
+
+
+book_summaries = BookSummaryCache()
+catalog_sync = CatalogSync()
+catalog_sync.subscribe(book_summaries.apply_changes)
+
+
+def setup_catalog_cache(app, head, feed):
+    """
+        binds a flask application and the catalog caches, head and feed read the change log
+    """
+    book_summaries.clear()
+    catalog_sync.init_app(app, head, feed)
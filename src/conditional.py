@@ -0,0 +1,62 @@
+"""
+    Conditional GET support (ETag / Last-Modified).
+    The validators come from a cheap version lookup, so a 304 never builds the response payload.
+"""
+from datetime import timezone
+from functools import wraps
+from hashlib import sha1
+from flask import request, current_app, g
+
+
+def _utc(date):
+    if date.tzinfo is None:
+        return date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def conditional(get_versions):
+    """ Answers 304 Not Modified without running the view when the client copy is still valid
+        get_versions: takes the view arguments and returns (version, last modified) or None,
+        None lets the view run (e.g. to raise not found)
+    """
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            versions = get_versions(**kwargs)
+            if versions is None:
+                return f(*args, **kwargs)
+
+            version, last_modified = versions
+            g.conditional_version = version
+            # the query string is part of the etag since it changes the payload (e.g. page)
+            etag = sha1(f"{request.path}?{request.query_string.decode()}|{version}".encode()).hexdigest()
+            last_modified = _utc(last_modified.replace(microsecond=0))
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            elif request.if_modified_since:
+                not_modified = last_modified <= _utc(request.if_modified_since)
+            else:
+                not_modified = False
+
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(f(*args, **kwargs))
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            return response
+
+        return wrapper
+    return conditional_decorator
+
+
+def versions_of(model):
+    """ Returns a get_versions function for views that take the model id as the id argument """
+    def get_versions(id):
+        try:
+            id = int(id)
+        except ValueError:
+            return None
+        return model.get_versions(id)
+    return get_versions
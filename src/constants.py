@@ -1,9 +1,100 @@
-from os import getenv
+from os import getenv, path
 from dotenv import load_dotenv
 
 load_dotenv()
 
 ITEMS_PER_PAGE = 10
+# the maximum value of the per_page query parameter
+MAX_ITEMS_PER_PAGE = int(getenv("MAX_ITEMS_PER_PAGE", 500))
+# the maximum number of books that can be fetched at once with /books?ids=
+MAX_LOOKUP_IDS = 500
+# the maximum number of books that are added, moved or removed by a /shelves/<id>/books request,
+# larger lists run as a background job
+MAX_BULK_BOOKS = 500
+# the maximum number of books or authors updated at once by PATCH /books and PATCH /authors
+MAX_BULK_UPDATES = 1000
+
+# Background jobs
+# the number of threads running the jobs of each worker
+JOB_WORKERS = int(getenv("JOB_WORKERS", 2))
+# the number of items committed at once
+JOB_BATCH = 500
+# seconds without progress after which a running job is resumed by another worker
+JOB_LEASE = int(getenv("JOB_LEASE", 300))
+# the minimum seconds between two checks for jobs to resume by each worker
+JOB_RESUME_INTERVAL = int(getenv("JOB_RESUME_INTERVAL", 60))
+# a job fails after this many failed batches
+JOB_MAX_ERRORS = 10
+# the maximum number of items of a job
+MAX_JOB_ITEMS = 100000
+
+# Library export
+# the number of rows read from the database cursor and sent at once
+EXPORT_BATCH = 1000
+
+# Autocomplete
+# the default and maximum number of suggestions of /autocomplete
+AUTOCOMPLETE_LIMIT = 10
+MAX_AUTOCOMPLETE_LIMIT = 50
+
+# Similar books
+# the number of neighbors stored for every book, the maximum limit of /books/<id>/similar
+SIMILAR_BOOKS = int(getenv("SIMILAR_BOOKS", 20))
+SIMILAR_BOOKS_PER_PAGE = 10
+# the weight of the genres in the similarity, the rest goes to the co-shelving (users that store both books)
+SIMILARITY_GENRE_WEIGHT = float(getenv("SIMILARITY_GENRE_WEIGHT", 0.5))
+# the number of scores computed at once by the builder (4 bytes each), bounds its memory use
+SIMILARITY_BLOCK_SCORES = 20000000
+
+# Admission control
+# route class: (concurrent requests, waiting requests) of each worker, see admission.py
+ADMISSION_LIMITS = {
+    "catalog": (int(getenv("CATALOG_CONCURRENCY", 16)), int(getenv("CATALOG_QUEUE", 32))),
+    "shelves": (int(getenv("SHELVES_CONCURRENCY", 8)), int(getenv("SHELVES_QUEUE", 16))),
+    "writes": (int(getenv("WRITES_CONCURRENCY", 4)), int(getenv("WRITES_QUEUE", 8))),
+    "bulk": (int(getenv("BULK_CONCURRENCY", 2)), int(getenv("BULK_QUEUE", 2)))
+}
+# seconds a queued request waits for its turn before it's rejected
+ADMISSION_TIMEOUT = float(getenv("ADMISSION_TIMEOUT", 5))
+# seconds, the Retry-After of the rejected requests
+ADMISSION_RETRY_AFTER = 1
+# requests per second of every authenticated user and the size of the bursts above it, 0 disables the limit
+RATE_LIMIT = float(getenv("RATE_LIMIT", 0))
+RATE_LIMIT_BURST = int(getenv("RATE_LIMIT_BURST", 50))
+# the maximum number of users whose buckets are kept by each worker
+RATE_LIMIT_MAX_USERS = 100000
+
+# the directory of the files of the app (e.g. the sqlite cache), created readable by its user only
+DATA_DIR = getenv("DATA_DIR", path.join(path.dirname(path.dirname(path.abspath(__file__))), "instance"))
+
+# Change feed
+CHANGES_PER_PAGE = 100
+MAX_CHANGES_PER_PAGE = 1000
+
+# Response cache
+# "memory" (per worker), "sqlite" (shared by the workers of the host) or "none"
+CACHE_BACKEND = getenv("CACHE_BACKEND", "memory")
+CACHE_MAX_ENTRIES = int(getenv("CACHE_MAX_ENTRIES", 10000))
+# seconds
+CACHE_TTL = int(getenv("CACHE_TTL", 300))
+CACHE_SQLITE_PATH = getenv("CACHE_SQLITE_PATH", path.join(DATA_DIR, "cache.sqlite"))
+
+# Book summary cache
+# the maximum number of book summaries cached by each worker
+BOOK_CACHE_MAX_ENTRIES = int(getenv("BOOK_CACHE_MAX_ENTRIES", 100000))
+# seconds between the change log checks, other workers' writes are seen after at most this delay
+CATALOG_SYNC_INTERVAL = float(getenv("CATALOG_SYNC_INTERVAL", 1))
+CATALOG_SYNC_BATCH = 1000
+
+# Shelf summary cache
+# the maximum number of users whose shelves are cached by each worker
+SHELF_CACHE_MAX_USERS = int(getenv("SHELF_CACHE_MAX_USERS", 10000))
+# seconds, bounds how long a worker can miss the shelf changes handled by the others
+SHELF_CACHE_TTL = int(getenv("SHELF_CACHE_TTL", 60))
+
+# Response encoder
+# "orjson" (used when installed) or "json" for the flask encoder
+JSON_BACKEND = getenv("JSON_BACKEND", "orjson")
 
 # Database
 DB_PATH = getenv("DATABASE_URL")
@@ -13,12 +104,38 @@ if not DB_PATH:
     DB_HOST = getenv("DB_HOST")
     DB_NAME = "bookshelf"
     DB_PATH = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
+# the connections kept open by each worker and the extra ones opened under load
+DB_POOL_SIZE = int(getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(getenv("DB_MAX_OVERFLOW", 10))
+# seconds a request waits for a connection before it fails
+DB_POOL_TIMEOUT = int(getenv("DB_POOL_TIMEOUT", 10))
+# seconds after which a connection is replaced
+DB_POOL_RECYCLE = int(getenv("DB_POOL_RECYCLE", 1800))
+# checks the connections before using them, replaces the ones dropped by a failover
+DB_POOL_PRE_PING = getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# the number of connections opened when a worker starts
+DB_POOL_WARMUP = int(getenv("DB_POOL_WARMUP", DB_POOL_SIZE))
+# seconds
+DB_CONNECT_TIMEOUT = int(getenv("DB_CONNECT_TIMEOUT", 5))
+# milliseconds, the statement timeout of the authenticated requests and of the public reads
+DB_STATEMENT_TIMEOUT = int(getenv("DB_STATEMENT_TIMEOUT", 30000))
+DB_READ_STATEMENT_TIMEOUT = int(getenv("DB_READ_STATEMENT_TIMEOUT", 5000))
 
 # Auth
 CLIENT_ID = getenv("BOOKSHELF_API_CLINET_ID")
 CLIENT_SECRET = getenv("BOOKSHELF_API_CLINET_SECRET")
 AUTH0_DOMAIN = getenv("BOOKSHELF_API_DOMAIN")
+# "auth0" or "local" to mint and verify tokens in-process with the local stand-in issuer
+AUTH_PROVIDER = getenv("BOOKSHELF_API_AUTH_PROVIDER", "auth0")
 ALGORITHMS = ['RS256']
 API_AUDIENCE = "bookshelf_api"
 CALLBACK_ENDPOINT = "callback"
 REQUEST_TIMEOUT = 1
+
+# Local issuer
+LOCAL_ISSUER = "https://bookshelf-local-issuer/"
+LOCAL_ISSUER_KEY_PATH = getenv("LOCAL_ISSUER_KEY_PATH", path.join(DATA_DIR, "local_issuer.pem"))
+LOCAL_ISSUER_PERMISSIONS = getenv(
+    "LOCAL_ISSUER_PERMISSIONS",
+    "post:books patch:books delete:books post:authors patch:authors delete:authors read:stats").split()
+LOCAL_ISSUER_TOKEN_LIFETIME = int(getenv("LOCAL_ISSUER_TOKEN_LIFETIME", 86400))
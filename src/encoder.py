@@ -0,0 +1,151 @@
+"""
+    Pluggable JSON encoder for the API responses.
+    jsonify() produces the same bytes as flask.jsonify, with orjson when it's installed
+    and the standard library encoder otherwise.
+"""
+import math
+import re
+from flask import current_app, json as flask_json, jsonify as flask_jsonify
+from constants import JSON_BACKEND
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson writes non-ascii characters as utf-8, flask escapes them
+NON_ASCII = re.compile(r"[^\x00-\x7f]")
+# orjson writes some floats differently: the small and large ones (e.g. 0.00001 and 1e16 instead of 1e-05 and 1e+16,
+# depending on its version) and the non-finite ones (null instead of NaN and Infinity), the encoder falls back to flask
+# when the output may have one. Only the numbers count: the strings are dropped and the digits and the bytes that
+# precede a number are folded (1 and :) so a few substring searches find the markers
+STRING = re.compile(rb'"(?:[^"\\]|\\.)*"')
+FOLD_NUMBERS = bytes.maketrans(b"23456789,[", b"11111111::")
+FLOAT_MARKERS = (b"0e", b"1e", b":0.0000", b":-0.0000")
+FLOAT_SMALL = (b"0.0000", b"-0.0000")
+
+
+def _outside_strings(body: bytes):
+    """ Returns the json output without its strings """
+    if b'\\"' in body:
+        # an escaped quote doesn't end its string
+        return STRING.sub(b"", body)
+    return b"".join(body.split(b'"')[::2])
+
+
+def _has_non_finite_floats(data):
+    values = [data]
+    while values:
+        value = values.pop()
+        if isinstance(value, dict):
+            values.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            values.extend(value)
+        elif isinstance(value, float) and not math.isfinite(value):
+            return True
+    return False
+
+
+def _has_float_markers(folded: bytes):
+    return any(marker in folded for marker in FLOAT_MARKERS) or folded.startswith(FLOAT_SMALL)
+
+
+def _has_odd_floats(data, body: bytes):
+    """ Returns whether the orjson output of the data may have a float that flask writes differently """
+    # the strings can only add markers, most outputs have none and don't need the strings dropped
+    folded = body.translate(FOLD_NUMBERS)
+    if not _has_float_markers(folded) and b"null" not in folded:
+        return False
+    numbers = _outside_strings(body).translate(FOLD_NUMBERS)
+    if _has_float_markers(numbers):
+        return True
+    # the values are only walked when one of the nulls may be a non-finite float
+    return b"null" in numbers and _has_non_finite_floats(data)
+
+
+def _escape(match):
+    code = ord(match.group())
+    if code > 0xFFFF:
+        # characters outside the basic multilingual plane are escaped as a surrogate pair
+        code -= 0x10000
+        return "\\u{:04x}\\u{:04x}".format(0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF))
+    return "\\u{:04x}".format(code)
+
+
+class OrjsonBackend():
+    name = "orjson"
+
+    options = (orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_SUBCLASS
+               if orjson else 0)
+
+    def dumps(self, data):
+        """ Returns the json bytes of the data or None if they may differ from flask's """
+        # dates and other types that orjson doesn't share with flask go through the flask encoder
+        body = orjson.dumps(data, default=current_app.json_encoder().default, option=self.options)
+        if _has_odd_floats(data, body):
+            return None
+        if not body.isascii():
+            body = NON_ASCII.sub(_escape, body.decode()).encode()
+        return body + b"\n"
+
+
+BACKENDS = {}
+if orjson:
+    BACKENDS["orjson"] = OrjsonBackend
+
+
+class ResponseEncoder():
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app, backend=JSON_BACKEND):
+        """ Sets the encoder backend, "json" or a backend that isn't installed uses flask's encoder """
+        self.backend = BACKENDS[backend]() if backend in BACKENDS else None
+
+    def _backend_dumps(self, data):
+        """ Returns the backend json bytes of the data or None when flask's encoder must be used """
+        # the non default json options keep the flask behavior
+        config = current_app.config
+        if self.backend is None or not config["JSON_SORT_KEYS"] or not config["JSON_AS_ASCII"]:
+            return None
+        try:
+            return self.backend.dumps(data)
+        except TypeError:
+            # e.g. integers larger than 64 bits or keys that aren't strings
+            return None
+
+    def jsonify(self, *args, **kwargs):
+        # pretty printing keeps the flask behavior
+        if current_app.config["JSONIFY_PRETTYPRINT_REGULAR"] or current_app.debug:
+            return flask_jsonify(*args, **kwargs)
+        body = self._backend_dumps(args[0] if len(args) == 1 else (args or kwargs))
+        if body is None:
+            return flask_jsonify(*args, **kwargs)
+        return current_app.response_class(body, mimetype=current_app.config["JSONIFY_MIMETYPE"])
+
+    def dumps(self, data):
+        """ Returns the compact json bytes of the data followed by a newline, e.g. for json lines """
+        body = self._backend_dumps(data)
+        if body is None:
+            return (flask_json.dumps(data, separators=(",", ":")) + "\n").encode()
+        return body
+
+
+response_encoder = ResponseEncoder()
+
+
+def jsonify(*args, **kwargs):
+    """ Drop-in replacement of flask.jsonify that uses the configured encoder backend """
+    return response_encoder.jsonify(*args, **kwargs)
+
+
+def dumps(data):
+    """ Returns the json bytes of a single line with the configured encoder backend """
+    return response_encoder.dumps(data)
+
+
+def setup_json(app, backend=JSON_BACKEND):
+    """
+        binds a flask application and the response encoder
+    """
+    response_encoder.init_app(app, backend)
@@ -0,0 +1,69 @@
+"""
+    Streams the exports of the user libraries (shelves and stored books) as json lines or csv.
+    The rows are read from a server-side cursor in batches so the memory use doesn't depend on the library size.
+"""
+import csv
+import io
+from flask import current_app, stream_with_context
+from encoder import dumps
+from constants import EXPORT_BATCH
+
+CSV_COLUMNS = ["shelf_id", "shelf_name", "book_id", "title", "author_id", "author_name", "genres"]
+
+
+def format_ndjson(rows):
+    lines = []
+    for row in rows:
+        book = None
+        if row["book_id"] is not None:
+            book = {
+                "id": row["book_id"],
+                "title": row["title"],
+                "genres": row["genres"] or [],
+                "author": {"id": row["author_id"], "name": row["author_name"]}
+            }
+        lines.append(dumps({"shelf": {"id": row["shelf_id"], "name": row["shelf_name"]}, "book": book}))
+    return b"".join(lines)
+
+
+def format_csv(rows, header=False):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(CSV_COLUMNS)
+    for row in rows:
+        writer.writerow([row["shelf_id"], row["shelf_name"], row["book_id"], row["title"],
+                         row["author_id"], row["author_name"], ", ".join(row["genres"] or [])])
+    return buffer.getvalue().encode()
+
+
+# format: (formatter, mimetype)
+FORMATS = {
+    "ndjson": (format_ndjson, "application/x-ndjson"),
+    "csv": (format_csv, "text/csv")
+}
+
+
+def stream_export(connection, statement, export_format: str, filename: str):
+    """ Returns a streamed response of the rows of the statement in the given format (see FORMATS)
+        connection : the connection to run the statement on, it must stay open until the response is sent
+    """
+    formatter, mimetype = FORMATS[export_format]
+
+    def generate():
+        # stream_results uses a server-side cursor instead of loading all the rows
+        result = connection.execution_options(stream_results=True).execute(statement)
+        try:
+            if export_format == "csv":
+                yield format_csv([], header=True)
+            while True:
+                rows = result.fetchmany(EXPORT_BATCH)
+                if not rows:
+                    break
+                yield formatter(rows)
+        finally:
+            result.close()
+
+    return current_app.response_class(stream_with_context(generate()), mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename={filename}.{export_format}"
+    })
@@ -0,0 +1,141 @@
+"""
+    In-process background jobs for the bulk operations that are too large for a request.
+    The jobs are stored in the jobs table (see models.Job) and run a batch of items at a time on a bounded thread pool,
+    every batch is committed with the job progress so a job resumes after its last batch when a worker restarts.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from models import db, Job
+from constants import JOB_WORKERS, JOB_BATCH, JOB_LEASE, JOB_MAX_ERRORS, JOB_RESUME_INTERVAL
+
+
+class JobRunner():
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        # job type: (run_batch, finish)
+        self.handlers = {}
+        self.app = None
+        self.interval = JOB_RESUME_INTERVAL
+        self._executor = None
+        self._lock = Lock()
+        # the ids of the jobs waiting for or running on the thread pool
+        self._scheduled = set()
+        self._last_check = 0
+        self._check_lock = Lock()
+
+    def init_app(self, app, interval=JOB_RESUME_INTERVAL):
+        """ The jobs are resumed by the requests of the serving workers,
+            the other users of the app (e.g. manage_migrations.py) never run them
+        """
+        self.app = app
+        self.interval = interval
+        self._last_check = 0
+        app.before_request(self.check)
+
+    def handler(self, type: str, finish=None):
+        """ Registers the function that runs a batch of items of the jobs of the given type
+            run_batch(job, items) : does the batch work without committing and returns the counts to add to the job
+            finish(job) : called once every batch is committed, before the job is done, e.g. to drop caches
+        """
+        def handler_decorator(run_batch):
+            self.handlers[type] = (run_batch, finish)
+            return run_batch
+        return handler_decorator
+
+    def submit(self, type: str, items: list, params: dict, user_id: str = None):
+        """ Stores a new job and schedules it, returns the job """
+        job = Job(type, user_id, items, params)
+        job.insert()
+        self._schedule(job.id)
+        return job
+
+    def resume(self):
+        """ Schedules the queued jobs and the jobs of the workers that stopped """
+        for id in Job.resumable_ids(JOB_LEASE):
+            self._schedule(id)
+
+    def check(self):
+        """ Resumes the jobs at most once every interval seconds and only from one thread at a time """
+        if self.app is None or time.time() - self._last_check < self.interval:
+            return
+        # another thread is already checking
+        if not self._check_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_check = time.time()
+            self.resume()
+        finally:
+            self._check_lock.release()
+
+    def _schedule(self, id: int):
+        with self._lock:
+            if id in self._scheduled:
+                return
+            self._scheduled.add(id)
+            if self._executor is None:
+                # created on first use so the forked workers don't share the pool of their parent
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="job")
+        self._executor.submit(self._run, self.app, id)
+
+    def _run(self, app, id: int):
+        with app.app_context():
+            try:
+                self._run_job(id)
+            except Exception as error:
+                # e.g. a lost connection or a failing finish, the job would stay running until its lease is over
+                app.logger.exception(f"job {id} failed")
+                self._fail(id, str(error))
+            finally:
+                with self._lock:
+                    self._scheduled.discard(id)
+
+    def _fail(self, id: int, message: str):
+        try:
+            db.session.rollback()
+            job = Job.query.get(id)
+            if job and job.status == Job.RUNNING:
+                job.errors = job.errors + [{"position": job.position, "message": message}]
+                job.finish(Job.FAILED)
+        except Exception:
+            # the job is resumed once its lease is over
+            self.app.logger.exception(f"job {id} couldn't be marked as failed")
+
+    def _run_job(self, id: int):
+        # another worker may have resumed the job first
+        job = Job.claim(id, JOB_LEASE)
+        if not job:
+            return
+        if job.type not in self.handlers:
+            job.errors = [{"position": job.position, "message": f"unknown job type {job.type}"}]
+            job.finish(Job.FAILED)
+            return
+
+        run_batch, finish = self.handlers[job.type]
+        while job.position < job.total:
+            items = job.items[job.position: job.position + JOB_BATCH]
+            try:
+                counts = run_batch(job, items)
+            except Exception as error:
+                # the failed batch is skipped, its work is rolled back
+                db.session.rollback()
+                job.advance(len(items), {"failed": len(items)}, str(error))
+                if len(job.errors) >= JOB_MAX_ERRORS:
+                    job.finish(Job.FAILED)
+                    return
+            else:
+                job.advance(len(items), counts)
+        # a failing finish fails the job
+        if finish:
+            finish(job)
+        job.finish()
+
+
+job_runner = JobRunner()
+
+
+def setup_jobs(app):
+    """
+        binds a flask application and the job runner, the requests resume the unfinished jobs
+    """
+    job_runner.init_app(app)
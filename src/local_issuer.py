@@ -0,0 +1,163 @@
+"""
+    Local stand-in for the Auth0 issuer used for offline testing and benchmarks.
+    Enable it with BOOKSHELF_API_AUTH_PROVIDER=local, then tokens are minted and
+    verified in-process and the app serves the jwks, token and authorize endpoints itself.
+"""
+import os
+import time
+import hashlib
+from base64 import urlsafe_b64encode
+from flask import Blueprint, request, jsonify, redirect, url_for
+from jose import jwt
+from Crypto.PublicKey import RSA
+from constants import (ALGORITHMS, API_AUDIENCE, CALLBACK_ENDPOINT, LOCAL_ISSUER,
+                       LOCAL_ISSUER_KEY_PATH, LOCAL_ISSUER_PERMISSIONS, LOCAL_ISSUER_TOKEN_LIFETIME)
+
+# authorization codes are short lived tokens signed with the same key
+CODE_LIFETIME = 60
+
+_key = None
+_jwks = None
+
+
+def _b64(number: int):
+    data = number.to_bytes((number.bit_length() + 7) // 8, "big")
+    return urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def get_key():
+    """ Returns the issuer RSA key, loading it from LOCAL_ISSUER_KEY_PATH or generating it
+        the key is stored on disk so every worker (and the test process) shares it
+    """
+    global _key
+    if _key:
+        return _key
+
+    os.makedirs(os.path.dirname(LOCAL_ISSUER_KEY_PATH) or ".", mode=0o700, exist_ok=True)
+    try:
+        # create the file exclusively so concurrent workers don't overwrite each other's key
+        fd = os.open(LOCAL_ISSUER_KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # anyone who can replace the key can sign tokens with any permissions
+        status = os.stat(LOCAL_ISSUER_KEY_PATH)
+        if status.st_uid != os.getuid() or status.st_mode & 0o022:
+            raise PermissionError(f"{LOCAL_ISSUER_KEY_PATH} must be owned by the app user and writable by it only")
+        # wait for the worker that created the file to finish writing it
+        for _ in range(50):
+            with open(LOCAL_ISSUER_KEY_PATH) as f:
+                pem = f.read()
+            if pem.strip().endswith("-----"):
+                break
+            time.sleep(0.1)
+        _key = RSA.import_key(pem)
+    else:
+        _key = RSA.generate(2048)
+        with os.fdopen(fd, "wb") as f:
+            f.write(_key.export_key())
+    return _key
+
+
+def get_kid():
+    key = get_key()
+    return hashlib.sha256(_b64(key.n).encode()).hexdigest()[:16]
+
+
+def get_jwks():
+    """ Returns the public key set in the same format as auth0 /.well-known/jwks.json """
+    global _jwks
+    if not _jwks:
+        key = get_key()
+        _jwks = {"keys": [{
+            "alg": ALGORITHMS[0],
+            "kty": "RSA",
+            "use": "sig",
+            "kid": get_kid(),
+            "n": _b64(key.n),
+            "e": _b64(key.e)
+        }]}
+    return _jwks
+
+
+def _sign(claims: dict):
+    return jwt.encode(claims, get_key().export_key().decode(),
+                      algorithm=ALGORITHMS[0], headers={"kid": get_kid()})
+
+
+def mint_token(sub: str, permissions=None, lifetime: int = LOCAL_ISSUER_TOKEN_LIFETIME):
+    """ Returns a signed access token
+        sub: the token subject in auth0 format (provider|id)
+        permissions: list of permissions, defaults to LOCAL_ISSUER_PERMISSIONS
+    """
+    now = int(time.time())
+    return _sign({
+        "iss": LOCAL_ISSUER,
+        "sub": sub,
+        "aud": API_AUDIENCE,
+        "iat": now,
+        "exp": now + lifetime,
+        "permissions": LOCAL_ISSUER_PERMISSIONS if permissions is None else list(permissions)
+    })
+
+
+def mint_code(sub: str, permissions=None):
+    """ Returns an authorization code that can be exchanged for an access token """
+    now = int(time.time())
+    return _sign({
+        "iss": LOCAL_ISSUER,
+        "sub": sub,
+        "aud": LOCAL_ISSUER + "code",
+        "exp": now + CODE_LIFETIME,
+        "permissions": LOCAL_ISSUER_PERMISSIONS if permissions is None else list(permissions)
+    })
+
+
+def exchange_code(code: str):
+    """ Returns an access token for the given authorization code or None if the code is invalid """
+    try:
+        claims = jwt.decode(code, get_jwks()["keys"][0], algorithms=ALGORITHMS,
+                            audience=LOCAL_ISSUER + "code", issuer=LOCAL_ISSUER)
+    except Exception:
+        return None
+    return mint_token(claims["sub"], claims["permissions"])
+
+
+def _permissions_arg(value):
+    return value.split() if value is not None else None
+
+
+local_issuer = Blueprint("local_issuer", __name__)
+
+
+@local_issuer.route("/.well-known/jwks.json")
+def jwks():
+    return jsonify(get_jwks())
+
+
+@local_issuer.route("/authorize")
+def authorize():
+    # there is no login page, the user and permissions can be set with the query parameters
+    sub = "local|" + request.args.get("user", "local-user")
+    code = mint_code(sub, _permissions_arg(request.args.get("permissions")))
+    return redirect(url_for(CALLBACK_ENDPOINT, code=code))
+
+
+@local_issuer.route("/oauth/token", methods=["POST"])
+def token():
+    data = request.form if request.form else (request.get_json(silent=True) or {})
+    grant_type = data.get("grant_type")
+    if grant_type == "authorization_code":
+        access_token = exchange_code(data.get("code", ""))
+        if not access_token:
+            return jsonify({"error": "invalid_grant"}), 403
+    elif grant_type == "client_credentials":
+        # lets load testing tools mint tokens for any user with any permissions
+        sub = "local|" + data.get("user", "local-user")
+        access_token = mint_token(sub, _permissions_arg(data.get("permissions")))
+    else:
+        return jsonify({"error": "unsupported_grant_type"}), 400
+
+    return jsonify({
+        "access_token": access_token,
+        "token_type": "Bearer",
+        "expires_in": LOCAL_ISSUER_TOKEN_LIFETIME
+    })
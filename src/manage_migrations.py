@@ -2,7 +2,9 @@ from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, AuthorGenre, Book, Change, REFRESH_POPULARITY
+from constants import CATALOG_SYNC_BATCH
+from seed import seed_database, dump_seed
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +12,150 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@MigrateCommand.option("--books", dest="books", type=int, default=100000, help="number of books to generate")
+@MigrateCommand.option("--authors", dest="authors", type=int, default=None, help="number of authors (default: books / 10)")
+@MigrateCommand.option("--users", dest="users", type=int, default=1000, help="number of users to generate")
+@MigrateCommand.option("--shelf-books", dest="shelf_books", type=int, default=50, help="average number of stored books per user")
+@MigrateCommand.option("--seed", dest="seed", type=int, default=0, help="random seed, the same seed always generates the same data")
+@MigrateCommand.option("--output", dest="output", default=None, help="stream a psql script to this file ('-' for stdout) instead of loading the data")
+def seed(books, authors, users, shelf_books, seed, output):
+    """ Generates a deterministic synthetic catalog for benchmarking """
+    authors = authors if authors is not None else max(1, books // 10)
+    if output is None:
+        seed_database(books, authors, users, shelf_books, seed)
+    elif output == "-":
+        dump_seed(books, authors, users, shelf_books, seed)
+    else:
+        with open(output, "w") as out:
+            dump_seed(books, authors, users, shelf_books, seed, out)
+
+
+# moves the genre names of book_genres to the genres table, the names were already stored with capwords
+# so lowering them gives the same key as Genre.make_key, genres that only differ in case
+# are merged under their most common spelling
+NORMALIZE_GENRES = """
+CREATE TABLE IF NOT EXISTS genres (
+    id SERIAL PRIMARY KEY,
+    key VARCHAR NOT NULL UNIQUE,
+    name VARCHAR NOT NULL
+);
+INSERT INTO genres (key, name)
+    SELECT DISTINCT ON (lower(genre)) lower(genre), genre
+    FROM book_genres GROUP BY genre ORDER BY lower(genre), count(*) DESC, genre
+    ON CONFLICT (key) DO NOTHING;
+ALTER TABLE book_genres ADD COLUMN genre_id INTEGER REFERENCES genres (id);
+UPDATE book_genres SET genre_id = genres.id FROM genres WHERE genres.key = lower(book_genres.genre);
+DELETE FROM book_genres a USING book_genres b
+    WHERE a.book_id = b.book_id AND a.genre_id = b.genre_id AND a.genre > b.genre;
+ALTER TABLE book_genres DROP CONSTRAINT book_genres_pkey;
+ALTER TABLE book_genres DROP COLUMN genre;
+ALTER TABLE book_genres ALTER COLUMN genre_id SET NOT NULL;
+ALTER TABLE book_genres ADD PRIMARY KEY (book_id, genre_id);
+CREATE INDEX ix_book_genres_genre_id ON book_genres (genre_id, book_id);
+"""
+
+
+# the row versions of the conditional requests for databases created before them
+ADD_VERSIONS = """
+ALTER TABLE books ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE books ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc');
+ALTER TABLE authors ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE authors ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc');
+ALTER TABLE shelves ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE shelves ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc');
+CREATE INDEX IF NOT EXISTS ix_books_versions ON books (id, version, updated_at);
+CREATE INDEX IF NOT EXISTS ix_authors_versions ON authors (id, version, updated_at);
+"""
+
+
+@MigrateCommand.command
+def add_versions():
+    """ Adds the version columns of the books, authors and shelves if needed """
+    db.session.execute(ADD_VERSIONS)
+    db.session.commit()
+
+
+@MigrateCommand.command
+def normalize_genres():
+    """ Backfills the genres table from the genre names of book_genres """
+    db.session.execute(NORMALIZE_GENRES)
+    db.session.commit()
+
+
+# the author statistics column and the index of the books of an author for databases created before them,
+# author_genres is created with the tables
+ADD_AUTHOR_STATS = """
+ALTER TABLE authors ADD COLUMN IF NOT EXISTS total_books INTEGER NOT NULL DEFAULT 0;
+CREATE INDEX IF NOT EXISTS ix_books_author_id ON books (author_id, id);
+"""
+
+
+@MigrateCommand.command
+def refresh_author_stats():
+    """ Adds the author statistics column if needed and recomputes the statistics (total books and books per genre) """
+    db.session.execute(ADD_AUTHOR_STATS)
+    AuthorGenre.refresh()
+
+
+@MigrateCommand.option("--since", dest="since", default=None,
+                       help="only rebuild the books changed after this change token (printed by the previous build)")
+def build_similarity(since):
+    """ Builds the similar books index from the genres and the stored books """
+    # imported here so numpy and scipy are only needed to build the index
+    from similarity import build_similarity
+
+    # the changes made during the build are rebuilt by the next one
+    head = Change.head()
+    books = None
+    if since:
+        position, books = Change.parse_token(since), set()
+        # the co-shelving changes aren't in the change log, every transaction up to the one of the token
+        # had ended when the token was printed so the previous build saw their stored books
+        books.update(id for id, in db.session.query(Book.id).filter(Book.shelved_transaction_id > position[0]))
+        while True:
+            changes = Change.feed(position, CATALOG_SYNC_BATCH)
+            books.update(change.entity_id for change in changes if change.entity == "book")
+            if len(changes) < CATALOG_SYNC_BATCH:
+                break
+            position = (changes[-1].transaction_id, changes[-1].id)
+    build_similarity(books)
+    print(f"next build: --since {Change.make_token(*head)}")
+
+
+# the popularity columns and the sort indexes of GET /books for databases created before them
+ADD_POPULARITY = """
+ALTER TABLE books ADD COLUMN IF NOT EXISTS popularity INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE books ADD COLUMN IF NOT EXISTS shelved_transaction_id BIGINT;
+CREATE INDEX IF NOT EXISTS ix_books_title ON books (title, id);
+CREATE INDEX IF NOT EXISTS ix_books_year ON books (year, id);
+CREATE INDEX IF NOT EXISTS ix_books_popularity ON books (popularity, id);
+"""
+
+
+@MigrateCommand.command
+def refresh_popularity():
+    """ Adds the popularity column if needed and recounts the users that store every book """
+    db.session.execute(ADD_POPULARITY)
+    db.session.execute(REFRESH_POPULARITY)
+    db.session.commit()
+
+
+# trigram indexes let the "contains" searches (ilike '%term%') of /search, /books and /authors use an index scan
+# instead of reading the whole tables, pg_trgm ships with the postgres contrib modules
+SEARCH_INDEXES = """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS ix_books_title_trgm ON books USING gin (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_authors_name_trgm ON authors USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_genres_name_trgm ON genres USING gin (name gin_trgm_ops);
+"""
+
+
+@MigrateCommand.command
+def search_indexes():
+    """ Creates the trigram indexes of the searched titles and names (requires the pg_trgm extension) """
+    db.session.execute(SEARCH_INDEXES)
+    db.session.commit()
+
+
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
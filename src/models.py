@@ -1,8 +1,19 @@
+import datetime
+import json
+from collections import Counter
+from functools import lru_cache
+from operator import itemgetter
 from flask import abort, request
-from sqlalchemy import Column, String, Integer, Date, ForeignKey, Sequence
+from sqlalchemy import Column, String, Integer, SmallInteger, BigInteger, Float, Date, DateTime, JSON, ForeignKey, Sequence, Index, text, event, func, tuple_
+from sqlalchemy import inspect
+from sqlalchemy.dialects.postgresql import insert, aggregate_order_by
+from sqlalchemy.orm import Query, relationship, column_property
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy_utils import database_exists, create_database
-from constants import ITEMS_PER_PAGE, DB_PATH
+from constants import ITEMS_PER_PAGE, MAX_ITEMS_PER_PAGE, DB_PATH, DB_POOL_WARMUP
+from pool import engine_options, warm_up
+from catalog_cache import book_summaries
+from shelf_cache import shelf_summaries
 
 # using string.capwords because str.title() misbehaves with apostrophes
 from string import capwords
@@ -19,20 +30,126 @@ def setup_db(app, database_path=DB_PATH):
 
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
     db.app = app
     db.init_app(app)
     db.create_all()
+    warm_up(db.engine, DB_POOL_WARMUP)
 
 
-def paginate(l: list):
+def get_page():
+    """ Returns (page, items per page) according to the page and per_page request arguments """
+    page = max(1, request.args.get("page", 1, type=int))
+    per_page = request.args.get("per_page", ITEMS_PER_PAGE, type=int)
+    return page, max(1, min(per_page, MAX_ITEMS_PER_PAGE))
+
+
+def is_column_query(query: Query):
+    """ Returns whether the query selects only columns, no orm entities """
+    return not any(isinstance(column["expr"], type) for column in query.column_descriptions)
+
+
+def fetch_rows(query: Query):
+    """ Runs a query of columns with SQLAlchemy Core, the rows are plain read-only tuples with attribute access
+        that skip the orm result processing (no identity map, no change tracking)
+    """
+    return db.session.execute(query.statement).fetchall()
+
+
+def escape_like(text: str):
+    """ Returns the text with the like wildcards escaped by backslashes, so like/ilike with the backslash escape match it literally """
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def paginate(l, format_page=None):
     """ Formats and paginate the given list according to page number in the request arguments
-      l : list to paginate
+      l : list or query to paginate, queries are paginated in the database
+      format_page : function that formats a list of elements, by default each element is formatted with format()
       Returns: list of dictionaries
     """
-    page = request.args.get("page", 1, type=int)
-    start_index = (page - 1) * ITEMS_PER_PAGE
-    l = [e.format() for e in l]
-    return l[start_index: start_index + ITEMS_PER_PAGE]
+    page, per_page = get_page()
+    start_index = (page - 1) * per_page
+    # only the elements of the requested page are loaded and formatted
+    if isinstance(l, Query):
+        l = l.offset(start_index).limit(per_page)
+        l = fetch_rows(l) if is_column_query(l) else l.all()
+    else:
+        l = l[start_index: start_index + per_page]
+    if format_page:
+        return format_page(l)
+    return [e.format() for e in l]
+
+
+def estimate_count(query: Query):
+    """ Returns the planner estimate of the number of rows of the query, without running it """
+    statement = query.order_by(None).statement.compile(dialect=db.engine.dialect)
+    plan = db.session.connection().execute(
+        "EXPLAIN (FORMAT JSON) " + str(statement), statement.params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def with_total(response: dict, l):
+    """ Adds the total number of elements to the response according to the include_total request argument
+      include_total=true (default) counts the elements, estimate uses the planner estimate for queries
+      and false skips counting
+      l : list or query that was paginated
+      Returns: the response
+    """
+    include_total = request.args.get("include_total", "true", type=str).lower()
+    if include_total == "false":
+        return response
+
+    if not isinstance(l, Query):
+        response["total"] = len(l)
+    elif include_total == "estimate":
+        response["total"] = estimate_count(l)
+    else:
+        response["total"] = l.order_by(None).count()
+    return response
+
+
+@lru_cache(maxsize=None)
+def row_serializer(fields: tuple):
+    """ Returns a function that copies the given fields of a Core row (see fetch_rows) to a dictionary,
+        compiled once per set of fields instead of looking up every field of every row
+    """
+    if not fields:
+        return lambda row: {}
+    if len(fields) == 1:
+        field, = fields
+        return lambda row: {field: row[field]}
+    # item access is much cheaper than attribute access on Core rows
+    get_fields = itemgetter(*fields)
+    return lambda row: dict(zip(fields, get_fields(row)))
+
+
+def parse_fields(allowed: list, default: list):
+    """ Returns the fields requested with the fields query parameter (e.g. fields=id,title)
+      allowed : the fields that can be requested
+      default : the fields to return when the parameter is missing
+      Returns: list of fields in the order of allowed
+    """
+    fields = request.args.get("fields", type=str)
+    if not fields:
+        return default
+
+    fields = {field.strip() for field in fields.split(",") if field.strip()}
+    if not fields or not fields.issubset(allowed):
+        # if a field doesn't exist raise unprocessable entity error
+        abort(422)
+    return [field for field in allowed if field in fields]
+
+
+def version_columns():
+    """ Returns the (version, updated_at) columns that every write to a row bumps
+        the server defaults let bulk loads (COPY) skip them, the bump is computed by the update itself
+        so concurrent writes to a row wait for each other's row lock instead of failing
+    """
+    return (Column(Integer, nullable=False, server_default="1", onupdate=text("version + 1")),
+            Column(DateTime, nullable=False, default=datetime.datetime.utcnow,
+                   onupdate=text("(now() at time zone 'utc')"), server_default=text("(now() at time zone 'utc')")))
 
 
 class DatabaseObject():
@@ -47,6 +164,15 @@ class DatabaseObject():
         db.session.delete(self)
         db.session.commit()
 
+    def bump(self):
+        """ Bumps the version of the instance with the next flush when data it depends on changes (e.g. its genres) """
+        self.version = type(self).version + 1
+
+    def touch(self):
+        """ Bumps the version of the instance and commits """
+        self.bump()
+        db.session.commit()
+
     @classmethod
     def get(cls, id: int):
         """ Returns an instance with the given id
@@ -72,9 +198,29 @@ class Book(db.Model, DatabaseObject):
     id = Column(Integer, primary_key=True)
     title = Column(String, nullable=False)
     description = Column(String, nullable=False)
-    author_id = Column(Integer, ForeignKey("authors.id"), nullable=False)
+    # active history keeps the previous author of unloaded books for update_author_stats
+    author_id = column_property(Column(Integer, ForeignKey("authors.id"), nullable=False), active_history=True)
     pages = Column(Integer, nullable=False)
     year = Column(Integer, nullable=False)
+    # the number of users that store the book, maintained by the Stored_Book bulk operations
+    popularity = Column(Integer, nullable=False, default=0, server_default="0")
+    # the last transaction that stored the book or removed it from a shelf, see manage_migrations.build_similarity
+    shelved_transaction_id = Column(BigInteger)
+    version, updated_at = version_columns()
+
+    # the sort indexes end with the id so the sorted pages are read in index order
+    __table_args__ = (Index("ix_books_versions", "id", "version", "updated_at"),
+                      Index("ix_books_title", "title", "id"),
+                      Index("ix_books_year", "year", "id"),
+                      Index("ix_books_popularity", "popularity", "id"),
+                      # the books of an author: the author details page, the author deletion check and the statistics recount
+                      Index("ix_books_author_id", "author_id", "id"))
+
+    # the fields that can be requested with the fields query parameter
+    FIELDS = ["id", "title", "description", "genres", "pages", "year", "author"]
+    # the fields of format()
+    SUMMARY_FIELDS = ["id", "title", "genres", "author"]
+    COLUMN_FIELDS = ["title", "description", "pages", "year"]
 
     def __init__(self, title, description, author_id, pages, year):
         self.title = capwords(title)
@@ -83,19 +229,98 @@ class Book(db.Model, DatabaseObject):
         self.pages = pages
         self.year = year
 
+    @staticmethod
+    def get_versions(id):
+        """ Returns (versions, last modified) of the book details or None if the book doesn't exist
+            the details include the author name so the author version is part of it
+            only reads indexed columns so it's answered by index lookups
+        """
+        row = db.session.query(Book.version, Book.updated_at, Author.version, Author.updated_at).join(
+            Author, Author.id == Book.author_id).filter(Book.id == id).first()
+        if not row:
+            return None
+        return f"b{row[0]}a{row[2]}", max(row[1], row[3])
+
+    @staticmethod
+    def select(fields: list):
+        """ Returns a query of only the columns needed for the given fields
+            the author is joined only if it's requested, the rows are formatted with Book.format_rows
+        """
+        columns = [Book.id] + [getattr(Book, field)
+                               for field in Book.COLUMN_FIELDS if field in fields]
+        if "author" in fields:
+            return db.session.query(*columns, Book.author_id, Author.name.label("author_name")).join(
+                Author, Author.id == Book.author_id)
+        return db.session.query(*columns)
+
+    @staticmethod
+    def format_rows(rows: list, fields: list):
+        """ Formats the rows of Book.select, the genres of all the rows are loaded in one query """
+        genres = Book.get_genres_of([row.id for row in rows]) if "genres" in fields else None
+        with_author = "author" in fields
+        serialize = row_serializer(tuple(field for field in fields if field not in ("genres", "author")))
+        books = []
+        for row in rows:
+            book = serialize(row)
+            if genres is not None:
+                book["genres"] = genres[row.id]
+            if with_author:
+                book["author"] = {
+                    "name": row["author_name"],
+                    "id": row["author_id"]
+                }
+            books.append(book)
+        return books
+
+    @staticmethod
+    def get_formatted(id, fields: list):
+        """ Returns the given fields of the book with the given id
+            id : the id of the desired book
+        """
+        try:
+            id = int(id)
+        except ValueError:
+            # if the id isn't an integer raise a not found error
+            abort(404)
+
+        row = next(iter(fetch_rows(Book.select(fields).filter(Book.id == id))), None)
+        if not row:
+            abort(404)
+        return Book.format_rows([row], fields)[0]
+
+    @staticmethod
+    def get_many(ids: list, fields: list = FIELDS):
+        """ Returns the given fields of the books with the given ids in at most two queries
+            ids: list of book ids
+            Returns: dictionary of book id to formatted book, missing ids are left out
+        """
+        rows = fetch_rows(Book.select(fields).filter(Book.id.in_(ids)))
+        return {row.id: book for row, book in zip(rows, Book.format_rows(rows, fields))}
+
+    @staticmethod
+    def get_summaries(ids: list):
+        """ Returns the summaries (Book.SUMMARY_FIELDS) of the books with the given ids in the same order
+            from the per-worker book cache, missing ids are left out
+            the summaries are shared, they must not be modified
+        """
+        return book_summaries.get_many(ids, lambda missing: Book.get_many(missing, Book.SUMMARY_FIELDS))
+
+    @staticmethod
+    def get_genres_of(ids: list):
+        """ Returns a dictionary of book id to the book genres in one query """
+        genres = {id: [] for id in ids}
+        if ids:
+            for book_id, genre in fetch_rows(db.session.query(BookGenre.book_id, Genre.name).join(
+                    Genre, Genre.id == BookGenre.genre_id).filter(BookGenre.book_id.in_(ids))):
+                genres[book_id].append(genre)
+        return genres
+
     def get_genres(self):
-        return [r.genre for r in BookGenre.query.filter_by(book_id=self.id).all()]
+        return [r.name for r in db.session.query(Genre.name).join(
+            BookGenre, BookGenre.genre_id == Genre.id).filter(BookGenre.book_id == self.id).all()]
 
     def format(self):
-        return {
-            "id": self.id,
-            "title": self.title,
-            "genres": self.get_genres(),
-            "author": {
-                "name": Author.query.filter_by(id=self.author_id).first().name,
-                "id": self.author_id
-            }
-        }
+        return dict(Book.get_summaries([self.id])[0])
 
     def detailed_format(self):
         return {
@@ -112,6 +337,16 @@ class Book(db.Model, DatabaseObject):
         }
 
 
+# the orders of the sort query parameter of GET /books, each one follows an index
+BOOK_SORTS = {
+    "title": [Book.title, Book.id],
+    "year": [Book.year.desc(), Book.id.desc()],
+    "popularity": [Book.popularity.desc(), Book.id.desc()],
+    # the newest books have the highest ids
+    "recent": [Book.id.desc()]
+}
+
+
 class Author(db.Model, DatabaseObject):
     __tablename__ = "authors"
 
@@ -119,34 +354,162 @@ class Author(db.Model, DatabaseObject):
     name = Column(String, nullable=False)
     description = Column(String, nullable=False)
     birthday = Column(Date, nullable=False)
+    # maintained by update_author_stats on every book write
+    total_books = Column(Integer, nullable=False, default=0, server_default="0")
+    # bumped by writes to the author and to the author's books
+    version, updated_at = version_columns()
+
+    __table_args__ = (Index("ix_authors_versions", "id", "version", "updated_at"),)
+
+    # the fields that can be requested with the fields query parameter
+    FIELDS = ["id", "name", "description", "birthday"]
+    DETAILED_FIELDS = FIELDS + ["books", "genres", "total_books"]
+    # the fields of format()
+    SUMMARY_FIELDS = ["id", "name"]
+    # the fields of the author's books
+    BOOK_FIELDS = ["id", "title", "genres"]
 
     def __init__(self, name, description, birthday):
         self.name = capwords(name)
         self.description = description
         self.birthday = birthday
 
+    @staticmethod
+    def get_versions(id):
+        """ Returns (version, last modified) of the author details or None if the author doesn't exist """
+        row = db.session.query(Author.version, Author.updated_at).filter(
+            Author.id == id).first()
+        if not row:
+            return None
+        return f"a{row[0]}", row[1]
+
+    @staticmethod
+    def select(fields: list):
+        """ Returns a query of only the columns needed for the given fields """
+        # the birthday is formatted by the database in the format of str(date)
+        columns = [func.to_char(Author.birthday, "YYYY-MM-DD").label("birthday") if field == "birthday"
+                   else getattr(Author, field) for field in Author.FIELDS if field != "id" and field in fields]
+        return db.session.query(Author.id, *columns)
+
+    @staticmethod
+    def format_rows(rows: list, fields: list):
+        """ Formats the rows of Author.select """
+        serialize = row_serializer(tuple(fields))
+        return [serialize(row) for row in rows]
+
     def format(self):
         return {
             "id": self.id,
             "name": self.name
         }
 
-    def detailed_format(self):
-        books = Book.query.filter_by(author_id=self.id).all()
-        formatted_books = paginate(books)
-        genres = set()
-        for format in formatted_books:
-            del format["author"]
-            genres.update(format["genres"])
+    def detailed_format(self, fields: list = DETAILED_FIELDS):
+        """ fields : the fields to return, the books are only loaded when books, genres or total_books is requested """
+        author = {field: getattr(self, field) for field in Author.FIELDS if field in fields}
+        if "birthday" in author:
+            author["birthday"] = str(self.birthday)
+
+        if "books" in fields:
+            books = db.session.query(Book.id).filter(
+                Book.author_id == self.id).order_by(Book.id)
+            author["books"] = paginate(books, lambda page: [
+                {field: book[field] for field in Author.BOOK_FIELDS}
+                for book in Book.get_summaries([row["id"] for row in page])])
+        # the statistics are precomputed so they don't depend on the number of books
+        if "genres" in fields:
+            author["genres"] = [name for name, in db.session.query(Genre.name).join(
+                AuthorGenre, AuthorGenre.genre_id == Genre.id).filter(AuthorGenre.author_id == self.id).order_by(
+                AuthorGenre.total_books.desc(), Genre.name).all()]
+        if "total_books" in fields:
+            author["total_books"] = self.total_books
+
+        return author
+
+
+# recounts the users that store every book, for stored books loaded without the bulk operations (e.g. seeding)
+REFRESH_POPULARITY = """
+UPDATE books SET popularity = coalesce(counts.total_users, 0)
+    FROM books b LEFT JOIN (SELECT book_id, count(*) AS total_users FROM stored_books GROUP BY book_id) counts
+        ON counts.book_id = b.id
+    WHERE books.id = b.id AND books.popularity <> coalesce(counts.total_users, 0);
+"""
+
+
+# recomputes the author statistics from scratch, for data loaded without the orm (e.g. seeding)
+REFRESH_AUTHOR_STATS = """
+UPDATE authors SET total_books = (SELECT count(*) FROM books WHERE books.author_id = authors.id);
+DELETE FROM author_genres;
+INSERT INTO author_genres (author_id, genre_id, total_books)
+    SELECT books.author_id, book_genres.genre_id, count(*)
+    FROM books JOIN book_genres ON book_genres.book_id = books.id
+    GROUP BY books.author_id, book_genres.genre_id;
+"""
+
+
+class AuthorGenre(db.Model, DatabaseObject):
+    """ The number of books of every genre that the author writes, maintained by update_author_stats """
+    __tablename__ = "author_genres"
+
+    author_id = Column(Integer, ForeignKey("authors.id"), primary_key=True)
+    genre_id = Column(Integer, ForeignKey("genres.id"), primary_key=True)
+    total_books = Column(Integer, nullable=False)
+
+    @staticmethod
+    def refresh():
+        db.session.execute(REFRESH_AUTHOR_STATS)
+        db.session.commit()
+
+
+class Genre(db.Model, DatabaseObject):
+    __tablename__ = "genres"
+
+    id = Column(Integer, primary_key=True)
+    # canonical lowercase name used for lookups
+    key = Column(String, nullable=False, unique=True)
+    name = Column(String, nullable=False)
+
+    def __init__(self, name):
+        self.name = capwords(name)
+        self.key = Genre.make_key(name)
+
+    @staticmethod
+    def make_key(name: str):
+        return capwords(name).lower()
+
+    @staticmethod
+    def get_id(name: str):
+        """ Returns the id of the genre with the given name (case insensitive) or None if it doesn't exist """
+        row = db.session.query(Genre.id).filter_by(key=Genre.make_key(name)).first()
+        return row.id if row else None
+
+    @staticmethod
+    def get_or_create(name: str):
+        """ Returns the id of the genre with the given name (case insensitive), creating it if it doesn't exist """
+        return Genre.get_or_create_many([name])[Genre.make_key(name)]
+
+    @staticmethod
+    def get_or_create_many(names: list):
+        """ Returns a dictionary of genre key to id of the given names (case insensitive),
+            the missing genres are created in the current transaction
+        """
+        names = {Genre.make_key(name): name for name in names}
+        if not names:
+            return {}
+        ids = dict(db.session.query(Genre.key, Genre.id).filter(Genre.key.in_(names)).all())
+        missing = names.keys() - ids.keys()
+        if missing:
+            # another request may create the same genres first, the sorted keys keep the concurrent inserts
+            # from waiting for each other in opposite orders
+            db.session.execute(insert(Genre.__table__).values(
+                [{"key": key, "name": capwords(names[key])} for key in sorted(missing)]).on_conflict_do_nothing(
+                index_elements=["key"]))
+            ids = dict(db.session.query(Genre.key, Genre.id).filter(Genre.key.in_(names)).all())
+        return ids
 
+    def format(self):
         return {
             "id": self.id,
-            "name": self.name,
-            "description": self.description,
-            "books": formatted_books,
-            "total_books": len(books),
-            "genres": list(genres),
-            "birthday": str(self.birthday)
+            "name": self.name
         }
 
 
@@ -154,16 +517,46 @@ class BookGenre(db.Model, DatabaseObject):
     __tablename__ = "book_genres"
 
     book_id = Column(Integer, ForeignKey("books.id"), primary_key=True)
-    genre = Column(String, primary_key=True)
+    genre_id = Column(Integer, ForeignKey("genres.id"), primary_key=True)
+    genre = relationship(Genre)
+
+    # the primary key serves the lookups by book, this one the lookups by genre
+    __table_args__ = (Index("ix_book_genres_genre_id", "genre_id", "book_id"),)
 
-    def __init__(self, book_id, genre):
+    def __init__(self, book_id, genre, genre_id: int = None):
+        """ genre : the genre name, the genre is created if it doesn't exist
+            genre_id : the id of the genre when it's already known (see Genre.get_or_create_many)
+        """
         self.book_id = book_id
-        self.genre = capwords(genre)
+        self.genre_id = genre_id if genre_id is not None else Genre.get_or_create(genre)
+
+    @staticmethod
+    def get_of(book_ids: list):
+        """ Returns a dictionary of book id to the book's genres (genre key: BookGenre) in one query """
+        genres = {}
+        for book_genre, key in db.session.query(BookGenre, Genre.key).join(
+                Genre, Genre.id == BookGenre.genre_id).filter(BookGenre.book_id.in_(book_ids)):
+            genres.setdefault(book_genre.book_id, {})[key] = book_genre
+        return genres
+
+    @staticmethod
+    def count_books(search_term: str = None):
+        """ Returns the number of books of every genre in one grouped query, most common genres first
+            search_term : only count the books whose title contains it
+        """
+        total = func.count(BookGenre.book_id)
+        query = db.session.query(Genre.name, total).join(
+            BookGenre, BookGenre.genre_id == Genre.id).group_by(Genre.id)
+        if search_term:
+            query = query.join(Book, Book.id == BookGenre.book_id).filter(
+                Book.title.ilike(f"%{escape_like(search_term)}%", escape="\\"))
+        return [{"name": genre, "total_books": count}
+                for genre, count in query.order_by(total.desc(), Genre.name).all()]
 
     def format(self):
         return {
             "book_id": self.book_id,
-            "type": self.genre
+            "type": self.genre.name
         }
 
 
@@ -174,6 +567,8 @@ class Shelf(db.Model, DatabaseObject):
     user_id = Column(String, nullable=False)
     user_based_id = Column(Integer, nullable=False)
     name = Column(String, nullable=False)
+    # bumped by writes to the shelf and by adding or removing its books
+    version, updated_at = version_columns()
 
     def __init__(self, user_id, name):
         self.user_id = user_id
@@ -187,6 +582,29 @@ class Shelf(db.Model, DatabaseObject):
 
         self.user_based_id = user_based_id
 
+    @staticmethod
+    def select(user_id: str):
+        """ Returns a query of the user shelves with their number of books, the rows are formatted with Shelf.format_rows """
+        total_books = db.session.query(func.count(Stored_Book.book_id)).filter(
+            Stored_Book.shelf_id == Shelf.id).correlate(Shelf).as_scalar()
+        return db.session.query(Shelf.id, Shelf.user_based_id, Shelf.name, total_books.label("total_books")).filter(
+            Shelf.user_id == user_id)
+
+    @staticmethod
+    def format_rows(rows: list):
+        """ Formats the rows of Shelf.select in the same format as format() """
+        return [{"id": row["user_based_id"], "name": row["name"], "total_books": row["total_books"]} for row in rows]
+
+    @staticmethod
+    def get_summaries(user_id: str):
+        """ Returns the formatted shelves of the user ordered by id from the per-worker shelf cache
+            the summaries are shared, they must not be modified
+        """
+        def load():
+            rows = fetch_rows(Shelf.select(user_id).order_by(Shelf.user_based_id))
+            return {row["id"]: shelf for row, shelf in zip(rows, Shelf.format_rows(rows))}
+        return shelf_summaries.get(user_id, load)
+
     def format(self):
         total_books = Stored_Book.query.filter_by(shelf_id=self.id).count()
         return {
@@ -196,15 +614,14 @@ class Shelf(db.Model, DatabaseObject):
         }
 
     def detailed_format(self):
-        books = []
-        for id in db.session.query(Stored_Book.book_id).filter_by(shelf_id=self.id).all():
-            books.append(Book.get(id.book_id))
+        books = db.session.query(Stored_Book.book_id.label("id")).filter(
+            Stored_Book.shelf_id == self.id).order_by(Stored_Book.book_id)
 
         return {
             "id": self.user_based_id,
             "name": self.name,
-            "books": paginate(books),
-            "total_books": len(books)
+            "books": paginate(books, lambda page: Book.get_summaries([row["id"] for row in page])),
+            "total_books": books.order_by(None).count()
         }
 
     # overwrite DatabaseObject.get to use the user_based_id instead of id
@@ -262,4 +679,393 @@ class Stored_Book(db.Model, DatabaseObject):
             abort(404)
         return instance
 
+    @staticmethod
+    def select_library(user_id: str):
+        """ Returns a query of all the user's shelves joined with their stored books ordered by shelf and book,
+            shelves without books have a single row with null book columns
+        """
+        genres = db.select([func.array_agg(aggregate_order_by(Genre.name, Genre.name))]).select_from(
+            BookGenre.__table__.join(Genre.__table__)).where(BookGenre.book_id == Book.id).correlate(Book.__table__)
+        return db.session.query(
+            Shelf.user_based_id.label("shelf_id"), Shelf.name.label("shelf_name"),
+            Book.id.label("book_id"), Book.title, Author.id.label("author_id"), Author.name.label("author_name"),
+            genres.as_scalar().label("genres")
+        ).select_from(Shelf).outerjoin(Stored_Book, Stored_Book.shelf_id == Shelf.id).outerjoin(
+            Book, Book.id == Stored_Book.book_id).outerjoin(Author, Author.id == Book.author_id).filter(
+            Shelf.user_id == user_id).order_by(Shelf.user_based_id, Stored_Book.book_id)
+
+    # the bulk operations are single statements, the primary key (user_id, book_id) detects the conflicts
+    @staticmethod
+    def add_many(user_id: str, shelf_id: int, book_ids: list):
+        """ Stores the given books in the shelf, returns the ids of the stored books
+            books that don't exist or are already on one of the user's shelves are skipped
+        """
+        table = Stored_Book.__table__
+        books = db.select([db.literal(user_id, String), db.literal(shelf_id, Integer), Book.id]).where(Book.id.in_(book_ids))
+        added = insert(table).from_select(["user_id", "shelf_id", "book_id"], books).on_conflict_do_nothing(
+            index_elements=[table.c.user_id, table.c.book_id]).returning(table.c.book_id).cte("added")
+        statement = Stored_Book._count_books(added, 1).returning(added.c.book_id)
+        return [row["book_id"] for row in db.session.execute(statement)]
+
+    @staticmethod
+    def move_many(user_id: str, book_ids: list, shelf_id: int, from_shelf_id: int = None):
+        """ Moves the given books from any of the user's shelves (or only from from_shelf_id) to the shelf
+            returns (book id, previous shelf id) of the moved books, books that aren't stored or are already on the shelf are skipped
+        """
+        table = Stored_Book.__table__
+        previous = table.alias("previous")
+        statement = table.update().values(shelf_id=shelf_id).where(db.and_(
+            table.c.user_id == user_id, table.c.book_id.in_(book_ids), table.c.shelf_id != shelf_id,
+            previous.c.user_id == table.c.user_id, previous.c.book_id == table.c.book_id))
+        if from_shelf_id is not None:
+            statement = statement.where(table.c.shelf_id == from_shelf_id)
+        statement = statement.returning(table.c.book_id, previous.c.shelf_id)
+        return [(row[0], row[1]) for row in db.session.execute(statement)]
+
+    @staticmethod
+    def remove_many(user_id: str, book_ids: list = None, shelf_id: int = None):
+        """ Removes the given books (all of them when None) from the user's shelves (or only from shelf_id)
+            returns (book id, shelf id) of the removed books
+        """
+        table = Stored_Book.__table__
+        statement = table.delete().where(table.c.user_id == user_id)
+        if book_ids is not None:
+            statement = statement.where(table.c.book_id.in_(book_ids))
+        if shelf_id is not None:
+            statement = statement.where(table.c.shelf_id == shelf_id)
+        removed = statement.returning(table.c.book_id, table.c.shelf_id).cte("removed")
+        statement = Stored_Book._count_books(removed, -1).returning(removed.c.book_id, removed.c.shelf_id)
+        return [(row[0], row[1]) for row in db.session.execute(statement)]
+
+    @staticmethod
+    def _count_books(changed, count: int):
+        """ Returns an update that adds count to the popularity of the books of the changed stored books
+            changed : cte of the inserted or deleted stored books, the update runs the cte in the same statement
+        """
+        books = Book.__table__
+        # the popularity isn't part of the book representation so its version is left as is
+        return books.update().values(popularity=books.c.popularity + count, shelved_transaction_id=func.txid_current(),
+                                     version=books.c.version, updated_at=books.c.updated_at).where(
+            books.c.id == changed.c.book_id)
+
+
+
+class SimilarBook(db.Model):
+    """ Precomputed nearest neighbors of every book, built offline by similarity.build_similarity """
+    __tablename__ = "similar_books"
+
+    book_id = Column(Integer, ForeignKey("books.id", ondelete="CASCADE"), primary_key=True)
+    # 0 is the most similar book
+    rank = Column(SmallInteger, primary_key=True)
+    similar_id = Column(Integer, ForeignKey("books.id", ondelete="CASCADE"), nullable=False)
+    score = Column(Float, nullable=False)
+
+    @staticmethod
+    def get_ids(book_id: int, limit: int):
+        """ Returns the ids of the books most similar to the given book, most similar first """
+        return [row["similar_id"] for row in fetch_rows(db.session.query(SimilarBook.similar_id).filter(
+            SimilarBook.book_id == book_id).order_by(SimilarBook.rank).limit(limit))]
+
+
+class Change(db.Model):
+    """ Append-only log of the catalog writes, read by the /changes feed """
+    __tablename__ = "changes"
+
+    id = Column(BigInteger, primary_key=True)
+    # ordering by the writing transaction makes the feed gap free, see Change.feed
+    transaction_id = Column(BigInteger, nullable=False,
+                            server_default=text("txid_current()"))
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    operation = Column(String, nullable=False)
+    changed_at = Column(DateTime, nullable=False,
+                        server_default=text("(now() at time zone 'utc')"))
+
+    __table_args__ = (Index("ix_changes_transaction_id_id", "transaction_id", "id"),)
+
+    UPSERT = "upsert"
+    DELETE = "delete"
+
+    def format(self):
+        return {
+            "token": Change.make_token(self.transaction_id, self.id),
+            "type": self.entity,
+            "id": self.entity_id,
+            "operation": self.operation,
+            "changed_at": self.changed_at.isoformat()
+        }
+
+    @staticmethod
+    def make_token(transaction_id, id):
+        return f"{transaction_id}.{id}"
+
+    @staticmethod
+    def parse_token(token: str):
+        """ Returns (transaction id, id) of a resume token, raises ValueError for invalid tokens """
+        transaction_id, id = token.split(".")
+        return int(transaction_id), int(id)
+
+    @staticmethod
+    def feed(since: tuple, limit: int):
+        """ Returns the changes after the given (transaction id, id) position in order
+            only the transactions older than every running transaction are returned,
+            so a change can never show up later behind a token that was already handed out
+        """
+        xmin = func.txid_snapshot_xmin(func.txid_current_snapshot())
+        return Change.query.filter(
+            Change.transaction_id < xmin,
+            tuple_(Change.transaction_id, Change.id) > since
+        ).order_by(Change.transaction_id, Change.id).limit(limit).all()
+
+    @staticmethod
+    def head():
+        """ Returns the (transaction id, id) position of the last change that Change.feed can return """
+        xmin = func.txid_snapshot_xmin(func.txid_current_snapshot())
+        last = db.session.query(Change.transaction_id, Change.id).filter(
+            Change.transaction_id < xmin).order_by(Change.transaction_id.desc(), Change.id.desc()).first()
+        return tuple(last) if last else (0, 0)
+
+
+class Job(db.Model, DatabaseObject):
+    """ Background job with its items and progress, run a batch at a time by jobs.JobRunner """
+    __tablename__ = "jobs"
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    id = Column(Integer, primary_key=True)
+    type = Column(String, nullable=False)
+    user_id = Column(String)
+    status = Column(String, nullable=False, default=QUEUED)
+    params = Column(JSON, nullable=False)
+    items = Column(JSON, nullable=False)
+    total = Column(Integer, nullable=False)
+    # the number of processed items, the job resumes from there
+    position = Column(Integer, nullable=False, default=0)
+    counts = Column(JSON, nullable=False)
+    errors = Column(JSON, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    # bumped by every batch, a running job that isn't bumped for a while lost its worker
+    updated_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow,
+                        onupdate=datetime.datetime.utcnow)
+    finished_at = Column(DateTime)
+
+    __table_args__ = (Index("ix_jobs_status", "status", "updated_at"),)
+
+    def __init__(self, type: str, user_id: str, items: list, params: dict):
+        self.type = type
+        self.user_id = user_id
+        self.items = items
+        self.total = len(items)
+        self.params = params
+        self.counts = {}
+        self.errors = []
+
+    @staticmethod
+    def _resumable(lease: int):
+        stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=lease)
+        return db.or_(Job.status == Job.QUEUED, db.and_(Job.status == Job.RUNNING, Job.updated_at < stale))
+
+    @staticmethod
+    def resumable_ids(lease: int):
+        """ Returns the ids of the queued jobs and of the running jobs not updated for lease seconds """
+        return [row["id"] for row in fetch_rows(db.session.query(Job.id).filter(Job._resumable(lease)).order_by(Job.id))]
+
+    @staticmethod
+    def claim(id: int, lease: int):
+        """ Marks the job as running by the caller and returns it, or None if it's done or run by another worker """
+        claimed = Job.__table__.update().values(status=Job.RUNNING, updated_at=datetime.datetime.utcnow()).where(
+            db.and_(Job.id == id, Job._resumable(lease)))
+        if db.session.execute(claimed).rowcount != 1:
+            db.session.rollback()
+            return None
+        db.session.commit()
+        return Job.query.get(id)
+
+    def advance(self, items: int, counts: dict, error: str = None):
+        """ Records a processed batch and commits it with the work of the batch """
+        self.position += items
+        self.counts = {key: self.counts.get(key, 0) + counts.get(key, 0) for key in {**self.counts, **counts}}
+        if error:
+            self.errors = self.errors + [{"position": self.position - items, "message": error}]
+        db.session.commit()
+
+    def finish(self, status: str = DONE):
+        self.status = status
+        self.finished_at = datetime.datetime.utcnow()
+        db.session.commit()
+
+    def format(self):
+        return {
+            "id": self.id,
+            "type": self.type,
+            "status": self.status,
+            "total": self.total,
+            "processed": self.position,
+            "counts": self.counts,
+            "errors": self.errors,
+            "created_at": self.created_at.isoformat(),
+            "updated_at": self.updated_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+def get_names(book_ids: set = None, author_ids: set = None):
+    """ Returns (type, id, name) of the given books and authors for the autocomplete index,
+        all the books and authors when both are None
+    """
+    everything = book_ids is None and author_ids is None
+    names = []
+    for type, id_column, name_column, ids in (("book", Book.id, Book.title, book_ids),
+                                              ("author", Author.id, Author.name, author_ids)):
+        query = db.session.query(id_column, name_column)
+        if not everything:
+            if not ids:
+                continue
+            query = query.filter(id_column.in_(ids))
+        names.extend((type, id, name) for id, name in fetch_rows(query))
+    return names
+
+
+# result type: the column of its number of matches
+SEARCH_TYPES = {"book": "books", "author": "authors", "genre": "genres"}
+
+
+def search(term: str):
+    """ Returns a query of the books, authors and genres whose title or name contains the term
+        ordered by relevance: exact match, then beginning of the name, then beginning of a word, then anywhere
+        every row also has the total number of matches (total) and of each type (the SEARCH_TYPES columns)
+    """
+    # the like wildcards of the term are matched literally
+    pattern = escape_like(term)
+
+    def rank(column):
+        return db.case([(func.lower(column) == term.lower(), 0), (column.ilike(f"{pattern}%", escape="\\"), 1),
+                        (column.ilike(f"% {pattern}%", escape="\\"), 2)], else_=3)
+
+    matches = [
+        db.session.query(db.literal(type).label("type"), id_column.label("id"), name_column.label("name"),
+                         rank(name_column).label("rank")).filter(name_column.ilike(f"%{pattern}%", escape="\\"))
+        for type, id_column, name_column in (("book", Book.id, Book.title), ("author", Author.id, Author.name),
+                                             ("genre", Genre.id, Genre.name))
+    ]
+    matches = matches[0].union_all(*matches[1:]).subquery()
+    # the counts are computed before the pagination
+    totals = [func.count().filter(matches.c.type == type).over().label(column) for type, column in SEARCH_TYPES.items()]
+    return db.session.query(matches, *totals, func.count().over().label("total")).order_by(
+        matches.c.rank, func.lower(matches.c.name), matches.c.type, matches.c.id)
+
+
+@event.listens_for(db.session, "after_flush")
+def record_changes(session, flush_context):
+    """ Writes the catalog changes to the change log in the same transaction as the change itself """
+    changes = {}
+    for instance in session.new:
+        if isinstance(instance, (Book, Author)):
+            changes[(instance.__tablename__, instance.id)] = Change.UPSERT
+    for instance in session.dirty:
+        if isinstance(instance, (Book, Author)) and session.is_modified(instance):
+            changes[(instance.__tablename__, instance.id)] = Change.UPSERT
+    # genres are part of the book
+    for instance in list(session.new) + list(session.deleted):
+        if isinstance(instance, BookGenre):
+            changes.setdefault(("books", instance.book_id), Change.UPSERT)
+    for instance in session.deleted:
+        if isinstance(instance, (Book, Author)):
+            changes[(instance.__tablename__, instance.id)] = Change.DELETE
+
+    if changes:
+        entities = {"books": "book", "authors": "author"}
+        session.connection().execute(Change.__table__.insert(), [
+            {"entity": entities[table], "entity_id": id, "operation": operation}
+            for (table, id), operation in changes.items()
+        ])
+        session.info.setdefault("catalog_changes", set()).update(changes)
+
+
+@event.listens_for(db.session, "after_commit")
+def invalidate_book_summaries(session):
+    """ Drops the changed books from this worker's book cache right away,
+        the other workers see the changes through the change log
+    """
+    changes = session.info.pop("catalog_changes", None)
+    if changes:
+        book_summaries.invalidate(books=[id for table, id in changes if table == "books"],
+                                  authors=[id for table, id in changes if table == "authors"])
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_catalog_changes(session):
+    session.info.pop("catalog_changes", None)
+
+
+@event.listens_for(db.session, "after_flush")
+def update_author_stats(session, flush_context):
+    """ Applies the flushed book and genre changes to the author statistics in the same transaction """
+    books = Counter()  # author id: change in the number of books
+    genres = Counter()  # (author id, genre id): change in the number of books
+    book_authors = {}  # book id: author id, for the books of this flush
+    moved = {}  # book id: (old author id, new author id)
+
+    for instance in session.new:
+        if isinstance(instance, Book):
+            books[instance.author_id] += 1
+            book_authors[instance.id] = instance.author_id
+    for instance in session.deleted:
+        if isinstance(instance, Book):
+            books[instance.author_id] -= 1
+            book_authors[instance.id] = instance.author_id
+    for instance in session.dirty:
+        if isinstance(instance, Book):
+            book_authors[instance.id] = instance.author_id
+            history = inspect(instance).attrs.author_id.history
+            if history.deleted and history.added and int(history.deleted[0]) != int(history.added[0]):
+                moved[instance.id] = (history.deleted[0], history.added[0])
+
+    added = [i for i in session.new if isinstance(i, BookGenre)]
+    removed = [i for i in session.deleted if isinstance(i, BookGenre)]
+    connection = session.connection()
+
+    if moved:
+        # the book takes its genres from before the flush to the new author,
+        # which also gets the genres added by the flush
+        current = [tuple(row) for row in connection.execute(db.select([BookGenre.book_id, BookGenre.genre_id]).where(
+            BookGenre.book_id.in_(list(moved)))).fetchall()]
+        before = set(current) - {(i.book_id, i.genre_id) for i in added} | \
+            {(i.book_id, i.genre_id) for i in removed if i.book_id in moved}
+        for book_id, (old_author_id, new_author_id) in moved.items():
+            books[old_author_id] -= 1
+            books[new_author_id] += 1
+        for book_id, genre_id in before:
+            genres[(moved[book_id][0], genre_id)] -= 1
+        for book_id, genre_id in current:
+            genres[(moved[book_id][1], genre_id)] += 1
+
+    changed = [(i, 1) for i in added if i.book_id not in moved] + \
+        [(i, -1) for i in removed if i.book_id not in moved]
+    missing = {i.book_id for i, _ in changed} - book_authors.keys()
+    if missing:
+        book_authors.update(tuple(row) for row in connection.execute(db.select([Book.id, Book.author_id]).where(
+            Book.id.in_(list(missing)))).fetchall())
+    for instance, count in changed:
+        genres[(book_authors[instance.book_id], instance.genre_id)] += count
+
+    authors = Author.__table__
+    for author_id, count in books.items():
+        if count:
+            connection.execute(authors.update().where(authors.c.id == int(author_id)).values(
+                total_books=authors.c.total_books + count))
+
+    author_genres = AuthorGenre.__table__
+    rows = [{"author_id": int(author_id), "genre_id": genre_id, "total_books": count}
+            for (author_id, genre_id), count in genres.items() if count]
+    if rows:
+        upsert = insert(author_genres)
+        connection.execute(upsert.on_conflict_do_update(
+            index_elements=[author_genres.c.author_id, author_genres.c.genre_id],
+            set_={"total_books": author_genres.c.total_books + upsert.excluded.total_books}), rows)
+        connection.execute(author_genres.delete().where(author_genres.c.total_books <= 0))
+
 # endregion
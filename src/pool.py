@@ -0,0 +1,118 @@
+"""
+    Database connection pool of each worker: its settings (see the DB_* constants), statistics and warm-up.
+    Every connection carries the statement timeout of its current use, public reads get a shorter one than
+    the authenticated requests, the background jobs and the maintenance commands run without one.
+"""
+import os
+import time
+from threading import Lock
+from flask import has_request_context, request
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+from constants import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, \
+    DB_CONNECT_TIMEOUT, DB_STATEMENT_TIMEOUT, DB_READ_STATEMENT_TIMEOUT
+
+
+def statement_timeout():
+    """ Returns the statement timeout in milliseconds of the current use of a connection, None for no timeout """
+    if not has_request_context():
+        return None
+    if request.method in ("GET", "HEAD") and "Authorization" not in request.headers:
+        return DB_READ_STATEMENT_TIMEOUT
+    return DB_STATEMENT_TIMEOUT
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ QueuePool that records how long the checkouts wait for a connection and sets the statement timeouts """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = Lock()
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+        self.connections = 0
+        self.invalidations = 0
+        event.listen(self, "connect", self._on_connect)
+        event.listen(self, "checkout", self._on_checkout)
+        event.listen(self, "invalidate", self._on_invalidate)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        connection_record.info["statement_timeout"] = None
+        with self._stats_lock:
+            self.connections += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        timeout = statement_timeout()
+        if connection_record.info["statement_timeout"] != timeout:
+            # committed right away so it stays when the request rolls back
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute("SET statement_timeout TO DEFAULT" if timeout is None
+                               else f"SET statement_timeout = {int(timeout)}")
+            dbapi_connection.commit()
+            connection_record.info["statement_timeout"] = timeout
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        # e.g. a failed pre-ping after a failover
+        with self._stats_lock:
+            self.invalidations += 1
+
+    def _do_get(self):
+        # includes the time to open a connection when the pool isn't full
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        wait = time.perf_counter() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+        return connection
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "size": self.size(),
+                "max_overflow": self._max_overflow,
+                "checked_out": self.checkedout(),
+                "checked_in": self.checkedin(),
+                # negative until the pool is full
+                "overflow": self.overflow(),
+                "checkouts": self.checkouts,
+                "average_wait_ms": round(1000 * self.wait_time / self.checkouts, 3) if self.checkouts else 0,
+                "max_wait_ms": round(1000 * self.max_wait_time, 3),
+                "timeouts": self.timeouts,
+                "connections": self.connections,
+                "invalidations": self.invalidations,
+                "worker": os.getpid()
+            }
+
+
+def engine_options():
+    """ Returns the create_engine arguments of the pool settings """
+    return {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        # replaces the connections that died with a failover or a restart before they're used
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "connect_args": {"connect_timeout": DB_CONNECT_TIMEOUT}
+    }
+
+
+def warm_up(engine, connections: int):
+    """ Opens up to the given number of pool connections at once so the first requests don't wait for them """
+    opened = []
+    try:
+        for _ in range(min(connections, engine.pool.size())):
+            opened.append(engine.raw_connection())
+    finally:
+        for connection in opened:
+            connection.close()
@@ -0,0 +1,238 @@
+"""
+    Deterministic synthetic catalog generator used to benchmark the api at production scale.
+    Rows are generated lazily and streamed straight into postgres with COPY,
+    so memory usage stays constant regardless of the requested catalog size.
+"""
+import sys
+from random import Random
+from string import capwords
+from models import db, REFRESH_AUTHOR_STATS, REFRESH_POPULARITY
+
+# the rng is re-seeded every BLOCK_SIZE entities so each table can be
+# regenerated independently (and identically) without keeping anything in memory
+BLOCK_SIZE = 1024
+
+# ordered from the most to the least common, weights follow a zipf-like curve
+GENRES = [
+    "fiction", "romance", "fantasy", "mystery", "young adult", "thriller",
+    "historical fiction", "science fiction", "nonfiction", "contemporary",
+    "classics", "horror", "crime", "paranormal", "adventure", "biography",
+    "history", "humor", "poetry", "self help", "childrens", "memoir",
+    "dystopia", "magic", "philosophy", "science", "psychology", "graphic novels",
+    "business", "religion", "travel", "cookbooks", "art", "music", "sports",
+    "politics", "true crime", "economics", "plays", "short stories"
+]
+GENRE_WEIGHTS = [1 / (rank + 1) ** 1.1 for rank in range(len(GENRES))]
+
+WORDS = [
+    "shadow", "river", "silent", "night", "garden", "empire", "stone", "winter",
+    "house", "secret", "fire", "glass", "ocean", "crown", "forgotten", "light",
+    "city", "storm", "last", "wild", "iron", "golden", "hidden", "star", "road",
+    "broken", "dream", "king", "queen", "girl", "boy", "war", "memory", "song",
+    "mountain", "island", "lost", "summer", "midnight", "heart", "blood", "sky"
+]
+FIRST_NAMES = [
+    "james", "mary", "john", "patricia", "robert", "jennifer", "michael", "linda",
+    "william", "elizabeth", "david", "barbara", "richard", "susan", "joseph",
+    "jessica", "thomas", "sarah", "charles", "karen", "haruki", "chimamanda",
+    "gabriel", "toni", "leila", "omar", "ines", "mateo", "anya"
+]
+LAST_NAMES = [
+    "smith", "johnson", "williams", "brown", "jones", "garcia", "miller", "davis",
+    "rodriguez", "martinez", "hernandez", "lopez", "gonzalez", "wilson", "anderson",
+    "thomas", "taylor", "moore", "jackson", "martin", "lee", "perez", "thompson",
+    "white", "harris", "sanchez", "clark", "ramirez", "lewis", "robinson"
+]
+DEFAULT_SHELVES = ["want to read", "currently reading", "read"]
+EXTRA_SHELVES = ["favorites", "to buy", "book club", "abandoned", "re-read"]
+
+
+def _blocks(seed: int, kind: str, count: int):
+    """ Yields (index, rng) for every entity of the given kind
+        the rng is shared by all the entities of the same block
+    """
+    for block_start in range(0, count, BLOCK_SIZE):
+        rng = Random(f"{seed}/{kind}/{block_start // BLOCK_SIZE}")
+        for i in range(block_start, min(block_start + BLOCK_SIZE, count)):
+            yield i, rng
+
+
+def _sentence(rng: Random, words: int):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def generate_authors(seed: int, count: int, first_id: int = 1):
+    """ Yields author rows: (id, name, description, birthday) """
+    for i, rng in _blocks(seed, "authors", count):
+        # the api refuses duplicate names, the id keeps them unique
+        name = capwords(f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}") + f" {first_id + i}"
+        birthday = f"{rng.randint(1850, 2000)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}"
+        yield first_id + i, name, _sentence(rng, 20), birthday
+
+
+def generate_books(seed: int, count: int, authors: int, first_id: int = 1, first_author_id: int = 1):
+    """ Yields (book row, genres) for every book
+        book row: (id, title, description, author_id, pages, year)
+    """
+    for i, rng in _blocks(seed, "books", count):
+        # the api refuses duplicate titles, the id keeps them unique
+        title = capwords(" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))) + f" {first_id + i}"
+        # cubing skews the books towards the first authors so a few authors are very prolific
+        author_id = first_author_id + int(authors * rng.random() ** 3)
+        # most of the catalog is recent
+        year = 2024 - int(200 * rng.random() ** 2)
+        genres = set(rng.choices(GENRES, GENRE_WEIGHTS, k=rng.randint(1, 4)))
+        row = (first_id + i, title, _sentence(rng, 40), author_id, rng.randint(60, 1200), year)
+        yield row, [capwords(genre) for genre in sorted(genres)]
+
+
+def generate_users(seed: int, count: int, books: int, shelf_books: int,
+                   first_shelf_id: int = 1, first_book_id: int = 1, first_user: int = 0):
+    """ Yields (shelves, stored books) for every user
+        shelves: list of (id, user_id, user_based_id, name)
+        stored books: list of (user_id, shelf_id, book_id)
+    """
+    shelf_id = first_shelf_id
+    for i, rng in _blocks(seed, "users", count):
+        user_id = f"seed{first_user + i:010}"
+        names = DEFAULT_SHELVES + EXTRA_SHELVES[:rng.randint(0, len(EXTRA_SHELVES))]
+        shelves = [(shelf_id + n, user_id, n + 1, name) for n, name in enumerate(names)]
+        shelf_id += len(shelves)
+
+        # shelf sizes are exponentially distributed around the requested average
+        total = min(books, int(rng.expovariate(1 / shelf_books))) if shelf_books else 0
+        stored = [(user_id, rng.choice(shelves)[0], first_book_id + book)
+                  for book in rng.sample(range(books), total)]
+        yield shelves, stored
+
+
+class RowStream:
+    """ File-like object that feeds generated rows to COPY without materializing them """
+
+    def __init__(self, rows):
+        self._lines = (_copy_line(row) for row in rows)
+        self._buffer = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _copy_line(row):
+    """ Formats a row in postgres COPY text format """
+    values = []
+    for value in row:
+        if value is None:
+            values.append("\\N")
+        else:
+            values.append(str(value).replace("\\", "\\\\").replace(
+                "\t", "\\t").replace("\n", "\\n").replace("\r", "\\r"))
+    return "\t".join(values) + "\n"
+
+
+def _tables(seed, books, authors, users, shelf_books, first_ids, genre_ids):
+    """ Returns (table, columns, row generator) for every seeded table in insertion order
+        first_ids: the first id of every table of SEQUENCES and the number of the first user (users)
+        genre_ids: maps the genre keys to the ids of the genres table
+    """
+    def book_rows():
+        for row, _ in generate_books(seed, books, authors, first_ids["books"], first_ids["authors"]):
+            yield row
+
+    def book_genre_rows():
+        for row, genres in generate_books(seed, books, authors, first_ids["books"], first_ids["authors"]):
+            for genre in genres:
+                yield row[0], genre_ids[genre.lower()]
+
+    def shelf_rows():
+        for shelves, _ in generate_users(seed, users, books, shelf_books, first_ids["shelves"], first_ids["books"],
+                                         first_ids["users"]):
+            yield from shelves
+
+    def stored_book_rows():
+        for _, stored in generate_users(seed, users, books, shelf_books, first_ids["shelves"], first_ids["books"],
+                                        first_ids["users"]):
+            yield from stored
+
+    return [
+        ("authors", ("id", "name", "description", "birthday"),
+         generate_authors(seed, authors, first_ids["authors"])),
+        ("books", ("id", "title", "description", "author_id", "pages", "year"), book_rows()),
+        ("book_genres", ("book_id", "genre_id"), book_genre_rows()),
+        ("shelves", ("id", "user_id", "user_based_id", "name"), shelf_rows()),
+        ("stored_books", ("user_id", "shelf_id", "book_id"), stored_book_rows()),
+    ]
+
+
+SEQUENCES = ["authors", "books", "shelves"]
+
+
+def seed_database(books: int, authors: int, users: int, shelf_books: int, seed: int = 0, log=print):
+    """ Generates the synthetic catalog and loads it into the database with COPY
+        ids continue from the current maximum ids so existing data is preserved
+    """
+    first_ids = {table: db.session.execute(
+        f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}").scalar() for table in SEQUENCES}
+    # every seeded user has shelves, the new users are numbered after the seeded ones
+    first_ids["users"] = db.session.execute(
+        "SELECT COALESCE(MAX(substr(user_id, 5)::bigint), -1) + 1 FROM shelves WHERE user_id ~ '^seed[0-9]{10}$'").scalar()
+
+    # the genres are shared with the existing data, only the missing ones are added
+    db.session.execute(
+        "INSERT INTO genres (key, name) VALUES (:key, :name) ON CONFLICT (key) DO NOTHING",
+        [{"key": genre, "name": capwords(genre)} for genre in GENRES])
+    db.session.commit()
+    genre_ids = dict(db.session.execute("SELECT key, id FROM genres").fetchall())
+
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for table, columns, rows in _tables(seed, books, authors, users, shelf_books, first_ids, genre_ids):
+            log(f"loading {table}")
+            cursor.copy_expert(
+                f"COPY {table} ({', '.join(columns)}) FROM STDIN", RowStream(rows))
+            connection.commit()
+
+        for table in SEQUENCES:
+            cursor.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))")
+        connection.commit()
+
+        # COPY skips the orm and the stored books operations so the counters are computed at the end
+        log("computing author statistics")
+        cursor.execute(REFRESH_AUTHOR_STATS)
+        log("computing book popularity")
+        cursor.execute(REFRESH_POPULARITY)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def dump_seed(books: int, authors: int, users: int, shelf_books: int, seed: int = 0, out=sys.stdout):
+    """ Streams the synthetic catalog as a psql script (COPY blocks) for an empty database
+        Usage example: python manage_migrations.py db seed --books 5000000 --output - | psql bookshelf
+    """
+    first_ids = {table: 1 for table in SEQUENCES}
+    first_ids["users"] = 0
+    genre_ids = {genre: id for id, genre in enumerate(GENRES, 1)}
+    tables = [("genres", ("id", "key", "name"), ((id, genre, capwords(genre)) for genre, id in genre_ids.items()))]
+    tables += _tables(seed, books, authors, users, shelf_books, first_ids, genre_ids)
+    for table, columns, rows in tables:
+        out.write(f"COPY public.{table} ({', '.join(columns)}) FROM stdin;\n")
+        for row in rows:
+            out.write(_copy_line(row))
+        out.write("\\.\n\n")
+
+    for table in SEQUENCES + ["genres"]:
+        out.write(
+            f"SELECT setval(pg_get_serial_sequence('public.{table}', 'id'), (SELECT MAX(id) FROM public.{table}));\n")
+    out.write(REFRESH_AUTHOR_STATS)
+    out.write(REFRESH_POPULARITY)
@@ -0,0 +1,105 @@
+"""
+    Per-worker cache of the users' shelf summaries (id, name and number of books) served by GET /shelves.
+    The shelf handlers update the cached summaries in place instead of dropping them,
+    the ttl bounds how long the writes handled by other workers can be missed.
+"""
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from constants import SHELF_CACHE_MAX_USERS, SHELF_CACHE_TTL
+
+
+class ShelfSummaryCache():
+    """ LRU of user id to the user shelves, each entry is a dictionary of shelf id (not user based) to summary """
+
+    def __init__(self, max_users=SHELF_CACHE_MAX_USERS, ttl=SHELF_CACHE_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        # bumped by every write, shelves loaded during a write aren't stored
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: str, load):
+        """ Returns the summaries of the user shelves ordered by id
+            load : function that returns a dictionary of shelf id to summary ordered by the summary id
+            the returned summaries are shared, they must not be modified
+        """
+        with self._lock:
+            generation = self._generation
+            entry = self._entries.get(user_id)
+            if entry and entry[1] > time.time():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return list(entry[0].values())
+        self.misses += 1
+
+        shelves = load()
+        with self._lock:
+            if generation == self._generation:
+                self._entries[user_id] = (shelves, time.time() + self.ttl)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+        return list(shelves.values())
+
+    def _update(self, user_id: str, update):
+        with self._lock:
+            self._generation += 1
+            entry = self._entries.get(user_id)
+            if entry:
+                update(entry[0])
+
+    def add_shelf(self, user_id: str, shelf_id: int, summary: dict):
+        # new shelves get the next user based id so they go last
+        self._update(user_id, lambda shelves: shelves.__setitem__(shelf_id, summary))
+
+    def rename_shelf(self, user_id: str, shelf_id: int, name: str):
+        def rename(shelves):
+            if shelf_id in shelves:
+                shelves[shelf_id] = dict(shelves[shelf_id], name=name)
+        self._update(user_id, rename)
+
+    def remove_shelf(self, user_id: str, shelf_id: int):
+        self._update(user_id, lambda shelves: shelves.pop(shelf_id, None))
+
+    def add_books(self, user_id: str, shelf_id: int, count: int):
+        """ Adds count (negative to remove) to the number of books of the shelf """
+        def add(shelves):
+            if shelf_id in shelves:
+                shelf = shelves[shelf_id]
+                shelves[shelf_id] = dict(shelf, total_books=shelf["total_books"] + count)
+        self._update(user_id, add)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / requests if requests else 0,
+            "worker": os.getpid()
+        }
+
+
+shelf_summaries = ShelfSummaryCache()
+
+
+def setup_shelf_cache(app):
+    """
+        binds a flask application and the shelf summary cache
+    """
+    shelf_summaries.clear()
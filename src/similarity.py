@@ -0,0 +1,114 @@
+"""
+    Offline builder of the similar books index served by GET /books/<id>/similar (see manage_migrations.py db build_similarity).
+    Books are compared with the cosine similarity of their genres and of the users that store them (co-shelving),
+    computed with sparse matrix products a block of books at a time, and only the top SIMILAR_BOOKS neighbors are stored.
+"""
+import numpy as np
+from scipy import sparse
+from models import db, SimilarBook
+from seed import RowStream
+from constants import SIMILAR_BOOKS, SIMILARITY_GENRE_WEIGHT, SIMILARITY_BLOCK_SCORES
+
+
+def _normalized_matrix(rows, columns, shape):
+    """ Returns the binary csr matrix with ones at (rows, columns) with every row scaled to unit length """
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=shape)
+    # duplicated pairs are summed by the constructor
+    matrix.data[:] = 1
+    lengths = np.sqrt(np.asarray(matrix.sum(axis=1)).ravel())
+    lengths[lengths == 0] = 1
+    return sparse.diags((1 / lengths).astype(np.float32)) @ matrix
+
+
+def _load_matrices():
+    """ Returns (book ids, book x genre matrix, book x user matrix), the matrix rows follow the sorted book ids """
+    connection = db.session.connection()
+    book_ids = np.array([row[0] for row in connection.execute("SELECT id FROM books ORDER BY id")], dtype=np.int64)
+
+    pairs = np.array(connection.execute("SELECT book_id, genre_id FROM book_genres").fetchall(),
+                     dtype=np.int64).reshape(-1, 2)
+    genres, genre_columns = np.unique(pairs[:, 1], return_inverse=True)
+    genre_matrix = _normalized_matrix(np.searchsorted(book_ids, pairs[:, 0]), genre_columns,
+                                      (len(book_ids), len(genres)))
+
+    stored = connection.execute("SELECT user_id, book_id FROM stored_books").fetchall()
+    users, user_columns = np.unique(np.array([row[0] for row in stored], dtype=object).astype(str),
+                                    return_inverse=True)
+    user_matrix = _normalized_matrix(np.searchsorted(book_ids, np.array([row[1] for row in stored], dtype=np.int64)),
+                                     user_columns, (len(book_ids), len(users)))
+    return book_ids, genre_matrix, user_matrix
+
+
+def _neighbors(book_ids, genre_matrix, user_matrix, rows, k=SIMILAR_BOOKS, genre_weight=SIMILARITY_GENRE_WEIGHT):
+    """ Yields the similar_books rows (book_id, rank, similar_id, score) of the books at the given matrix rows """
+    # there are few genres so the genre products are mostly dense, a dense matrix uses the faster blas products
+    if genre_matrix.shape[0] * genre_matrix.shape[1] <= SIMILARITY_BLOCK_SCORES:
+        genre_matrix = genre_matrix.toarray()
+    genre_t = genre_matrix.T.copy() if isinstance(genre_matrix, np.ndarray) else genre_matrix.T.tocsr()
+    user_t = user_matrix.T.tocsr()
+    # the scores of a block are a dense (block x books) array
+    block_size = max(1, SIMILARITY_BLOCK_SCORES // max(1, len(book_ids)))
+    for start in range(0, len(rows), block_size):
+        block = rows[start: start + block_size]
+        scores = genre_matrix[block] @ genre_t
+        scores = genre_weight * (scores if isinstance(scores, np.ndarray) else scores.toarray())
+        scores += ((1 - genre_weight) * (user_matrix[block] @ user_t)).toarray()
+        # a book isn't similar to itself
+        scores[np.arange(len(block)), block] = 0
+
+        if len(book_ids) > k:
+            top = np.argpartition(-scores, k, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(len(book_ids)), (len(block), 1))
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        # highest score first, ties go to the lowest book id
+        order = np.lexsort((top, -top_scores), axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        for row, neighbors, neighbor_scores in zip(block, top, top_scores):
+            similar = neighbor_scores > 0
+            neighbors, neighbor_scores = neighbors[similar], neighbor_scores[similar]
+            for rank, (neighbor, score) in enumerate(zip(neighbors, neighbor_scores)):
+                yield int(book_ids[row]), rank, int(book_ids[neighbor]), round(float(score), 6)
+
+
+def _with_neighbors(books: set):
+    """ Returns the given books with their stored neighbors and the books whose neighbors they are,
+        their scores with the given books changed with them
+    """
+    if not books:
+        return books
+    neighbors = db.session.query(SimilarBook.similar_id).filter(SimilarBook.book_id.in_(books)).union(
+        db.session.query(SimilarBook.book_id).filter(SimilarBook.similar_id.in_(books)))
+    return books | {id for id, in neighbors}
+
+
+def build_similarity(books: set = None, log=print):
+    """ Computes the similar books of the given book ids (every book when None) and replaces their stored neighbors
+        in one transaction, the readers see the previous neighbors until it's committed
+        Returns: the number of books whose neighbors were computed
+    """
+    log("loading the genres and stored books")
+    book_ids, genre_matrix, user_matrix = _load_matrices()
+    if books is None:
+        rows = np.arange(len(book_ids))
+        db.session.query(SimilarBook).delete(synchronize_session=False)
+    else:
+        ids = np.array(sorted(_with_neighbors(books)), dtype=np.int64)
+        # the deleted books are removed from the neighbors by the foreign keys
+        rows = np.searchsorted(book_ids, ids)
+        rows = rows[rows < len(book_ids)]
+        rows = rows[np.isin(book_ids[rows], ids)]
+        if len(rows):
+            db.session.query(SimilarBook).filter(SimilarBook.book_id.in_(book_ids[rows].tolist())).delete(
+                synchronize_session=False)
+
+    log(f"computing the neighbors of {len(rows)} books")
+    if len(rows):
+        # the rows are streamed to COPY as they are computed
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(f"COPY {SimilarBook.__tablename__} (book_id, rank, similar_id, score) FROM STDIN",
+                           RowStream(_neighbors(book_ids, genre_matrix, user_matrix, rows)))
+    db.session.commit()
+    return len(rows)
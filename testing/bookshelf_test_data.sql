@@ -28,7 +28,10 @@ CREATE TABLE public.authors (
     id integer NOT NULL,
     name character varying NOT NULL,
     description character varying NOT NULL,
-    birthday date NOT NULL
+    birthday date NOT NULL,
+    total_books integer DEFAULT 0 NOT NULL,
+    version integer DEFAULT 1 NOT NULL,
+    updated_at timestamp without time zone DEFAULT (now() AT TIME ZONE 'utc'::text) NOT NULL
 );
 
 
@@ -56,18 +59,65 @@ ALTER TABLE public.authors_id_seq OWNER TO yamen;
 ALTER SEQUENCE public.authors_id_seq OWNED BY public.authors.id;
 
 
+--
+-- Name: author_genres; Type: TABLE; Schema: public; Owner: yamen
+--
+
+CREATE TABLE public.author_genres (
+    author_id integer NOT NULL,
+    genre_id integer NOT NULL,
+    total_books integer NOT NULL
+);
+
+
+ALTER TABLE public.author_genres OWNER TO yamen;
+
 --
 -- Name: book_genres; Type: TABLE; Schema: public; Owner: yamen
 --
 
 CREATE TABLE public.book_genres (
     book_id integer NOT NULL,
-    genre character varying NOT NULL
+    genre_id integer NOT NULL
 );
 
 
 ALTER TABLE public.book_genres OWNER TO yamen;
 
+--
+-- Name: genres; Type: TABLE; Schema: public; Owner: yamen
+--
+
+CREATE TABLE public.genres (
+    id integer NOT NULL,
+    key character varying NOT NULL,
+    name character varying NOT NULL
+);
+
+
+ALTER TABLE public.genres OWNER TO yamen;
+
+--
+-- Name: genres_id_seq; Type: SEQUENCE; Schema: public; Owner: yamen
+--
+
+CREATE SEQUENCE public.genres_id_seq
+    AS integer
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+ALTER TABLE public.genres_id_seq OWNER TO yamen;
+
+--
+-- Name: genres_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: yamen
+--
+
+ALTER SEQUENCE public.genres_id_seq OWNED BY public.genres.id;
+
 --
 -- Name: books; Type: TABLE; Schema: public; Owner: yamen
 --
@@ -78,7 +128,11 @@ CREATE TABLE public.books (
     description character varying NOT NULL,
     author_id integer NOT NULL,
     pages integer NOT NULL,
-    year integer NOT NULL
+    year integer NOT NULL,
+    popularity integer DEFAULT 0 NOT NULL,
+    shelved_transaction_id bigint,
+    version integer DEFAULT 1 NOT NULL,
+    updated_at timestamp without time zone DEFAULT (now() AT TIME ZONE 'utc'::text) NOT NULL
 );
 
 
@@ -114,7 +168,9 @@ CREATE TABLE public.shelves (
     id integer NOT NULL,
     user_id character varying,
     user_based_id integer,
-    name character varying
+    name character varying,
+    version integer DEFAULT 1 NOT NULL,
+    updated_at timestamp without time zone DEFAULT (now() AT TIME ZONE 'utc'::text) NOT NULL
 );
 
 
@@ -183,6 +239,13 @@ ALTER TABLE ONLY public.authors ALTER COLUMN id SET DEFAULT nextval('public.auth
 ALTER TABLE ONLY public.books ALTER COLUMN id SET DEFAULT nextval('public.books_id_seq'::regclass);
 
 
+--
+-- Name: genres id; Type: DEFAULT; Schema: public; Owner: yamen
+--
+
+ALTER TABLE ONLY public.genres ALTER COLUMN id SET DEFAULT nextval('public.genres_id_seq'::regclass);
+
+
 --
 -- Name: shelves id; Type: DEFAULT; Schema: public; Owner: yamen
 --
@@ -194,9 +257,23 @@ ALTER TABLE ONLY public.shelves ALTER COLUMN id SET DEFAULT nextval('public.shel
 -- Data for Name: authors; Type: TABLE DATA; Schema: public; Owner: yamen
 --
 
-COPY public.authors (id, name, description, birthday) FROM stdin;
-2	J.K. Rowling	Although she writes under the pen name J.K. Rowling, pronounced like rolling, her name when her first Harry Potter book was published was simply Joanne Rowling. Anticipating that the target audience of young boys might not want to read a book written by a woman, her publishers demanded that she use two initials, rather than her full name. As she had no middle name, she chose K as the second initial of her pen name, from her paternal grandmother Kathleen Ada Bulgen Rowling. She calls herself Jo and has said, "No one ever called me 'Joanne' when I was young, unless they were angry." Following her marriage, she has sometimes used the name Joanne Murray when conducting personal business. During the Leveson Inquiry she gave evidence under the name of Joanne Kathleen Rowling. In a 2012 interview, Rowling noted that she no longer cared that people pronounced her name incorrectly.	1965-07-31
-4	Adam Savage	Adam Whitney Savage is an American industrial design and special effects designer/fabricator, actor, educator, and co-host of the Discovery Channel television series MythBusters.	1967-07-15
+COPY public.authors (id, name, description, birthday, total_books) FROM stdin;
+2	J.K. Rowling	Although she writes under the pen name J.K. Rowling, pronounced like rolling, her name when her first Harry Potter book was published was simply Joanne Rowling. Anticipating that the target audience of young boys might not want to read a book written by a woman, her publishers demanded that she use two initials, rather than her full name. As she had no middle name, she chose K as the second initial of her pen name, from her paternal grandmother Kathleen Ada Bulgen Rowling. She calls herself Jo and has said, "No one ever called me 'Joanne' when I was young, unless they were angry." Following her marriage, she has sometimes used the name Joanne Murray when conducting personal business. During the Leveson Inquiry she gave evidence under the name of Joanne Kathleen Rowling. In a 2012 interview, Rowling noted that she no longer cared that people pronounced her name incorrectly.	1965-07-31	3
+4	Adam Savage	Adam Whitney Savage is an American industrial design and special effects designer/fabricator, actor, educator, and co-host of the Discovery Channel television series MythBusters.	1967-07-15	1
+\.
+
+
+--
+-- Data for Name: author_genres; Type: TABLE DATA; Schema: public; Owner: yamen
+--
+
+COPY public.author_genres (author_id, genre_id, total_books) FROM stdin;
+2	1	3
+2	2	3
+2	3	3
+2	4	3
+4	5	1
+4	6	1
 \.
 
 
@@ -204,21 +281,35 @@ COPY public.authors (id, name, description, birthday) FROM stdin;
 -- Data for Name: book_genres; Type: TABLE DATA; Schema: public; Owner: yamen
 --
 
-COPY public.book_genres (book_id, genre) FROM stdin;
-1	Fantasy
-1	Fiction
-1	Magic
-1	Young Adult
-2	Fantasy
-2	Fiction
-2	Magic
-2	Young Adult
-4	Fantasy
-4	Fiction
-4	Magic
-4	Young Adult
-5	Nonfiction
-5	Biography
+COPY public.book_genres (book_id, genre_id) FROM stdin;
+1	1
+1	2
+1	3
+1	4
+2	1
+2	2
+2	3
+2	4
+4	1
+4	2
+4	3
+4	4
+5	5
+5	6
+\.
+
+
+--
+-- Data for Name: genres; Type: TABLE DATA; Schema: public; Owner: yamen
+--
+
+COPY public.genres (id, key, name) FROM stdin;
+1	fantasy	Fantasy
+2	fiction	Fiction
+3	magic	Magic
+4	young adult	Young Adult
+5	nonfiction	Nonfiction
+6	biography	Biography
 \.
 
 
@@ -226,11 +317,11 @@ COPY public.book_genres (book_id, genre) FROM stdin;
 -- Data for Name: books; Type: TABLE DATA; Schema: public; Owner: yamen
 --
 
-COPY public.books (id, title, description, author_id, pages, year) FROM stdin;
-1	Harry Potter and the Sorcerer's Stone	Harry Potter's life is miserable. His parents are dead and he's stuck with his heartless relatives, who force him to live in a tiny closet under the stairs. But his fortune changes when he receives a letter that tells him the truth about himself: he's a wizard. A mysterious visitor rescues him from his relatives and takes him to his new home, Hogwarts School of Witchcraft and Wizardry.	2	309	1997
-2	Harry Potter and the Chamber of Secrets	Ever since Harry Potter had come home for the summer, the Dursleys had been so mean and hideous that all Harry wanted was to get back to the Hogwarts School for Witchcraft and Wizardry. But just as he’s packing his bags, Harry receives a warning from a strange impish creature who says that if Harry returns to Hogwarts, disaster will strike.	2	341	1998
-4	Harry Potter And The Prisoner Of Azkaban	For twelve long years, the dread fortress of Azkaban held an infamous prisoner named Sirius Black. Convicted of killing thirteen people with a single curse, he was said to be the heir apparent to the Dark Lord, Voldemort.	2	435	1999
-5	Every Tool's a Hammer: Life Is What You Make It	n this New York Times bestselling “imperative how-to for creativity” (Nick Offerman), Adam Savage—star of Discovery Channel’s Mythbusters—shares his golden rules of creativity, from finding inspiration to following through and successfully making your idea a reality.	4	320	2019
+COPY public.books (id, title, description, author_id, pages, year, popularity) FROM stdin;
+1	Harry Potter and the Sorcerer's Stone	Harry Potter's life is miserable. His parents are dead and he's stuck with his heartless relatives, who force him to live in a tiny closet under the stairs. But his fortune changes when he receives a letter that tells him the truth about himself: he's a wizard. A mysterious visitor rescues him from his relatives and takes him to his new home, Hogwarts School of Witchcraft and Wizardry.	2	309	1997	0
+2	Harry Potter and the Chamber of Secrets	Ever since Harry Potter had come home for the summer, the Dursleys had been so mean and hideous that all Harry wanted was to get back to the Hogwarts School for Witchcraft and Wizardry. But just as he’s packing his bags, Harry receives a warning from a strange impish creature who says that if Harry returns to Hogwarts, disaster will strike.	2	341	1998	1
+4	Harry Potter And The Prisoner Of Azkaban	For twelve long years, the dread fortress of Azkaban held an infamous prisoner named Sirius Black. Convicted of killing thirteen people with a single curse, he was said to be the heir apparent to the Dark Lord, Voldemort.	2	435	1999	0
+5	Every Tool's a Hammer: Life Is What You Make It	n this New York Times bestselling “imperative how-to for creativity” (Nick Offerman), Adam Savage—star of Discovery Channel’s Mythbusters—shares his golden rules of creativity, from finding inspiration to following through and successfully making your idea a reality.	4	320	2019	0
 \.
 
 
@@ -271,6 +362,13 @@ SELECT pg_catalog.setval('public.authors_id_seq', 4, true);
 SELECT pg_catalog.setval('public.books_id_seq', 5, true);
 
 
+--
+-- Name: genres_id_seq; Type: SEQUENCE SET; Schema: public; Owner: yamen
+--
+
+SELECT pg_catalog.setval('public.genres_id_seq', 6, true);
+
+
 --
 -- Name: shelves_id_seq; Type: SEQUENCE SET; Schema: public; Owner: yamen
 --
@@ -293,12 +391,20 @@ ALTER TABLE ONLY public.authors
     ADD CONSTRAINT authors_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: author_genres author_genres_pkey; Type: CONSTRAINT; Schema: public; Owner: yamen
+--
+
+ALTER TABLE ONLY public.author_genres
+    ADD CONSTRAINT author_genres_pkey PRIMARY KEY (author_id, genre_id);
+
+
 --
 -- Name: book_genres book_genres_pkey; Type: CONSTRAINT; Schema: public; Owner: yamen
 --
 
 ALTER TABLE ONLY public.book_genres
-    ADD CONSTRAINT book_genres_pkey PRIMARY KEY (book_id, genre);
+    ADD CONSTRAINT book_genres_pkey PRIMARY KEY (book_id, genre_id);
 
 
 --
@@ -309,6 +415,22 @@ ALTER TABLE ONLY public.books
     ADD CONSTRAINT books_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: genres genres_pkey; Type: CONSTRAINT; Schema: public; Owner: yamen
+--
+
+ALTER TABLE ONLY public.genres
+    ADD CONSTRAINT genres_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: genres genres_key_key; Type: CONSTRAINT; Schema: public; Owner: yamen
+--
+
+ALTER TABLE ONLY public.genres
+    ADD CONSTRAINT genres_key_key UNIQUE (key);
+
+
 --
 -- Name: shelves shelves_pkey; Type: CONSTRAINT; Schema: public; Owner: yamen
 --
@@ -325,6 +447,71 @@ ALTER TABLE ONLY public.stored_books
     ADD CONSTRAINT stored_books_pkey PRIMARY KEY (user_id, book_id);
 
 
+--
+-- Name: ix_book_genres_genre_id; Type: INDEX; Schema: public; Owner: yamen
+--
+
+CREATE INDEX ix_book_genres_genre_id ON public.book_genres USING btree (genre_id, book_id);
+
+
+--
+-- Name: ix_authors_versions; Type: INDEX; Schema: public; Owner: yamen
+--
+
+CREATE INDEX ix_authors_versions ON public.authors USING btree (id, version, updated_at);
+
+
+--
+-- Name: ix_books_versions; Type: INDEX; Schema: public; Owner: yamen
+--
+
+CREATE INDEX ix_books_versions ON public.books USING btree (id, version, updated_at);
+
+
+--
+-- Name: ix_books_popularity; Type: INDEX; Schema: public; Owner: yamen
+--
+
+CREATE INDEX ix_books_popularity ON public.books USING btree (popularity, id);
+
+
+--
+-- Name: ix_books_title; Type: INDEX; Schema: public; Owner: yamen
+--
+
+CREATE INDEX ix_books_title ON public.books USING btree (title, id);
+
+
+--
+-- Name: ix_books_year; Type: INDEX; Schema: public; Owner: yamen
+--
+
+CREATE INDEX ix_books_year ON public.books USING btree (year, id);
+
+
+--
+-- Name: ix_books_author_id; Type: INDEX; Schema: public; Owner: yamen
+--
+
+CREATE INDEX ix_books_author_id ON public.books USING btree (author_id, id);
+
+
+--
+-- Name: author_genres author_genres_author_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: yamen
+--
+
+ALTER TABLE ONLY public.author_genres
+    ADD CONSTRAINT author_genres_author_id_fkey FOREIGN KEY (author_id) REFERENCES public.authors(id);
+
+
+--
+-- Name: author_genres author_genres_genre_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: yamen
+--
+
+ALTER TABLE ONLY public.author_genres
+    ADD CONSTRAINT author_genres_genre_id_fkey FOREIGN KEY (genre_id) REFERENCES public.genres(id);
+
+
 --
 -- Name: book_genres book_genres_book_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: yamen
 --
@@ -333,6 +520,14 @@ ALTER TABLE ONLY public.book_genres
     ADD CONSTRAINT book_genres_book_id_fkey FOREIGN KEY (book_id) REFERENCES public.books(id);
 
 
+--
+-- Name: book_genres book_genres_genre_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: yamen
+--
+
+ALTER TABLE ONLY public.book_genres
+    ADD CONSTRAINT book_genres_genre_id_fkey FOREIGN KEY (genre_id) REFERENCES public.genres(id);
+
+
 --
 -- Name: books books_author_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: yamen
 --
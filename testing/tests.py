@@ -1,12 +1,18 @@
 import os
 import unittest
 import json
+import time
+import tempfile
+from urllib.parse import urlparse, parse_qs
 from flask_sqlalchemy import SQLAlchemy
 
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..","src")))
 from app import create_app
 from models import *
+from constants import AUTH_PROVIDER, LOCAL_ISSUER_KEY_PATH, CATALOG_SYNC_INTERVAL, DB_STATEMENT_TIMEOUT, DB_READ_STATEMENT_TIMEOUT
+from local_issuer import mint_token
+from admission import admission, rate_limiter, RouteClass
 
 # Load variables from .env file
 from dotenv import load_dotenv
@@ -37,10 +43,18 @@ class TriviaTestCase(unittest.TestCase):
             self.db.create_all()
 
         # Get jwt tokens
+        manager_jwt = os.getenv("MANAGER_JWT")
+        librarian_jwt = os.getenv("LIBRARIAN_JWT")
+        if AUTH_PROVIDER == "local":
+            # mint the tokens with the local issuer, the librarian owns shelves in the test data
+            manager_jwt = manager_jwt or mint_token("local|manager", [
+                "post:books", "patch:books", "delete:books", "post:authors", "patch:authors", "delete:authors", "read:stats"])
+            librarian_jwt = librarian_jwt or mint_token("local|620b83abb4d1ca006829c19e", [
+                "post:books", "patch:books", "post:authors", "patch:authors"])
         self.manager_auth_header = {
-            "Authorization": "Bearer " + os.getenv("MANAGER_JWT")}
+            "Authorization": "Bearer " + manager_jwt}
         self.librarian_auth_header = {
-            "Authorization": "Bearer " + os.getenv("LIBRARIAN_JWT")}
+            "Authorization": "Bearer " + librarian_jwt}
 
         # Data for a test book to send to the api
         self.added_book_id = None
@@ -121,6 +135,11 @@ class TriviaTestCase(unittest.TestCase):
             print(err)
             pass
 
+        # every test creates an app, close the connections of its pool
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+
     # region Books
 
     #GET /books
@@ -132,6 +151,50 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data["total"])
         self.assertTrue(len(data["books"]))
 
+    def test_lookup_books(self):
+        res = self.client().get("/books?ids=4,10000,1,4")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual([book["id"] for book in data["books"]], [4, 1])
+        self.assertEqual(data["missing"], [10000])
+        self.assertTrue(data["books"][0]["description"])
+        self.assertTrue(data["books"][0]["author"]["name"])
+
+    def test_422_lookup_books(self):
+        res = self.client().get("/books?ids=1,two")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+
+    def test_get_books_fields(self):
+        res = self.client().get("/books?fields=id,title")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(set(data["books"][0].keys()), {"id", "title"})
+
+    def test_422_get_books_fields(self):
+        res = self.client().get("/books?fields=id,isbn")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+
+    def test_get_books_per_page_without_total(self):
+        res = self.client().get("/books?per_page=2&page=2&include_total=false")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(len(data["books"]), 2)
+        self.assertNotIn("total", data)
+
+    def test_get_books_estimated_total(self):
+        res = self.client().get("/books?include_total=estimate")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertIsInstance(data["total"], int)
+
     def test_405_get_books(self):
         res = self.client().delete("/books")
         data = json.loads(res.data)
@@ -177,12 +240,65 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data["book"]["year"])
         self.assertTrue(len(data["book"]["genres"]))
 
+    def test_304_get_book_details(self):
+        res = self.client().get("/books/1")
+        etag = res.headers.get("ETag")
+        self.assertTrue(etag)
+        res = self.client().get("/books/1", headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertFalse(res.data)
+
+        # genre changes bump the book version
+        data = {"genres": ["Fantasy", "Fiction"]}
+        self.client().patch("/books/1", json=data, headers=self.librarian_auth_header)
+        res = self.client().get("/books/1", headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers.get("ETag"), etag)
+
     def test_404_get_book_details(self):
         res = self.client().get("/books/10000")
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data["success"], False)
 
+    # GET /books/<id>/similar
+
+    def test_get_similar_books(self):
+        from similarity import build_similarity
+        with self.app.app_context():
+            build_similarity(log=lambda message: None)
+        try:
+            res = self.client().get("/books/4/similar")
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data["success"], True)
+            ids = [book["id"] for book in data["books"]]
+            # the other books share the genres of the book
+            self.assertIn(1, ids)
+            self.assertNotIn(4, ids)
+            self.assertEqual(data["books"][0], json.loads(self.client().get(f"/books?ids={ids[0]}&fields=id,title,genres,author").data)["books"][0])
+        finally:
+            with self.app.app_context():
+                SimilarBook.query.delete()
+                db.session.commit()
+
+    def test_shelving_marks_books(self):
+        # build_similarity --since finds the books whose co-shelving changed by their last shelving transaction
+        with self.app.app_context():
+            head = Change.head()
+        self.client().post("/shelves/1/books", json={"book_ids": [1]}, headers=self.librarian_auth_header)
+        try:
+            with self.app.app_context():
+                self.assertGreater(Book.query.get(1).shelved_transaction_id, head[0])
+        finally:
+            self.client().delete("/shelves/1/books", json={"book_ids": [1]}, headers=self.librarian_auth_header)
+
+    def test_404_get_similar_books(self):
+        res = self.client().get("/books/10000/similar")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+
     # PATCH /books/<id>
 
     def test_patch_book(self):
@@ -192,6 +308,25 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
 
+    def test_patch_book_invalidates_cache(self):
+        self.client().get("/books/1")
+        res = self.client().get("/books/1")
+        self.assertEqual(res.headers.get("X-Cache"), "HIT")
+        self.client().get("/books/01")
+
+        data = {"pages": 310}
+        res = self.client().patch("/books/1", json=data, headers=self.librarian_auth_header)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get("/books/1")
+        data = json.loads(res.data)
+        self.assertEqual(res.headers.get("X-Cache"), "MISS")
+        self.assertEqual(data["book"]["pages"], 310)
+        # the tags come from the parsed id
+        res = self.client().get("/books/01")
+        self.assertEqual(res.headers.get("X-Cache"), "MISS")
+        self.assertEqual(json.loads(res.data)["book"]["pages"], 310)
+
     def test_422_patch_book(self):
         data = {"year": "year"}
         res = self.client().patch("/books/1", json=data, headers=self.librarian_auth_header)
@@ -199,6 +334,36 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data["success"], False)
 
+    # PATCH /books
+
+    def test_patch_books(self):
+        res = self.client().post("/books", json=self.new_book, headers=self.librarian_auth_header)
+        self.added_book_id = json.loads(res.data)["created"]
+
+        res = self.client().patch("/books", json=[
+            {"id": self.added_book_id, "author_id": "4", "year": 2001, "genres": ["g1", "g4"]},
+            {"id": 10000, "year": 2001},
+            {"id": 1, "author_id": 10000},
+            {"id": self.added_book_id, "year": 2002},
+            {"title": 5}
+        ], headers=self.librarian_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["updated"], 1)
+        self.assertEqual([result["status"] for result in data["results"]], [200, 404, 404, 409, 422])
+
+        book = json.loads(self.client().get(f"/books/{self.added_book_id}").data)["book"]
+        self.assertEqual(book["year"], 2001)
+        self.assertEqual(book["author"]["id"], 4)
+        self.assertEqual(set(book["genres"]), {"G1", "G4"})
+        # the author statistics follow the bulk updates too
+        genres = json.loads(self.client().get("/authors/4?fields=genres").data)["author"]["genres"]
+        self.assertIn("G4", genres)
+
+    def test_400_patch_books(self):
+        res = self.client().patch("/books", json={"id": 1, "year": 2001}, headers=self.librarian_auth_header)
+        self.assertEqual(res.status_code, 400)
+
     # DELETE /books/<id>
 
     def test_delete_book(self):
@@ -223,6 +388,74 @@ class TriviaTestCase(unittest.TestCase):
 
     # endregion
 
+    # region Genres
+
+    # GET /genres
+    def test_get_genres(self):
+        res = self.client().get("/genres")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(len(data["genres"]))
+        self.assertTrue(data["genres"][0]["name"])
+        self.assertTrue(data["genres"][0]["total_books"])
+
+    def test_get_books_genre_facets(self):
+        res = self.client().get("/books?search_term=harry&facets=genres")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        genres = {g["name"]: g["total_books"] for g in data["facets"]["genres"]}
+        self.assertNotIn("Biography", genres)
+        self.assertTrue(genres["Magic"])
+
+    def test_get_books_sorted(self):
+        def get_ids(sort):
+            data = json.loads(self.client().get(f"/books?sort={sort}&fields=id,title,year").data)
+            return data["books"]
+
+        books = get_ids("title")
+        # in the collation of the database
+        with self.app.app_context():
+            titles = [title for title, in db.session.query(Book.title).order_by(Book.title, Book.id).limit(len(books))]
+        self.assertEqual([book["title"] for book in books], titles)
+        books = get_ids("year")
+        self.assertEqual([book["year"] for book in books], sorted((book["year"] for book in books), reverse=True))
+        books = get_ids("recent")
+        self.assertEqual([book["id"] for book in books], sorted((book["id"] for book in books), reverse=True))
+
+        res = self.client().get("/books?sort=pages")
+        self.assertEqual(res.status_code, 422)
+
+    def test_get_books_by_popularity(self):
+        def popularity():
+            with self.app.app_context():
+                return Book.query.get(5).popularity
+
+        before = popularity()
+        self.client().post("/shelves/1/books", json={"book_ids": [5]}, headers=self.librarian_auth_header)
+        try:
+            self.assertEqual(popularity(), before + 1)
+            data = json.loads(self.client().get("/books?sort=popularity&fields=id").data)
+            self.assertEqual(data["books"][0]["id"], 5)
+        finally:
+            self.client().delete("/shelves/1/5", headers=self.librarian_auth_header)
+        self.assertEqual(popularity(), before)
+
+    def test_get_books_by_genre_case_insensitive(self):
+        res = self.client().get("/books?genre=yOUNG adult")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["total"])
+        self.assertTrue(all("Young Adult" in book["genres"] for book in data["books"]))
+
+        res = self.client().get("/books?genre=unknown genre")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["books"], [])
+
+    # endregion
+
     # region Authors
 
     #GET /authors
@@ -279,6 +512,41 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data["author"]["books"]))
         self.assertTrue(len(data["author"]["genres"]))
 
+    def test_304_get_author_details(self):
+        res = self.client().get("/authors/2")
+        last_modified = res.headers.get("Last-Modified")
+        self.assertTrue(last_modified)
+        res = self.client().get("/authors/2", headers={"If-Modified-Since": last_modified})
+        self.assertEqual(res.status_code, 304)
+
+    def test_get_author_details_fields(self):
+        res = self.client().get(f"/authors/2?fields=name,total_books")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(set(data["author"].keys()), {"name", "total_books"})
+        self.assertTrue(data["author"]["total_books"])
+
+    def test_author_stats_follow_book_writes(self):
+        def get_stats(author_id):
+            data = json.loads(self.client().get(f"/authors/{author_id}?fields=genres,total_books").data)
+            return data["author"]["total_books"], data["author"]["genres"]
+
+        total_books, _ = get_stats(2)
+        res = self.client().post("/books", json=self.new_book, headers=self.librarian_auth_header)
+        self.added_book_id = json.loads(res.data)["created"]
+        self.assertEqual(get_stats(2)[0], total_books + 1)
+        self.assertIn("G1", get_stats(2)[1])
+
+        # moving the book moves its genres too
+        self.client().patch(f"/books/{self.added_book_id}", json={"author_id": "4", "genres": ["g1", "g4"]},
+                            headers=self.librarian_auth_header)
+        self.assertEqual(get_stats(2)[0], total_books)
+        self.assertNotIn("G1", get_stats(2)[1])
+        self.assertIn("G1", get_stats(4)[1])
+        self.assertIn("G4", get_stats(4)[1])
+        self.assertNotIn("G2", get_stats(4)[1])
+
     def test_404_get_author_details(self):
         res = self.client().get(f"/authors/10000")
         data = json.loads(res.data)
@@ -303,6 +571,19 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data["success"], False)
 
+    # PATCH /authors
+
+    def test_patch_authors(self):
+        res = self.client().patch("/authors", json=[
+            {"id": 4, "name": "bulk patched name"},
+            {"id": 3, "birthday": "2000 jan,2"}
+        ], headers=self.librarian_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([result["status"] for result in data["results"]], [200, 422])
+        author = json.loads(self.client().get("/authors/4?fields=name").data)["author"]
+        self.assertEqual(author["name"], "bulk patched name")
+
     # DELETE /authors/<id>
 
     def test_409_delete_author(self):
@@ -327,6 +608,411 @@ class TriviaTestCase(unittest.TestCase):
 
     # endregion
 
+    # region Search
+
+    # GET /search
+    def test_search(self):
+        res = self.client().get("/search?q=a&per_page=2")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(len(data["results"]), 2)
+        self.assertEqual(data["total"], sum(data["counts"].values()))
+        self.assertEqual(data["counts"]["authors"], json.loads(self.client().get("/authors?search_term=a").data)["total"])
+        self.assertEqual(data["counts"]["books"], json.loads(self.client().get("/books?search_term=a").data)["total"])
+
+    def test_search_ranking(self):
+        data = json.loads(self.client().get("/search?q=fantasy").data)
+        # the exact genre name comes before the titles that contain it
+        self.assertEqual(data["results"][0]["type"], "genre")
+        self.assertEqual(data["results"][0]["name"], "Fantasy")
+
+    def test_search_wildcards(self):
+        # the like wildcards are matched literally
+        for term in ("%25", "_", "%5C"):
+            data = json.loads(self.client().get(f"/search?q={term}").data)
+            self.assertEqual(data["results"], [])
+            self.assertEqual(data["total"], 0)
+            self.assertEqual(json.loads(self.client().get(f"/books?search_term={term}").data)["total"], 0)
+            self.assertEqual(json.loads(self.client().get(f"/authors?search_term={term}").data)["total"], 0)
+
+    def test_400_search(self):
+        res = self.client().get("/search")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    # endregion
+
+    # region Autocomplete
+
+    # GET /autocomplete
+    def test_autocomplete(self):
+        res = self.client().get("/autocomplete?q=harry%20potter%20and%20the")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual({s["id"] for s in data["suggestions"]}, {1, 2, 4})
+
+        # word prefixes and author names
+        data = json.loads(self.client().get("/autocomplete?q=SAV").data)
+        self.assertEqual(data["suggestions"], [{"type": "author", "id": 4, "name": "Adam Savage"}])
+
+        # the like wildcards are matched literally
+        data = json.loads(self.client().get("/autocomplete?q=%25").data)
+        self.assertEqual(data["suggestions"], [])
+
+    def test_autocomplete_follows_writes(self):
+        res = self.client().post("/books", json=self.new_book, headers=self.librarian_auth_header)
+        self.added_book_id = json.loads(res.data)["created"]
+        data = json.loads(self.client().get("/autocomplete?q=test book").data)
+        self.assertIn(self.added_book_id, [s["id"] for s in data["suggestions"] if s["type"] == "book"])
+
+        self.client().patch(f"/books/{self.added_book_id}", json={"title": "renamed book"},
+                            headers=self.librarian_auth_header)
+        data = json.loads(self.client().get("/autocomplete?q=test book").data)
+        self.assertEqual(data["suggestions"], [])
+        data = json.loads(self.client().get("/autocomplete?q=renamed").data)
+        self.assertEqual(data["suggestions"], [{"type": "book", "id": self.added_book_id, "name": "renamed book"}])
+
+    def test_autocomplete_follows_change_log(self):
+        from sqlalchemy import create_engine
+        from catalog_cache import catalog_sync
+        from autocomplete import autocomplete_index
+
+        # another worker writes through its own connection, only the change log tells this worker
+        def write_from_other_worker(name):
+            with create_engine(self.database_path).begin() as connection:
+                connection.execute("UPDATE authors SET name = %s WHERE id = 4", name)
+                connection.execute("INSERT INTO changes (entity, entity_id, operation) VALUES ('author', 4, 'upsert')")
+
+        catalog_sync.interval = 0
+        # the changes are patched into the sorted arrays right away
+        autocomplete_index.PATCH_EVERY = 1
+        try:
+            self.client().get("/autocomplete?q=sav")
+            write_from_other_worker("Zora Quillfeather")
+            data = json.loads(self.client().get("/autocomplete?q=quill").data)
+            self.assertEqual(data["suggestions"], [{"type": "author", "id": 4, "name": "Zora Quillfeather"}])
+            data = json.loads(self.client().get("/autocomplete?q=sav").data)
+            self.assertEqual(data["suggestions"], [])
+            self.assertEqual(json.loads(self.client().get("/cache/stats", headers=self.manager_auth_header).data)["autocomplete"]["pending"], 0)
+        finally:
+            write_from_other_worker("Adam Savage")
+            self.client().get("/autocomplete?q=sav")
+            del autocomplete_index.PATCH_EVERY
+            catalog_sync.interval = CATALOG_SYNC_INTERVAL
+
+    def test_422_autocomplete(self):
+        res = self.client().get("/autocomplete?q=%20")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+
+    # endregion
+
+    # region Changes
+
+    # GET /changes
+    def test_get_changes(self):
+        # the end of the feed however long the change log already is
+        with self.app.app_context():
+            token = Change.make_token(*Change.head())
+
+        res = self.client().post("/books", json=self.new_book,
+                                 headers=self.librarian_auth_header)
+        self.added_book_id = json.loads(res.data)["created"]
+        res = self.client().delete(
+            f"/books/{self.book_to_delete_id}", headers=self.manager_auth_header)
+
+        res = self.client().get(f"/changes?since={token}")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        changes = [(c["type"], c["id"], c["operation"]) for c in data["changes"]]
+        self.assertIn(("book", self.added_book_id, "upsert"), changes)
+        self.assertIn(("book", self.book_to_delete_id, "delete"), changes)
+        self.assertNotEqual(data["next"], token)
+
+    def test_422_get_changes(self):
+        res = self.client().get("/changes?since=token")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+
+    # endregion
+
+    # region Stats
+
+    def test_get_cache_stats(self):
+        before = json.loads(self.client().get("/cache/stats", headers=self.manager_auth_header).data)["cache"]
+        self.client().get("/authors?search_term=savage&page=1")
+        self.client().get("/authors?search_term=savage&page=01")
+        res = self.client().get("/cache/stats", headers=self.manager_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["cache"]["hits"] - before["hits"], 1)
+        self.assertEqual(data["cache"]["misses"] - before["misses"], 1)
+
+    def test_stats_require_permission(self):
+        for route in ("/cache/stats", "/pool/stats", "/admission/stats"):
+            self.assertEqual(self.client().get(route).status_code, 401)
+            self.assertEqual(self.client().get(route, headers=self.librarian_auth_header).status_code, 403)
+            self.assertEqual(self.client().get(route, headers=self.manager_auth_header).status_code, 200)
+
+    def test_sqlite_cache_backend(self):
+        from cache import SQLiteBackend
+        with tempfile.TemporaryDirectory() as directory:
+            backend = SQLiteBackend(os.path.join(directory, "cache", "cache.sqlite"))
+            entry = (b'{"success": true}', 200, "application/json", {"books": 1})
+            backend.set("/books?", entry, 60)
+            self.assertEqual(backend.get("/books?"), entry)
+            self.assertEqual(os.stat(os.path.join(directory, "cache")).st_mode & 0o777, 0o700)
+
+    # endregion
+
+    # region Admission
+    def test_503_route_class_full(self):
+        catalog = admission.classes["catalog"]
+        admission.classes["catalog"] = RouteClass(1, 0)
+        try:
+            # the only slot is taken and nothing can wait for it
+            admission.classes["catalog"].acquire()
+            res = self.client().get("/books/1/similar")
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(res.headers["Retry-After"], "1")
+            # the other route classes aren't affected
+            self.assertEqual(self.client().get("/shelves", headers=self.librarian_auth_header).status_code, 200)
+
+            admission.classes["catalog"].release()
+            self.assertEqual(self.client().get("/books/1/similar").status_code, 200)
+            data = json.loads(self.client().get("/admission/stats", headers=self.manager_auth_header).data)
+            self.assertEqual(data["admission"]["classes"]["catalog"]["shed"], 1)
+            self.assertEqual(data["admission"]["classes"]["catalog"]["active"], 0)
+        finally:
+            admission.classes["catalog"] = catalog
+
+    def test_429_rate_limit(self):
+        rate, burst = rate_limiter.rate, rate_limiter.burst
+        rate_limiter.rate, rate_limiter.burst = 0.5, 2
+        header = {"Authorization": "Bearer " + mint_token("local|rate-limited-user", [])}
+        try:
+            self.assertEqual(self.client().get("/user", headers=header).status_code, 200)
+            self.assertEqual(self.client().get("/user", headers=header).status_code, 200)
+            res = self.client().get("/user", headers=header)
+            self.assertEqual(res.status_code, 429)
+            self.assertEqual(res.headers["Retry-After"], "2")
+            # other users have their own bucket
+            self.assertEqual(self.client().get("/user", headers=self.librarian_auth_header).status_code, 200)
+        finally:
+            rate_limiter.rate, rate_limiter.burst = rate, burst
+
+    # endregion
+
+    # region Pool
+    def test_pool_stats(self):
+        res = self.client().get("/pool/stats", headers=self.manager_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["pool"]["checked_out"], 0)
+        self.assertGreater(data["pool"]["checkouts"], 0)
+        self.assertEqual(data["pool"]["timeouts"], 0)
+
+    def test_statement_timeouts(self):
+        def get_timeout(**kwargs):
+            with self.app.test_request_context("/", **kwargs):
+                timeout = db.session.execute("SHOW statement_timeout").scalar()
+                db.session.remove()
+            return timeout
+
+        # public reads get the shorter timeout
+        self.assertEqual(get_timeout(), f"{DB_READ_STATEMENT_TIMEOUT // 1000}s")
+        self.assertEqual(get_timeout(headers=self.librarian_auth_header), f"{DB_STATEMENT_TIMEOUT // 1000}s")
+        self.assertEqual(get_timeout(method="POST"), f"{DB_STATEMENT_TIMEOUT // 1000}s")
+
+    # endregion
+
+    # region Book cache
+
+    def test_book_cache_follows_change_log(self):
+        from sqlalchemy import create_engine
+        from catalog_cache import catalog_sync
+
+        # another worker writes through its own connection, only the change log tells this worker
+        def write_from_other_worker(name):
+            with create_engine(self.database_path).begin() as connection:
+                connection.execute("UPDATE authors SET name = %s WHERE id = 4", name)
+                connection.execute("INSERT INTO changes (entity, entity_id, operation) VALUES ('author', 4, 'upsert')")
+
+        catalog_sync.interval = 0
+        try:
+            with self.app.test_request_context():
+                catalog_sync.poll()
+                name = Book.get_summaries([5])[0]["author"]["name"]
+                write_from_other_worker("Renamed Author")
+                catalog_sync.poll()
+                self.assertEqual(Book.get_summaries([5])[0]["author"]["name"], "Renamed Author")
+                write_from_other_worker(name)
+        finally:
+            catalog_sync.interval = CATALOG_SYNC_INTERVAL
+
+    def test_response_cache_follows_change_log(self):
+        from sqlalchemy import create_engine
+        from catalog_cache import catalog_sync
+
+        # another worker writes through its own connection, this worker's cache doesn't see the write
+        def write_from_other_worker(title):
+            with create_engine(self.database_path).begin() as connection:
+                connection.execute("UPDATE books SET title = %s, version = version + 1 WHERE id = 5", title)
+                connection.execute("INSERT INTO changes (entity, entity_id, operation) VALUES ('book', 5, 'upsert')")
+
+        title = json.loads(self.client().get("/books/5").data)["book"]["title"]
+        catalog_sync.interval = 0
+        try:
+            self.client().get("/search?q=Cached Title")
+            self.client().get("/books/5")
+            write_from_other_worker("Cached Title")
+            # the detail entry is keyed by the book version even before the change log is read
+            catalog_sync.interval = 3600
+            res = self.client().get("/books/5")
+            self.assertEqual(res.headers.get("X-Cache"), "MISS")
+            self.assertEqual(json.loads(res.data)["book"]["title"], "Cached Title")
+            # the search entry is invalidated from the change log
+            catalog_sync.interval = 0
+            res = self.client().get("/search?q=Cached Title")
+            self.assertEqual(res.headers.get("X-Cache"), "MISS")
+            self.assertIn("Cached Title", [result["name"] for result in json.loads(res.data)["results"]])
+        finally:
+            write_from_other_worker(title)
+            catalog_sync.interval = CATALOG_SYNC_INTERVAL
+
+    def test_cached_book_matches_etag(self):
+        from sqlalchemy import create_engine
+
+        res = self.client().get("/books/4")
+        etag = res.headers.get("ETag")
+        with create_engine(self.database_path).begin() as connection:
+            connection.execute("UPDATE books SET version = version + 1 WHERE id = 4")
+        res = self.client().get("/books/4")
+        self.assertNotEqual(res.headers.get("ETag"), etag)
+        self.assertEqual(res.headers.get("X-Cache"), "MISS")
+        res = self.client().get("/books/4")
+        self.assertEqual(res.headers.get("X-Cache"), "HIT")
+
+    # endregion
+
+    # region Encoding
+
+    def test_response_matches_flask_encoding(self):
+        # the description of book 2 has non-ascii characters
+        for url in ["/books?per_page=50", "/books/2", "/authors/2"]:
+            res = self.client().get(url)
+            expected = json.dumps(json.loads(res.data), sort_keys=True, separators=(",", ":")) + "\n"
+            self.assertEqual(res.data, expected.encode())
+
+    def assert_flask_encoding(self, data):
+        from encoder import dumps
+        with self.app.app_context():
+            self.assertEqual(dumps(data), (json.dumps(data, sort_keys=True, separators=(",", ":")) + "\n").encode())
+
+    def test_encoding_of_small_floats(self):
+        self.assert_flask_encoding({"tiny": 0.00001, "small": [-1.5e-7], "score": -0.5})
+
+    def test_encoding_of_large_floats(self):
+        self.assert_flask_encoding({"large": 1.5e17})
+        self.assert_flask_encoding({"x": 1e16})
+
+    def test_encoding_of_non_finite_floats(self):
+        self.assert_flask_encoding({"r": float("nan")})
+        self.assert_flask_encoding({"r": [float("inf"), None, -float("inf")]})
+
+    def test_encoding_of_float_like_strings(self):
+        from encoder import response_encoder
+        data = {"title": "Free-range e-book", "version": "v 2e-3 x", "tail": "1.5e17", "none": None}
+        self.assert_flask_encoding(data)
+        if response_encoder.backend is not None:
+            # the strings don't make the encoder fall back to flask
+            with self.app.app_context():
+                self.assertIsNotNone(response_encoder.backend.dumps(data))
+                self.assertIsNotNone(response_encoder.backend.dumps({"quoted": 'say "2e-3"', "n": 1}))
+
+    # endregion
+
+    # region Library export
+
+    # GET /user/library/export
+    def test_export_library(self):
+        self.client().post("/shelves/1/books", json={"book_ids": [4, 5]}, headers=self.librarian_auth_header)
+        try:
+            res = self.client().get("/user/library/export", headers=self.librarian_auth_header)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.mimetype, "application/x-ndjson")
+            lines = [json.loads(line) for line in res.data.splitlines()]
+            books = [line["book"] for line in lines if line["shelf"]["id"] == 1]
+            self.assertEqual([book["id"] for book in books], [4, 5])
+            self.assertEqual(books[0], json.loads(self.client().get("/books?ids=4&fields=id,title,genres,author").data)["books"][0])
+            # the empty shelves are exported without books
+            self.assertEqual([line["book"] for line in lines if line["shelf"]["id"] == 3], [None])
+
+            res = self.client().get("/user/library/export?format=csv", headers=self.librarian_auth_header)
+            rows = res.data.decode().splitlines()
+            self.assertEqual(rows[0], "shelf_id,shelf_name,book_id,title,author_id,author_name,genres")
+            self.assertEqual(len(rows), len(lines) + 1)
+        finally:
+            self.client().delete("/shelves/1/books", json={"book_ids": [4, 5]}, headers=self.librarian_auth_header)
+
+    def test_422_export_library(self):
+        res = self.client().get("/user/library/export?format=xml", headers=self.librarian_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+
+    # endregion
+
+    # region Local issuer
+
+    @unittest.skipUnless(AUTH_PROVIDER == "local", "served with BOOKSHELF_API_AUTH_PROVIDER=local")
+    def test_local_issuer_jwks(self):
+        res = self.client().get("/.well-known/jwks.json")
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(key["alg"], key["kty"]) for key in data["keys"]], [("RS256", "RSA")])
+        # the key can only be written by the app user
+        self.assertEqual(os.stat(LOCAL_ISSUER_KEY_PATH).st_mode & 0o077, 0)
+
+    @unittest.skipUnless(AUTH_PROVIDER == "local", "served with BOOKSHELF_API_AUTH_PROVIDER=local")
+    def test_local_issuer_authorize(self):
+        res = self.client().get("/authorize?user=reader&permissions=post:books")
+        location = urlparse(res.headers["Location"])
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(location.path, "/callback")
+
+        res = self.client().post("/oauth/token", data={"grant_type": "authorization_code",
+                                                       "code": parse_qs(location.query)["code"][0]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["token_type"], "Bearer")
+        # the api accepts the token
+        res = self.client().get("/user", headers={"Authorization": "Bearer " + data["access_token"]})
+        self.assertEqual(json.loads(res.data)["user_id"], "reader")
+
+    @unittest.skipUnless(AUTH_PROVIDER == "local", "served with BOOKSHELF_API_AUTH_PROVIDER=local")
+    def test_local_issuer_token(self):
+        res = self.client().post("/oauth/token", json={"grant_type": "client_credentials", "user": "loader"})
+        self.assertEqual(res.status_code, 200)
+        token = json.loads(res.data)["access_token"]
+        res = self.client().get("/user", headers={"Authorization": "Bearer " + token})
+        self.assertEqual(json.loads(res.data)["user_id"], "loader")
+
+        res = self.client().post("/oauth/token", data={"grant_type": "authorization_code", "code": token})
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(json.loads(res.data)["error"], "invalid_grant")
+        res = self.client().post("/oauth/token", data={"grant_type": "password"})
+        self.assertEqual(res.status_code, 400)
+
+    # endregion
+
     # region Shelves
 
     # GET /shelves
@@ -337,7 +1023,23 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertTrue(data["total"])
         self.assertTrue(len(data["shelves"]))
-    
+
+    def test_get_shelves_updates_cached_counts(self):
+        def get_shelf(id):
+            data = json.loads(self.client().get("/shelves", headers=self.librarian_auth_header).data)
+            return next(shelf for shelf in data["shelves"] if shelf["id"] == id)
+
+        total_books = get_shelf(1)["total_books"]
+        misses = json.loads(self.client().get("/cache/stats", headers=self.manager_auth_header).data)["shelf_summaries"]["misses"]
+        self.client().post("/shelves/1", json={"book_id": "4"}, headers=self.librarian_auth_header)
+        try:
+            self.assertEqual(get_shelf(1)["total_books"], total_books + 1)
+        finally:
+            self.client().delete("/shelves/1/4", headers=self.librarian_auth_header)
+        self.assertEqual(get_shelf(1)["total_books"], total_books)
+        # the counts were updated in place, the shelves were never reloaded
+        self.assertEqual(json.loads(self.client().get("/cache/stats", headers=self.manager_auth_header).data)["shelf_summaries"]["misses"], misses)
+
     def test_405_get_shelves(self):
         res = self.client().patch("/shelves", headers=self.librarian_auth_header)
         data = json.loads(res.data)
@@ -387,7 +1089,125 @@ class TriviaTestCase(unittest.TestCase):
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 400)
         self.assertEqual(data["success"], False)
-    
+
+    # /shelves/<id>/books
+    def test_bulk_stored_books(self):
+        def get_counts():
+            data = json.loads(self.client().get("/shelves", headers=self.librarian_auth_header).data)
+            return {shelf["id"]: shelf["total_books"] for shelf in data["shelves"]}
+
+        counts = get_counts()
+        res = self.client().post("/shelves/1/books", json={"book_ids": [1, 5, 10000]}, headers=self.librarian_auth_header)
+        data = json.loads(res.data)
+        try:
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data["added"], [1, 5])
+            self.assertEqual(data["skipped"], [10000])
+
+            data = json.loads(self.client().patch("/shelves/2/books", json={"book_ids": [5, 4]},
+                                                  headers=self.librarian_auth_header).data)
+            self.assertEqual(data["moved"], [5])
+            self.assertEqual(data["skipped"], [4])
+            self.assertEqual(get_counts()[1], counts[1] + 1)
+            self.assertEqual(get_counts()[2], counts[2] + 1)
+        finally:
+            data = json.loads(self.client().delete("/shelves/1/books", json={"book_ids": [1, 5]},
+                                                   headers=self.librarian_auth_header).data)
+            self.client().delete("/shelves/2/5", headers=self.librarian_auth_header)
+        self.assertEqual(data["removed"], [1])
+        self.assertEqual(get_counts(), counts)
+
+    def test_422_bulk_stored_books(self):
+        res = self.client().post("/shelves/1/books", json={"book_ids": []}, headers=self.librarian_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+
+    # PATCH /shelves/<id>/<book_id>
+    def test_move_stored_book(self):
+        self.client().post("/shelves/1", json={"book_id": "4"}, headers=self.librarian_auth_header)
+        try:
+            res = self.client().patch("/shelves/1/4", json={"shelf_id": 3}, headers=self.librarian_auth_header)
+            self.assertEqual(res.status_code, 200)
+            res = self.client().patch("/shelves/1/4", json={"shelf_id": 3}, headers=self.librarian_auth_header)
+            self.assertEqual(res.status_code, 404)
+            data = json.loads(self.client().get("/shelves/3", headers=self.librarian_auth_header).data)
+            self.assertIn(4, [book["id"] for book in data["shelf"]["books"]])
+            # the book is already on a shelf
+            res = self.client().post("/shelves/1", json={"book_id": "4"}, headers=self.librarian_auth_header)
+            self.assertEqual(res.status_code, 409)
+        finally:
+            self.client().delete("/shelves/3/4", headers=self.librarian_auth_header)
+
+    # endregion
+
+    # region Jobs
+    def wait_for_job(self, id):
+        for _ in range(100):
+            data = json.loads(self.client().get(f"/jobs/{id}", headers=self.librarian_auth_header).data)
+            if data["job"]["status"] not in ("queued", "running"):
+                return data["job"]
+            time.sleep(0.05)
+        self.fail(f"job {id} didn't finish")
+
+    # POST /shelves/<id>/books?background=true, GET /jobs/<id>
+    def test_background_stored_books(self):
+        res = self.client().post("/shelves/1/books?background=true", json={"book_ids": [1, 5, 10000]},
+                                 headers=self.librarian_auth_header)
+        data = json.loads(res.data)
+        try:
+            self.assertEqual(res.status_code, 202)
+            self.assertTrue(res.headers["Location"].endswith(f"/jobs/{data['job']}"))
+            job = self.wait_for_job(data["job"])
+            self.assertEqual(job["status"], "done")
+            self.assertEqual(job["processed"], 3)
+            self.assertEqual(job["counts"], {"added": 2, "skipped": 1})
+
+            data = json.loads(self.client().get("/shelves/1", headers=self.librarian_auth_header).data)
+            self.assertTrue({1, 5} <= {book["id"] for book in data["shelf"]["books"]})
+        finally:
+            self.client().delete("/shelves/1/books", json={"book_ids": [1, 5]}, headers=self.librarian_auth_header)
+
+    def test_failing_job(self):
+        from jobs import job_runner
+
+        def fail(job):
+            raise RuntimeError("finish failed")
+
+        run_batch, finish = job_runner.handlers["stored_books"]
+        job_runner.handlers["stored_books"] = (run_batch, fail)
+        try:
+            data = json.loads(self.client().delete("/shelves/1/books?background=true", json={"book_ids": [10000]},
+                                                   headers=self.librarian_auth_header).data)
+            job = self.wait_for_job(data["job"])
+        finally:
+            job_runner.handlers["stored_books"] = (run_batch, finish)
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["errors"][-1]["message"], "finish failed")
+
+    def test_404_job_of_other_user(self):
+        data = json.loads(self.client().delete("/shelves/1/books?background=true", json={"book_ids": [10000]},
+                                               headers=self.librarian_auth_header).data)
+        self.wait_for_job(data["job"])
+        res = self.client().get(f"/jobs/{data['job']}", headers=self.manager_auth_header)
+        self.assertEqual(res.status_code, 404)
+        res = self.client().get("/jobs/100000", headers=self.librarian_auth_header)
+        self.assertEqual(res.status_code, 404)
+
+    # endregion
+
+    # region Seed
+
+    def test_seed_is_deterministic_and_unique(self):
+        from seed import generate_authors, generate_books
+
+        authors = list(generate_authors(7, 3000, first_id=10))
+        books = [row for row, genres in generate_books(7, 3000, 3000, first_id=10, first_author_id=10)]
+        self.assertEqual(authors, list(generate_authors(7, 3000, first_id=10)))
+        self.assertEqual(books, [row for row, genres in generate_books(7, 3000, 3000, first_id=10, first_author_id=10)])
+        # the api refuses duplicate titles and names regardless of the case
+        self.assertEqual(len({row[1].lower() for row in authors}), len(authors))
+        self.assertEqual(len({row[1].lower() for row in books}), len(books))
 
     # endregion
 